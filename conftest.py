@@ -0,0 +1 @@
+"""Puts the repository root on `sys.path`, so `pytest` imports `crawler` from the checkout."""
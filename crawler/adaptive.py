@@ -0,0 +1,259 @@
+""" Adaptive per-host load control
+
+Every host gets an AIMD controller over two limits: the interval between
+request starts and the number of requests in flight. A response in normal
+time (below `slow_factor` times the fastest recent response of the host, or
+below `slow_latency`) adds to the request rate and to the concurrency; a slow
+response or a transient failure (timeout, connection error, 5xx, 429) cuts
+both multiplicatively, at most once per response time so a burst of failures
+of requests in flight counts once. Fast hosts are so fetched up to
+`max_concurrency` requests at a time and `min_delay` apart, slow ones back
+off to a single connection and up to `max_delay` between requests.
+
+A `Crawl-delay` in robots.txt stays the lower bound of the interval of its
+host; hosts without one start at the default crawl delay.
+
+Transient failures are retried after a full-jitter exponential backoff (or
+the `Retry-After` of the response, if longer). A 429 or 503 with a
+`Retry-After` parks the host until then and only cuts its concurrency: the
+host said when to come back, halving the rate as well would slow it down
+for every such error it returns by chance. `park_after` failures in a row
+park the host for `park_time`, doubled with every park, after which it goes
+on at its pace from before the failures. A host still failing after
+`max_parks` parks is down for `max_park` seconds: its urls are handed back
+to the frontier without a request (see `PolitenessScheduler.defer`), a url
+that used up its retries fails with `HostDown`.
+
+The controller is not thread-safe, `PolitenessScheduler` calls it with its
+lock held:
+
+    controller = AdaptiveController(min_delay=0.5, max_concurrency=4)
+    scheduler = PolitenessScheduler(Worker.get_domain_from_url, refill, controller=controller)
+"""
+
+import random
+import datetime
+
+from email.utils import parsedate_to_datetime
+
+import requests
+
+from crawler.robots import DEFAULT_CRAWL_DELAY
+
+
+THROTTLE_STATUS = (429, 503)
+RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+DEFAULT_MIN_DELAY = 0.5
+DEFAULT_MAX_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+
+
+class HostDown(Exception):
+    pass
+
+
+def status_of(error):
+    """ HTTP status of the response `error` was raised for, or `None`. """
+    response = getattr(error, "response", None)
+    return response.status_code if response is not None else None
+
+
+def is_transient(error):
+    """ Whether fetching again later may succeed. """
+    status = status_of(error)
+    if status is not None:
+        return status in RETRY_STATUS
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def retry_after(error, now=None):
+    """ Seconds to wait from the `Retry-After` header (delay or HTTP date) of the response of `error`, or `None`. """
+    response = getattr(error, "response", None)
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (when - (now or datetime.datetime.now(datetime.timezone.utc))).total_seconds())
+
+
+class RetryPolicy:
+    def __init__(self, retries=DEFAULT_RETRIES, base=2.0, cap=300.0, rnd=None):
+        self.retries = retries
+        self.base = base
+        self.cap = cap
+        self.random = rnd or random.Random()
+
+    def delay(self, attempt, error):
+        """ Seconds until retry `attempt` (from 1) after `error`, `None` if it is not retried. """
+        if attempt > self.retries or not is_transient(error):
+            return None
+        backoff = self.random.uniform(0, min(self.cap, self.base * 2 ** (attempt - 1)))
+        after = retry_after(error)
+        return max(backoff, min(after, self.cap)) if after is not None else backoff
+
+
+class HostControl:
+    def __init__(self, interval, floor):
+        self.interval = interval  # seconds between request starts
+        self.floor = floor        # lowest interval: robots.txt Crawl-delay or `min_delay`
+        self.limit = 1.0          # requests allowed in flight
+        self.in_flight = 0
+        self.latency = None       # moving average of the response time
+        self.best = None          # fastest recent response time
+        self.decreased_at = float("-inf")
+        self.failures = 0         # transient failures in a row
+        self.resume = interval    # interval before the failures, restored after a park
+        self.parks = 0
+        self.parked_until = 0.0
+        self.down_until = 0.0
+        self.responses = 0
+        self.errors = 0
+
+    def can_start(self):
+        return self.in_flight < int(self.limit)
+
+
+class AdaptiveController:
+    def __init__(self, default_delay=DEFAULT_CRAWL_DELAY, min_delay=DEFAULT_MIN_DELAY, max_delay=60.0,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, increase=0.1, decrease=0.5, slow_factor=3.0,
+                 slow_latency=1.0, smoothing=0.2, park_after=5, park_time=30.0, max_parks=3, max_park=600.0,
+                 retry: RetryPolicy = None):
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_concurrency = max_concurrency
+        self.increase = increase        # requests/sec added to the rate per normal response
+        self.decrease = decrease        # factor applied to rate and concurrency
+        self.slow_factor = slow_factor
+        self.slow_latency = slow_latency
+        self.smoothing = smoothing
+        self.park_after = park_after
+        self.park_time = park_time
+        self.max_parks = max_parks
+        self.max_park = max_park
+        self.retry = retry or RetryPolicy()
+        self.hosts = {}
+        self.parked = {}  # domain -> monotonic time it is parked until
+
+    def host(self, domain) -> HostControl:
+        host = self.hosts.get(domain)
+        if host is None:
+            host = self.hosts[domain] = HostControl(max(self.default_delay, self.min_delay), self.min_delay)
+        return host
+
+    def set_delay(self, domain, delay):
+        """ `delay` from robots.txt is the lowest interval of `domain`. """
+        host = self.host(domain)
+        host.floor = delay
+        host.interval = max(host.interval, delay)
+
+    def interval(self, domain):
+        return self.host(domain).interval
+
+    def can_start(self, domain):
+        return self.host(domain).can_start()
+
+    def start(self, domain):
+        self.host(domain).in_flight += 1
+
+    def release(self, domain):
+        host = self.host(domain)
+        host.in_flight = max(0, host.in_flight - 1)
+
+    def parked_until(self, domain):
+        return self.parked.get(domain, 0.0)
+
+    def is_down(self, domain, now):
+        host = self.hosts.get(domain)
+        return host is not None and host.down_until > now
+
+    def parked_domains(self, now):
+        for domain in [domain for domain, until in self.parked.items() if until <= now]:
+            del self.parked[domain]
+        return self.parked.keys()
+
+    def record(self, domain, now, latency, error=None):
+        """ Adapt the limits of `domain` to a response after `latency` seconds, or to the failure `error`. """
+        host = self.host(domain)
+        if error is None or not is_transient(error):
+            # any response, also a 404, shows how loaded the host is
+            host.responses += 1
+            host.failures = 0
+            host.parks = 0
+            if host.best is None or latency < host.best:
+                host.best = latency
+            else:
+                # forget a fast response long gone, e.g. of a cached page
+                host.best += (latency - host.best) * self.smoothing / 10
+            host.latency = latency if host.latency is None else \
+                host.latency + (latency - host.latency) * self.smoothing
+            if host.latency > max(self.slow_factor * host.best, self.slow_latency):
+                self._decrease(host, now)
+            else:
+                self._increase(host)
+            return
+
+        host.errors += 1
+        host.failures += 1
+        if host.failures == 1:
+            host.resume = host.interval
+        wait = retry_after(error)
+        if wait is not None and status_of(error) in THROTTLE_STATUS:
+            host.limit = max(1.0, host.limit * self.decrease)
+            self._park(domain, host, now + min(wait, self.max_park))
+        else:
+            self._decrease(host, now)
+        if host.failures >= self.park_after:
+            # the park is the backoff, the host is tried again at its earlier pace
+            host.interval = max(host.floor, host.resume)
+            host.failures = 0
+            host.parks += 1
+            if host.parks < self.max_parks:
+                self._park(domain, host, now + min(self.max_park, self.park_time * 2 ** (host.parks - 1)))
+                return
+            # one more failure streak after it is back takes it down again
+            host.parks -= 1
+            host.down_until = now + self.max_park
+            host.parked_until = 0.0
+            self.parked.pop(domain, None)
+
+    def _increase(self, host: HostControl):
+        host.limit = min(self.max_concurrency, host.limit + 1 / host.limit)
+        if host.interval > host.floor:
+            host.interval = max(host.floor, 1 / (1 / host.interval + self.increase))
+
+    def _decrease(self, host: HostControl, now):
+        if now - host.decreased_at < (host.latency or 0.0):
+            return
+        host.decreased_at = now
+        host.limit = max(1.0, host.limit * self.decrease)
+        host.interval = min(max(self.max_delay, host.floor), max(host.interval, 0.1) / self.decrease)
+
+    def _park(self, domain, host: HostControl, until):
+        if until > host.parked_until:
+            host.parked_until = until
+            self.parked[domain] = until
+
+    def stats(self, domain):
+        host = self.hosts.get(domain)
+        if host is None:
+            return {}
+        return {
+            "interval": host.interval,
+            "limit": int(host.limit),
+            "in_flight": host.in_flight,
+            "latency": host.latency or 0.0,
+            "responses": host.responses,
+            "errors": host.errors,
+        }
@@ -0,0 +1,258 @@
+""" Asyncio fetch engine
+
+Runs many in-flight fetches on a single event loop. HTTP connections are
+pooled and kept alive per host by one shared `aiohttp` session. Everything
+that blocks (robots.txt handling, parsing and `Storage` persistence) is handed
+to a small pool of threads, each owning its own `Worker` and DB connection.
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from crawler.blobs import TooLarge, CHUNK_SIZE, DEFAULT_MAX_SIZE
+from crawler.storage import DEFAULT_LEASE, connect
+from crawler.metrics import metrics
+from crawler.robots import DEFAULT_CRAWL_DELAY
+from crawler.web_crawler import Worker
+
+
+DEFAULT_CONCURRENCY = 1000
+DEFAULT_LIMIT_PER_HOST = 8
+DEFAULT_DB_THREADS = 4
+
+
+class FetchedResponse:
+    """ Minimal stand-in for `requests.Response` so `Worker.handle_response`
+        can store pages fetched by the async engine.
+    """
+
+    def __init__(self, url, status_code, headers, content, encoding=None):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding or "utf-8"
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, errors="replace")
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+def _trace_stage(stage, on_start, on_end):
+    async def start(session, context, params):
+        setattr(context, stage, time.perf_counter())
+
+    async def end(session, context, params):
+        metrics.observe(stage, time.perf_counter() - getattr(context, stage))
+
+    on_start.append(start)
+    on_end.append(end)
+
+
+def metrics_trace_config():
+    """ Time DNS lookups and new connections as their own crawl stages. """
+    trace = aiohttp.TraceConfig()
+    _trace_stage("dns", trace.on_dns_resolvehost_start, trace.on_dns_resolvehost_end)
+    _trace_stage("connect", trace.on_connection_create_start, trace.on_connection_create_end)
+    return trace
+
+
+class AsyncFetcher:
+    """ Shared `aiohttp` session with keep-alive connection pools per host.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, limit_per_host=DEFAULT_LIMIT_PER_HOST, timeout=10,
+                 max_size=DEFAULT_MAX_SIZE):
+        self.concurrency = concurrency
+        # bodies are buffered in memory here, so every response is capped at `max_size` bytes
+        self.max_size = max_size
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.concurrency,
+                                         limit_per_host=self.limit_per_host,
+                                         ttl_dns_cache=300,
+                                         ssl=False)
+        # time spent waiting for a pooled connection is not a timeout
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(sock_connect=self.timeout,
+                                                                           sock_read=self.timeout),
+                                             trace_configs=[metrics_trace_config()])
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def fetch(self, url: str, headers=None):
+        async with self.session.get(url, headers=headers, allow_redirects=False) as response:
+            response.raise_for_status()
+            if response.content_length and response.content_length > self.max_size:
+                raise TooLarge("Content-Length is %d bytes" % response.content_length)
+            content = bytearray()
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                content += chunk
+                if len(content) > self.max_size:
+                    raise TooLarge("more than %d bytes" % self.max_size)
+            content = bytes(content)
+            return FetchedResponse(url, response.status, response.headers, content, response.charset)
+
+
+class AsyncCrawler:
+    """ Crawl the frontier with up to `concurrency` fetches in flight.
+
+        Each DB thread lazily creates its own `Worker` (without Selenium) and
+        DB connection.
+    """
+
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, limit_per_host=DEFAULT_LIMIT_PER_HOST,
+                 db_threads=DEFAULT_DB_THREADS, idle_retries=50, claim_batch=100, seen=None, dedup=None, blobs=None, shard=None,
+                 recrawl=None, owner=None, lease=DEFAULT_LEASE):
+        self.concurrency = concurrency
+        self.owner = owner
+        self.lease = lease
+        self.recrawl = recrawl
+        self.shard = shard
+        self.blobs = blobs
+        self.seen = seen
+        self.dedup = dedup
+        self.claim_batch = claim_batch
+        self.limit_per_host = limit_per_host
+        self.idle_retries = idle_retries
+        self.executor = ThreadPoolExecutor(max_workers=db_threads)
+        self.local = threading.local()
+        self.worker_ids = itertools.count()
+        self.next_allowed = {}  # domain -> earliest time of the next request
+        self.fetched = 0
+
+    def _worker(self) -> Worker:
+        worker = getattr(self.local, "worker", None)
+        if worker is None:
+            worker = Worker(next(self.worker_ids), connect(), seen=self.seen, dedup=self.dedup,
+                            blobs=self.blobs, recrawl=self.recrawl)
+            self.local.worker = worker
+        return worker
+
+    async def _in_thread(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    def _claim(self):
+        return self._worker().conn.claim_from_frontier(self.claim_batch, shard=self.shard, owner=self.owner,
+                                                       lease=self.lease)
+
+    def _prepare(self, url, is_binary):
+        worker = self._worker()
+        url, site_id, crawl_delay, allowed = worker.prepare_url(url, is_binary)
+        revisit = worker.revisit_for(url, is_binary) if allowed else None
+        return url, site_id, crawl_delay, allowed, revisit
+
+    def _for_row(self, row, fn, *args):
+        # outcomes are stored on the claimed row
+        worker = self._worker()
+        worker.row = row
+        try:
+            return fn(*args)
+        finally:
+            worker.row = None
+
+    def _disallow(self, url):
+        self._worker().disallow(url)
+
+    def _handle(self, url, site_id, is_binary, response, err, revisit=None):
+        worker = self._worker()
+        if err is not None:
+            worker.handle_error(url, site_id, err)
+            return
+        try:
+            worker.handle_response(url, site_id, is_binary, response, revisit)
+        except Exception as e:
+            worker.handle_error(url, site_id, e)
+
+    async def _wait_for_domain(self, url, crawl_delay):
+        # politeness: sleep this coroutine only, the event loop keeps going
+        domain = Worker.get_domain_from_url(url)
+        now = time.monotonic()
+        ready = max(now, self.next_allowed.get(domain, now))
+        self.next_allowed[domain] = ready + (DEFAULT_CRAWL_DELAY if crawl_delay is None else crawl_delay)
+        if ready > now:
+            await asyncio.sleep(ready - now)
+
+    async def _process(self, fetcher, row):
+        _, url, is_binary, _ = row
+        url, site_id, crawl_delay, allowed, revisit = await self._in_thread(self._prepare, url, is_binary)
+        if not allowed:
+            await self._in_thread(self._for_row, row, self._disallow, url)
+            return
+        await self._wait_for_domain(url, crawl_delay)
+
+        response, err = None, None
+        try:
+            with metrics.timer("fetch"):
+                response = await fetcher.fetch(url, revisit.headers() if revisit else None)
+            metrics.count("fetches", domain=Worker.get_domain_from_url(url))
+        except Exception as e:
+            err = e
+        await self._in_thread(self._for_row, row, self._handle, url, site_id, is_binary, response, err, revisit)
+        self.fetched += 1
+        print('Dequed: ', url)
+
+    async def _fetch_loop(self, fetcher, queue):
+        while True:
+            row = await queue.get()
+            try:
+                if row is None:
+                    return
+                await self._process(fetcher, row)
+            except Exception as e:
+                print("Error while crawling {}".format(row[1]), e)
+                metrics.error("crawl", e)
+            finally:
+                queue.task_done()
+
+    async def _feed(self, queue):
+        retry_count = self.idle_retries
+        while retry_count:
+            rows = await self._in_thread(self._claim)
+            if not rows:
+                # frontier is empty, but in-flight pages may still add new urls
+                await queue.join()
+                rows = await self._in_thread(self._claim)
+            if rows:
+                retry_count = self.idle_retries
+                for row in rows:
+                    await queue.put(row)
+                continue
+            retry_count -= 1
+            await asyncio.sleep(10)
+        print("Finished crawling")
+
+    async def run(self):
+        queue = asyncio.Queue(maxsize=self.concurrency)
+        metrics.gauge("queued", queue.qsize)
+        max_size = self.blobs.max_size if self.blobs else DEFAULT_MAX_SIZE
+        async with AsyncFetcher(self.concurrency, self.limit_per_host, max_size=max_size) as fetcher:
+            tasks = [asyncio.ensure_future(self._fetch_loop(fetcher, queue)) for _ in range(self.concurrency)]
+            await self._feed(queue)
+            for _ in tasks:
+                await queue.put(None)
+            await asyncio.gather(*tasks)
+        self.executor.shutdown()
+        return self.fetched
+
+    def __call__(self):
+        return asyncio.run(self.run())
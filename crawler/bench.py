@@ -0,0 +1,1295 @@
+""" Crawler benchmarks against a local stand-in HTTP server
+
+    python -m crawler.bench fetch --pages 2000 --latency 0.05
+"""
+
+import os
+import sys
+import time
+import random
+import asyncio
+import itertools
+import argparse
+import threading
+
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+def synthetic_page(n: int, links=20, pages=1000):
+    """ A small gov.si-like HTML page with `links` outgoing links. """
+    rnd = random.Random(n)
+    hrefs = "".join(
+        '<li><a href="/page/%d">Povezava %d</a></li>' % (rnd.randrange(pages), i) for i in range(links)
+    )
+    return (
+        "<html><head><title>Stran %d</title></head><body>"
+        "<div class=\"header\"><img src=\"/img/logo.png\"></div>"
+        "<ul>%s</ul><p>%s</p></body></html>" % (n, hrefs, "Vsebina strani. " * 50)
+    ).encode("utf-8")
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive
+    # headers and body are separate writes, don't let Nagle hold the body back on kept-alive connections
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # emulate connection setup (handshakes) of a remote host, paid once per connection
+        if self.server.connect_latency:
+            time.sleep(self.server.connect_latency)
+        super().setup()
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        etag = None
+        if self.path == "/robots.txt":
+            body, content_type = b"User-agent: *\nAllow: /\n", "text/plain"
+        elif self.path in server.files:
+            body, content_type = server.files[self.path]
+        elif self.path.startswith("/page/"):
+            n = int(self.path.rsplit("/", 1)[-1] or 0)
+            version = server.versions.get(n, 0)
+            etag = '"%d-%d"' % (n, version)
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body, content_type = synthetic_page(n + 1000000 * version), "text/html; charset=utf-8"
+        else:
+            body, content_type = b"", "text/plain"
+
+        self.send_response(200 if body else 404)
+        if etag:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class StandInServer:
+    """ Threaded local HTTP server serving synthetic pages, optionally with a
+        fixed per-request latency to emulate a remote host.
+    """
+
+    def __init__(self, latency=0.0, handler=StandInHandler, connect_latency=0.0):
+        self.httpd = _HTTPServer(("127.0.0.1", 0), handler)
+        self.httpd.latency = latency
+        self.httpd.connect_latency = connect_latency
+        self.httpd.versions = {}  # page number -> version, bumped to simulate a changed page
+        self.httpd.files = {}     # path -> (body, content type) of extra static files
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address
+        return "http://%s:%d" % (host, port)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _report(name, pages, elapsed):
+    print("%-28s %6d pages in %6.2fs  %8.1f pages/sec" % (name, pages, elapsed, pages / elapsed))
+
+
+def bench_fetch(args):
+    """ Pages/sec of threaded `Worker.get_response` vs. the asyncio engine. """
+    from crawler.web_crawler import Worker
+    from crawler.async_fetch import AsyncFetcher
+
+    with StandInServer(latency=args.latency) as server:
+        urls = ["%s/page/%d" % (server.base_url, n) for n in range(args.pages)]
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as executor:
+            list(executor.map(Worker.get_response, urls))
+        _report("threads (%d workers)" % args.threads, len(urls), time.perf_counter() - start)
+
+        async def fetch_all():
+            async with AsyncFetcher(concurrency=args.concurrency, limit_per_host=args.concurrency) as fetcher:
+                await asyncio.gather(*(fetcher.fetch(url) for url in urls))
+
+        start = time.perf_counter()
+        asyncio.run(fetch_all())
+        _report("async (%d in flight)" % args.concurrency, len(urls), time.perf_counter() - start)
+
+
+def bench_client(args):
+    """ Fresh connection per request vs. the shared client's keep-alive pools and DNS cache. """
+    import requests
+    from crawler.client import http_client
+
+    with StandInServer(latency=args.latency, connect_latency=args.connect_latency) as server:
+        # by name, so that DNS is part of the cost
+        urls = ["http://localhost:%d/page/%d" % (server.httpd.server_address[1], n) for n in range(args.pages)]
+
+        def fresh(url):
+            return requests.get(url, headers={"Connection": "close"}).content
+
+        def shared(url):
+            return http_client.get(url).content
+
+        for name, fetch in (("new connection", fresh), ("shared client", shared)):
+            before = http_client.stats()
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.threads) as executor:
+                list(executor.map(fetch, urls))
+            _report(name, len(urls), time.perf_counter() - start)
+            after = http_client.stats()
+            print("%-28s %6d connections, %d DNS lookups" %
+                  ("", after["connections"] - before["connections"], after["dns_misses"] - before["dns_misses"]))
+
+
+def bench_recrawl(args):
+    """ Bytes and time of a repeat crawl with and without conditional requests. """
+    from crawler.web_crawler import Worker
+    from crawler.recrawl import Revisit
+
+    def crawl(urls, revisits=None):
+        transferred, statuses = 0, {}
+        start = time.perf_counter()
+        for url in urls:
+            revisit = revisits.get(url) if revisits else None
+            response = Worker.get_response(url, revisit.headers() if revisit else None)
+            transferred += len(response.content)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            etags[url] = response.headers.get("ETag")
+        return transferred, statuses, time.perf_counter() - start
+
+    with StandInServer(latency=args.latency) as server:
+        urls = ["%s/page/%d" % (server.base_url, n) for n in range(args.pages)]
+        etags = {}
+        crawl(urls)
+        revisits = {url: Revisit(None, etag, None, None, 1, 0, 0.0, None) for url, etag in etags.items()}
+        for n in random.Random(0).sample(range(args.pages), int(args.changed * args.pages)):
+            server.httpd.versions[n] = 1
+
+        for name, known in (("full recrawl", None), ("conditional recrawl", revisits)):
+            transferred, statuses, elapsed = crawl(urls, known)
+            _report(name, len(urls), elapsed)
+            print("%-28s %8.1f KB  statuses %s" % ("", transferred / 1024, statuses))
+
+
+def _sitemap(base_url, start, count):
+    import gzip
+    entries = "".join("<url><loc>%s/page/%d</loc><lastmod>2019-03-%02d</lastmod></url>" % (base_url, n, n % 28 + 1)
+                      for n in range(start, start + count))
+    return gzip.compress(('<?xml version="1.0" encoding="UTF-8"?>'
+                          '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</urlset>' % entries).encode())
+
+
+def bench_sitemap(args):
+    """ Streaming ingestion of a sitemap index with gzip sitemaps of 50k urls each. """
+    import resource
+    from crawler.sitemap import SitemapReader
+
+    with StandInServer(latency=args.latency) as server:
+        index = []
+        for n in range(args.sitemaps):
+            path = "/sitemap-%d.xml.gz" % n
+            server.httpd.files[path] = (_sitemap(server.base_url, n * args.urls, args.urls), "application/gzip")
+            index.append("<sitemap><loc>%s%s</loc><lastmod>2019-03-01</lastmod></sitemap>" % (server.base_url, path))
+        server.httpd.files["/sitemap_index.xml"] = (
+            ('<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">'
+             '%s</sitemapindex>' % "".join(index)).encode(), "application/xml")
+
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.perf_counter()
+        urls = sum(len(chunk) for chunk in SitemapReader().urls([server.base_url + "/sitemap_index.xml"]))
+        elapsed = time.perf_counter() - start
+        print("%d urls from %d sitemaps in %.2fs (%.0f urls/sec), peak RSS grew by %.1f MB" %
+              (urls, args.sitemaps, elapsed, urls / elapsed,
+               (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss) / 1024))
+
+
+def bench_writes(args):
+    """ Rows/sec and commits per page: per-row inserts vs. `WriteBatch` (needs the crawldb Postgres). """
+    from crawler.utils import DBConn, DBApi, WriteBatch
+
+    api = DBApi(DBConn())
+    site_id = api.insert_site("bench-%d.gov.si" % os.getpid(), "", "")
+    run = "%d-%d" % (os.getpid(), int(time.time()))
+
+    def page_links(mode, n):
+        return ["http://bench.gov.si/%s/%s/%d/%d" % (run, mode, n, i) for i in range(args.links)]
+
+    def per_row(n):
+        page_id = api.insert_page(site_id, "HTML", "http://bench.gov.si/%s/row/%d" % (run, n), "", 200, None)
+        for url in page_links("row", n):
+            api.insert_link(page_id, api.insert_page(site_id, "FRONTIER", url, None, None, None))
+        api.conn.commit()
+
+    def batched(n):
+        page_id = api.insert_page(site_id, "HTML", "http://bench.gov.si/%s/batch/%d" % (run, n), "", 200, None)
+        batch = WriteBatch()
+        for url in page_links("batch", n):
+            batch.add_frontier(url, site_id)
+            batch.add_link(page_id, url)
+        batch.flush(api)
+
+    for name, process in (("per-row inserts", per_row), ("WriteBatch", batched)):
+        commits = api.conn.commits
+        start = time.perf_counter()
+        for n in range(args.pages):
+            process(n)
+        elapsed = time.perf_counter() - start
+        rows = args.pages * (2 * args.links + 1)
+        print("%-18s %8.0f rows/sec  %6.1f commits/page" %
+              (name, rows / elapsed, (api.conn.commits - commits) / args.pages))
+
+    api.conn.release()
+
+
+def _storage_workload(run, base, pages, links, done):
+    """ Crawl `pages` synthetic pages from the frontier of the configured backend, like a `Worker` would. """
+    import datetime
+    from crawler.storage import connect
+    from crawler.utils import WriteBatch
+
+    api = connect()
+    batch = WriteBatch()
+    rnd = random.Random()
+    idle = 0
+    while idle < 20 and len(done) < pages:
+        rows = api.claim_from_frontier(20, owner=run)
+        if not rows:
+            idle += 1
+            time.sleep(0.05)
+            continue
+        idle = 0
+        for id, url, _, _ in rows:
+            n = int(url.rsplit("/", 1)[-1])
+            document = synthetic_page(n, links=links, pages=pages).decode()
+            api.page_for_url(url)
+            # a tree over all pages plus links back to already crawled ones
+            hrefs = ["%s/page/%d" % (base, child) for child in range(n * links + 1, min(pages, (n + 1) * links + 1))]
+            hrefs += ["%s/page/%d" % (base, rnd.randrange(n + 1)) for _ in range(links - len(hrefs))]
+            new = set(hrefs) - set(api.existing_urls(hrefs))
+            api.update_page(id, "HTML", document, 200, datetime.datetime.now(), hash=n, simhash=n)
+            for href in hrefs:
+                if href in new:
+                    batch.add_frontier(href, 1, source_id=id)
+                batch.add_link(id, href)
+            batch.flush(api)
+            done.append(len(document))
+    api.close()
+
+
+def bench_storage(args):
+    """ Pages/sec of the same crawl workload on the Postgres and SQLite storage backends. """
+    import tempfile
+    from crawler.storage import configure, connect
+    from crawler.utils import WriteBatch
+
+    for backend in args.backends:
+        run = "%d-%d" % (os.getpid(), int(time.time()))
+        path = os.path.join(tempfile.mkdtemp(), "bench.sqlite")
+        configure(backend, path)
+        base = "http://bench.gov.si/%s" % run
+
+        api = connect()
+        site_id = api.insert_site("bench-%s.gov.si" % run, "", "")
+        batch = WriteBatch()
+        batch.add_frontier("%s/page/0" % base, site_id)
+        batch.flush(api)
+        api.close()
+
+        done = []
+        start = time.perf_counter()
+        threads = [threading.Thread(target=_storage_workload, args=(run, base, args.pages, args.links, done))
+                   for _ in range(args.threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        _report("%s (%d threads)" % (backend, args.threads), len(done), time.perf_counter() - start)
+        if backend == "sqlite":
+            size = sum(os.path.getsize(path + suffix) for suffix in ("", "-wal") if os.path.exists(path + suffix))
+            print("%-28s %6.1f MB of HTML in a %.1f MB database file" % ("", sum(done) / 2 ** 20, size / 2 ** 20))
+
+
+def _parse_pages(pages):
+    from crawler.web_crawler import Worker
+    for document in pages:
+        Worker.extract_links(document)
+    return len(pages)
+
+
+def bench_shards(args):
+    """ Parse throughput (streaming link extractor, `crawler.links`) with N threads vs. N processes. """
+    pages = [synthetic_page(n, links=args.links).decode().replace('href="/', 'href="http://www.gov.si/')
+             for n in range(args.pages)]
+
+    for n in args.scale:
+        chunks = [pages[i::n] for i in range(n)]
+        for name, executor_class in (("threads", ThreadPoolExecutor), ("processes", ProcessPoolExecutor)):
+            with executor_class(max_workers=n) as executor:
+                list(executor.map(_parse_pages, [pages[:n]] * n))  # warm up workers
+                start = time.perf_counter()
+                parsed = sum(executor.map(_parse_pages, chunks))
+                _report("%d %s" % (n, name), parsed, time.perf_counter() - start)
+
+
+def _canonical_form(url):
+    import urlcanon
+    return str(urlcanon.semantic(urlcanon.parse_url(url)))
+
+
+def _is_valid_url(url):
+    import validators
+    return bool(validators.url(url))
+
+
+def _extract_links_soup(document):
+    # the BeautifulSoup implementation `crawler.links` replaced, kept as the reference
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(document, 'html.parser')
+    base_tags_urls = [base_url.get('href') for base_url in soup.find_all('base')]
+    base_url_for_image = base_tags_urls[0] if base_tags_urls else None
+
+    hrefs = [
+        _canonical_form(a.get("href"))
+        for a in soup.find_all(href=True)
+        if _is_valid_url(a.get("href"))
+    ]
+    image_sources = []
+    for img in [a.get("src") for a in soup.find_all('img', src=True)]:
+        if _is_valid_url(img):
+            image_sources.append(img)
+        elif base_url_for_image is not None:
+            img = _canonical_form(os.path.join(base_url_for_image, img))
+            if _is_valid_url(img) and 'base64' not in img:
+                image_sources.append(img)
+    return hrefs, image_sources
+
+
+def bench_links(args):
+    """ Streaming link extractor vs. BeautifulSoup on gov.si pages from the `db` dump. """
+    from crawler.corpus import html_pages
+    from crawler.links import extract_links
+
+    pages = [document for _, document in html_pages(limit=args.pages)]
+    print("%d pages, %.1f MB of HTML" % (len(pages), sum(map(len, pages)) / 2 ** 20))
+
+    mismatches, found = 0, {"streaming": 0, "BeautifulSoup": 0}
+    for document in pages:
+        streamed, soup = extract_links(document), _extract_links_soup(document)
+        found["streaming"] += sum(map(len, streamed))
+        found["BeautifulSoup"] += sum(map(len, soup))
+        if streamed != soup:
+            mismatches += 1
+    # the streaming extractor also resolves relative hrefs against `<base href>`,
+    # follows `onclick` locations and canonicalises image urls
+    print("pages with different links: %d, links found: %s" %
+          (mismatches, ", ".join("%s %d" % item for item in found.items())))
+
+    for name, extract in (("BeautifulSoup", _extract_links_soup), ("streaming", extract_links)):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for document in pages:
+                extract(document)
+        _report(name, len(pages) * args.repeat, time.perf_counter() - start)
+
+
+def _process_url_strings(url):
+    # the checks `crawler.urls` replaced: a validators regex, two urlcanon passes and substring tests
+    from urllib.parse import urlparse
+    if not _is_valid_url(url):
+        return None
+    canonical = _canonical_form(url)
+    if ".gov.si" not in canonical:
+        return None
+    domain = "{uri.netloc}/".format(uri=urlparse(canonical)).replace('www.', '')[:-1]
+    file_type = next((f for f in ("pdf", "doc", "docx", "ppt", "pptx") if f in canonical), None)
+    return _canonical_form(canonical), domain, file_type
+
+
+def bench_urls(args):
+    """ Url checks on the links of `export/link.csv` and the dump pages: string tests vs. the cached `UrlEngine`. """
+    from crawler.corpus import read_table, read_csv, html_pages
+    from crawler.links import LinkExtractor
+    from crawler.urls import UrlEngine
+
+    # link.csv only has page ids, most of them from a larger crawl than the dump has urls for
+    pages = {row["id"]: row["url"] for row in read_table("page")}
+    targets = [pages[row["to_page"]] for row in read_csv("link") if row["to_page"] in pages]
+    hrefs = []
+    for _, document in html_pages():
+        parser = LinkExtractor()
+        parser.feed(document)
+        parser.close()
+        hrefs.extend(parser.hrefs)
+
+    for name, urls in (("link.csv targets", targets), ("hrefs of dump pages", hrefs)):
+        print("%s: %d urls, %d unique" % (name, len(urls), len(set(urls))))
+        engine = UrlEngine()
+        scope_differs = files_differ = 0
+        for url in set(urls):
+            if _is_valid_url(url):
+                info, (_, _, file_type) = engine.parse(url), _process_url_strings(url) or (None, None, None)
+                scope_differs += info.in_scope != (".gov.si" in url)
+                files_differ += info.in_scope and (info.file_type or "").lower() != (file_type or "")
+        print("  valid urls classified differently: %d in scope, %d file types" % (scope_differs, files_differ))
+
+        def report(label, elapsed):
+            count = len(urls) * args.repeat
+            print("  %-26s %8d urls in %6.2fs  %10.0f urls/sec  %6.1f us/url" %
+                  (label, count, elapsed, count / elapsed, 1e6 * elapsed / count))
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for url in urls:
+                _process_url_strings(url)
+        report("string checks", time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            UrlEngine(cache_size=0).parse_many(urls)
+        report("engine, no cache", time.perf_counter() - start)
+
+        engine = UrlEngine(cache_size=args.cache_size)
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for i in range(0, len(urls), args.batch):
+                engine.filter(urls[i:i + args.batch])
+        report("engine, LRU cache", time.perf_counter() - start)
+        info = engine.cache_info()
+        print("  cache hit rate %.1f%% (%d entries)" % (100 * info.hits / max(1, info.hits + info.misses),
+                                                      info.currsize))
+
+
+def _pagerank(nodes, outlinks, damping=0.85, iterations=50):
+    rank = dict.fromkeys(nodes, 1.0 / len(nodes))
+    for _ in range(iterations):
+        leaked = sum(rank[n] for n in nodes if not outlinks.get(n))
+        new = dict.fromkeys(nodes, (1 - damping + damping * leaked) / len(nodes))
+        for n in nodes:
+            targets = outlinks.get(n)
+            if targets:
+                share = damping * rank[n] / len(targets)
+                for target in targets:
+                    new[target] += share
+        rank = new
+    return rank
+
+
+def _replay(seeds, outlinks, budget, priority=None):
+    """ Order in which a crawl starting at `seeds` fetches pages; FIFO without
+        `priority(page, depth, cash)`, best-first with lazy-deleted heap entries otherwise.
+    """
+    import heapq
+
+    depth = {seed: 0 for seed in seeds}
+    cash = dict.fromkeys(seeds, 0.0)
+    fetched, order = set(), []
+    queue = [(-priority(seed, 0, 0.0) if priority else n, n, seed) for n, seed in enumerate(seeds)]
+    heapq.heapify(queue)
+    counter = len(queue)
+    while queue and len(order) < budget:
+        key, _, page = heapq.heappop(queue)
+        if page in fetched or (priority and key != -priority(page, depth[page], cash[page])):
+            continue  # already fetched, or a stale entry from before its cash grew
+        fetched.add(page)
+        order.append(page)
+        targets = [t for t in outlinks.get(page, ()) if t not in fetched]
+        for target in targets:
+            if target not in depth:
+                depth[target], cash[target] = depth[page] + 1, 0.0
+                is_new = True
+            else:
+                is_new = False
+            cash[target] += 1.0 / len(targets)
+            if priority:
+                heapq.heappush(queue, (-priority(target, depth[target], cash[target]), counter, target))
+            elif is_new:
+                heapq.heappush(queue, (counter, counter, target))
+            counter += 1
+    return order
+
+
+def bench_frontier(args):
+    """ Replay the link graph of the `db` dump: FIFO vs. priority frontier coverage of important pages. """
+    import re
+    from crawler.corpus import read_table
+    from crawler.priority import PriorityScorer
+
+    urls, first_of_site = {}, {}
+    for row in read_table("page"):
+        page = int(row["id"])
+        urls[page] = row["url"]
+        first_of_site[row["site_id"]] = min(page, first_of_site.get(row["site_id"], page))
+    outlinks = {}
+    for row in read_table("link"):
+        if int(row["to_page"]) in urls:
+            outlinks.setdefault(int(row["from_page"]), []).append(int(row["to_page"]))
+    in_sitemap = set()
+    for row in read_table("site"):
+        in_sitemap.update(re.findall(r"<loc>\s*([^<\s]+)\s*</loc>", row["sitemap_content"] or ""))
+
+    seeds = sorted(first_of_site.values())
+    reachable = _replay(seeds, outlinks, len(urls))
+    rank = _pagerank(list(urls), outlinks)
+    total = sum(rank[page] for page in reachable)
+    important = set(sorted(reachable, key=rank.get, reverse=True)[:max(1, len(reachable) // 10)])
+    print("%d pages, %d links, %d reachable from %d seeds, %d in sitemaps" %
+          (len(urls), sum(map(len, outlinks.values())), len(reachable), len(seeds), len(in_sitemap)))
+
+    scorer = PriorityScorer()
+
+    def priority(page, depth, cash):
+        return scorer.score(urls[page], depth, urls[page] in in_sitemap) + scorer.cash_weight * cash
+
+    budgets = [0.1, 0.25, 0.5, 0.75, 1.0]
+    print("%-16s %s" % ("", "  ".join("%4d%% fetched" % (100 * b) for b in budgets)))
+    for name, order in (("FIFO", reachable), ("priority", _replay(seeds, outlinks, len(urls), priority))):
+        covered = []
+        for budget in budgets:
+            prefix = order[:int(budget * len(order))]
+            covered.append((sum(rank[page] for page in prefix) / total,
+                            len(important.intersection(prefix)) / len(important)))
+        print("%-16s %s" % (name + " rank", "  ".join("%11.1f%%" % (100 * r) for r, _ in covered)))
+        print("%-16s %s" % (name + " top 10%", "  ".join("%11.1f%%" % (100 * t) for _, t in covered)))
+
+
+# body of redirect responses, stored as duplicates of each other in the dump
+_MOVED = "<html><head><title>Moved</title></head><body>Document moved.</body></html>"
+
+
+def _corpus_key(url=None, host=None, path=None):
+    """ `(host, path)` under which the stand-in server looks up `url` (or a request for `host` and `path`). """
+    from urllib.parse import urlsplit, unquote
+    if url is not None:
+        parts = urlsplit(url)
+        host, path = parts.netloc, parts.path + ("?" + parts.query if parts.query else "")
+    host = host.lower().rsplit(":", 1)[0] if host.count(":") == 1 else host.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    return host, unquote(path or "/")
+
+
+def _corpus_responses(binary_size):
+    """ `{(host, path): (status, content type, body)}` of every page, robots.txt and sitemap in the `db` dump. """
+    import hashlib
+    import mimetypes
+    from urllib.parse import urlsplit
+    from crawler.corpus import read_table
+    from crawler.sitemap import sitemap_locations
+
+    rows = list(read_table("page"))
+    html = {row["id"]: row["html_content"] for row in rows if row["html_content"]}
+    responses = {}
+    for row in rows:
+        url = row["url"]
+        # pages that were never fetched have no status
+        status = int(row["http_status_code"] or 404)
+        if status >= 400:
+            response = (status, "text/plain", b"")
+        elif row["page_type_code"] == "BINARY":
+            # files and images are not in the dump, serve distinct filler of a fixed size
+            content_type = mimetypes.guess_type(urlsplit(url).path)[0] or "application/octet-stream"
+            body = hashlib.sha256(url.encode()).digest() * (binary_size // 32 + 1)
+            response = (status, content_type, body[:binary_size])
+        elif row["page_type_code"] == "UNKNOWN":
+            response = (status, "application/octet-stream", b"\0")
+        else:
+            document = html.get(row["id"]) or html.get(row["duplicate_page_id"]) or _MOVED
+            response = (status, "text/html; charset=utf-8", document.encode("utf-8"))
+        responses[_corpus_key(url)] = response
+
+    for row in read_table("site"):
+        robots = row["robots_content"]
+        if not robots or robots == "/":
+            continue  # robots.txt was unavailable
+        responses[(row["domain"], "/robots.txt")] = (200, "text/plain", robots.encode("utf-8"))
+        if (row["sitemap_content"] or "").lstrip().startswith("<"):
+            for location in sitemap_locations(robots.splitlines()):
+                responses[_corpus_key(location)] = (200, "application/xml", row["sitemap_content"].encode("utf-8"))
+    return responses
+
+
+class CorpusHandler(StandInHandler):
+    def setup(self):
+        super().setup()
+        if hasattr(self.request, "do_handshake"):
+            # TLS handshakes happen in the handler threads, not in the accepting one
+            self.request.do_handshake()
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        if "://" in self.path:
+            # absolute form, sent to proxies
+            key = _corpus_key(self.path)
+        else:
+            key = _corpus_key(host=self.headers.get("Host", ""), path=self.path)
+        status, content_type, body = server.responses.get(key, (404, "text/plain", b""))
+
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _self_signed_cert(directory):
+    """ `(cert, key)` paths of a throwaway certificate made with the openssl CLI, `None` without it. """
+    import shutil
+    import subprocess
+    if not shutil.which("openssl"):
+        return None
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    try:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+                        "-subj", "/CN=localhost", "-keyout", key, "-out", cert],
+                       check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return cert, key
+
+
+class _CorpusServer(_HTTPServer):
+    def handle_error(self, request, client_address):
+        pass  # crawlers drop kept-alive connections without notice
+
+
+def _serve_corpus(pipe, directory, latency, binary_size):
+    """ Serve the dump over HTTP (and HTTPS if a certificate can be made) until `pipe` receives something. """
+    import ssl
+
+    responses = _corpus_responses(binary_size)
+    servers = [_CorpusServer(("127.0.0.1", 0), CorpusHandler)]
+    cert = _self_signed_cert(directory)
+    if cert:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*cert)
+        tls = _CorpusServer(("127.0.0.1", 0), CorpusHandler)
+        tls.socket = context.wrap_socket(tls.socket, server_side=True, do_handshake_on_connect=False)
+        servers.append(tls)
+    for server in servers:
+        server.responses = responses
+        server.latency = latency
+        server.connect_latency = 0.0
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    pipe.send(([server.server_address for server in servers], len(responses)))
+    pipe.recv()
+
+
+class _CountingStorage:
+    """ A `Storage` connection counting its calls, i.e. the DB round trips of the crawler. """
+
+    def __init__(self, api, count):
+        self.api = api
+        self.count = count
+
+    def __getattr__(self, name):
+        value = getattr(self.api, name)
+        if not callable(value):
+            return value
+
+        def call(*args, **kwargs):
+            self.count("db_calls", method=name)
+            return value(*args, **kwargs)
+        return call
+
+
+def bench_replay(args):
+    """ Replay the `db` dump through the threaded `Worker` pipeline (SQLite, no Chrome): pages/sec,
+        DB round trips per page, stage latencies and peak RSS.
+    """
+    import json
+    import shutil
+    import resource
+    import tempfile
+    import functools
+    import contextlib
+    import multiprocessing
+    from crawler.blobs import BlobStore
+    from crawler.client import http_client
+    from crawler.hashing import DuplicateIndex
+    from crawler.metrics import metrics
+    from crawler.politeness import PolitenessScheduler
+    from crawler.seen import SeenUrls
+    from crawler.storage import configure, connect
+    from crawler.web_crawler import Worker, prepare_frontier
+
+    directory = tempfile.mkdtemp(prefix="replay-")
+    # a separate process, so that the crawler's CPU time and RSS are measured alone
+    pipe, child_pipe = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=_serve_corpus, args=(child_pipe, directory, args.latency, args.binary_size),
+                                     daemon=True)
+    server.start()
+    addresses, served = pipe.recv()
+    print("Serving %d urls of the dump%s" % (served, "" if len(addresses) > 1 else ", https urls will fail (no openssl)"))
+
+    configure("sqlite", os.path.join(directory, "replay.sqlite"), args.html_storage)
+    http_client.configure(pool_maxsize=args.pool_size)
+    # no proxies, every connection goes to the stand-in server
+    http_client.session.trust_env = False
+    http_client.route({443: addresses[-1], None: addresses[0]})
+
+    owner = "replay"
+    seen, dedup = SeenUrls(), DuplicateIndex()
+    blobs = BlobStore(os.path.join(directory, "blobs"))
+    api = _CountingStorage(connect(), metrics.count)
+    scheduler = PolitenessScheduler(Worker.get_domain_from_url,
+                                    refill=functools.partial(api.claim_from_frontier, owner=owner),
+                                    max_delay=args.crawl_delay, timeout=args.idle)
+    finished = []
+
+    class ReplayWorker(Worker):
+        def parse_url(self, url, is_binary):
+            try:
+                super().parse_url(url, is_binary)
+            finally:
+                finished.append(time.perf_counter())
+
+    workers = [ReplayWorker(id, conn=_CountingStorage(connect(), metrics.count), scheduler=scheduler, seen=seen,
+                            write_window=args.write_window, dedup=dedup, blobs=blobs, owner=owner)
+               for id in range(args.workers)]
+    start = time.perf_counter()
+    with open(args.log or os.devnull, "w") as log, contextlib.redirect_stdout(log):
+        # seeded like a new crawl, the dump is reached through links and sitemaps from there;
+        # with the scheduler the seeds don't sleep the crawl delay
+        prepare_frontier(api, ReplayWorker(0, conn=api, scheduler=scheduler, seen=seen, dedup=dedup, blobs=blobs,
+                                           owner=owner))
+        threads = [threading.Thread(target=worker) for worker in workers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    pipe.send(None)
+    server.join()
+
+    pages, elapsed = len(finished), max(finished, default=start) - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    histograms, counters, _ = metrics.snapshot()
+    calls = {dict(labels)["method"]: value for (name, labels), value in counters.items() if name == "db_calls"}
+    types = {dict(labels)["page_type_code"]: value for (name, labels), value in counters.items() if name == "pages"}
+    # errors by stage: fetch (HTTP and connection errors), parse, db_write (storage), crawl (anything else)
+    errors = {}
+    for (name, labels), value in counters.items():
+        if name == "errors":
+            labels = dict(labels)
+            by_type = errors.setdefault(labels["stage"], {})
+            by_type[labels["error"]] = by_type.get(labels["error"], 0) + value
+    stages = {stage: {"count": count, "p50": p50, "p99": p99}
+              for (stage, labels), (_, _, _, count, p50, p99) in sorted(histograms.items()) if not labels}
+
+    _report("replay (%d workers)" % args.workers, pages, elapsed)
+    print("%-28s %8.1f DB round trips per page, most by %s" %
+          ("", sum(calls.values()) / max(pages, 1),
+           ", ".join("%s %d" % item for item in sorted(calls.items(), key=lambda item: -item[1])[:3])))
+    print("%-28s %8.1f MB peak RSS" % ("", peak_rss))
+    print("%-28s %s" % ("", ", ".join("%s %d" % item for item in sorted(types.items()))))
+    for stage, by_type in sorted(errors.items()):
+        print("%-28s %d %s errors: %s" % ("", sum(by_type.values()), stage,
+                                          ", ".join("%s %d" % item for item in sorted(by_type.items(), key=lambda item: -item[1]))))
+    http_client.report()
+    print("%-12s %8s %10s %10s" % ("stage", "count", "p50 <=", "p99 <="))
+    for stage, values in stages.items():
+        print("%-12s %8d %8.0fms %8.0fms" % (stage, values["count"], 1000 * values["p50"], 1000 * values["p99"]))
+
+    if args.output:
+        with open(args.output, "a") as fp:
+            fp.write(json.dumps({
+                "time": time.time(), "workers": args.workers, "pages": pages, "seconds": elapsed,
+                "pages_per_sec": pages / elapsed if elapsed else 0.0,
+                "db_calls_per_page": sum(calls.values()) / max(pages, 1), "peak_rss_mb": peak_rss,
+                "page_types": types, "errors": errors, "stages": stages,
+            }, sort_keys=True) + "\n")
+    if args.keep:
+        print("Kept the database and blobs in %s" % directory)
+    else:
+        shutil.rmtree(directory, ignore_errors=True)
+    if "db_write" in errors:
+        # the numbers above are not comparable: pages and their rows were lost by the backend
+        print("FAILED: %d storage errors, see --log" % sum(errors["db_write"].values()), file=sys.stderr)
+        return 1
+
+
+# name -> (latency, extra latency per request in flight, error rate, error status, requests/sec before a 429)
+HOST_PROFILES = {
+    "fast": (0.005, 0.0, 0.0, None, None),
+    "slow": (0.2, 0.2, 0.0, None, None),
+    "flaky": (0.02, 0.0, 0.2, 503, None),
+    "throttling": (0.01, 0.0, 0.0, None, 5.0),
+    "down": (0.01, 0.0, 1.0, 500, None),
+}
+
+
+class ProfileHandler(StandInHandler):
+    """ Serves synthetic pages with the latency and errors of its server's `profile`. """
+
+    def do_GET(self):
+        server = self.server
+        latency, per_request, error_rate, error_status, rate_limit = server.profile
+        now = time.monotonic()
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            server.recent = [t for t in server.recent if t > now - 1.0] + [now]
+            in_flight, recent = server.in_flight, len(server.recent)
+        try:
+            # an overloaded host answers slower with every request it serves at once
+            time.sleep(latency + per_request * (in_flight - 1))
+            if rate_limit and recent > rate_limit:
+                self._error(429, "1")
+            elif error_rate and server.random.random() < error_rate:
+                self._error(error_status, "1" if error_status == 503 else None)
+            else:
+                body = synthetic_page(int(self.path.rsplit("/", 1)[-1] or 0), links=0)
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def _error(self, status, retry_after=None):
+        with self.server.lock:
+            self.server.errors += 1
+        self.send_response(status)
+        if retry_after:
+            self.send_header("Retry-After", retry_after)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+def _profile_server(profile, seed):
+    server = StandInServer(handler=ProfileHandler)
+    httpd = server.httpd
+    httpd.profile = HOST_PROFILES[profile]
+    httpd.lock = threading.Lock()
+    httpd.random = random.Random(seed)
+    httpd.requests = httpd.errors = httpd.in_flight = httpd.max_in_flight = 0
+    httpd.recent = []
+    return server
+
+
+def bench_hosts(args):
+    """ Fixed crawl delay vs. the adaptive per-host controller against local hosts with latency and error profiles. """
+    from crawler.adaptive import AdaptiveController, RetryPolicy, HostDown
+    from crawler.client import http_client
+    from crawler.politeness import PolitenessScheduler
+    from crawler.web_crawler import Worker
+
+    http_client.configure(pool_maxsize=args.workers)
+    http_client.session.trust_env = False
+
+    def run(controller):
+        servers = {profile: _profile_server(profile, n) for n, profile in enumerate(args.profiles)}
+        for server in servers.values():
+            server.__enter__()
+        scheduler = PolitenessScheduler(Worker.get_domain_from_url, default_delay=args.delay, timeout=0.5,
+                                        controller=controller)
+        profile_of = {}
+        for profile, server in servers.items():
+            profile_of[Worker.get_domain_from_url(server.base_url)] = profile
+            for n in range(args.pages):
+                scheduler.put((len(profile_of) * args.pages + n, "%s/page/%d" % (server.base_url, n), False, 0))
+        done = {profile: {"ok": 0, "failed": 0, "finished": 0.0} for profile in servers}
+        lock = threading.Lock()
+        remaining = [len(servers) * args.pages]
+
+        def work():
+            while remaining[0] > 0:
+                row = scheduler.get()
+                if row is None:
+                    continue
+                profile = profile_of[Worker.get_domain_from_url(row[1])]
+                started = time.monotonic()
+                try:
+                    if scheduler.is_down(row[1]):
+                        delay = scheduler.defer(row)
+                        if delay is None:
+                            raise HostDown(row[1])
+                        # the crawler returns it to the frontier, claimed again after `delay`
+                        threading.Timer(delay, scheduler.put, (row, )).start()
+                        continue
+                    response = http_client.get(row[1], timeout=args.timeout)
+                    response.raise_for_status()
+                    scheduler.record(row, time.monotonic() - started)
+                    outcome = "ok"
+                except HostDown:
+                    outcome = "failed"
+                except Exception as e:
+                    outcome = None if scheduler.record(row, time.monotonic() - started, e) else "failed"
+                finally:
+                    scheduler.release(row)
+                if outcome is not None:
+                    with lock:
+                        done[profile][outcome] += 1
+                        done[profile]["finished"] = time.perf_counter() - start
+                        remaining[0] -= 1
+
+        start = time.perf_counter()
+        threads = [threading.Thread(target=work) for _ in range(args.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        for profile, server in servers.items():
+            httpd = server.httpd
+            result = done[profile]
+            print("  %-12s %5d ok %5d failed in %6.1fs  %6.1f pages/sec  %5d requests, %4d errors, "
+                  "max %d in flight" % (profile, result["ok"], result["failed"], result["finished"],
+                                        result["ok"] / max(result["finished"], 1e-9), httpd.requests, httpd.errors,
+                                        httpd.max_in_flight))
+            server.__exit__()
+        ok = sum(result["ok"] for result in done.values())
+        print("  %-12s %5d ok in %6.1fs  %6.1f pages/sec" % ("all", ok, elapsed, ok / elapsed))
+
+    print("fixed %.2fs delay, no retries:" % args.delay)
+    run(None)
+    print("adaptive (min delay %.2fs, up to %d in flight, %d retries):" %
+          (args.min_delay, args.max_concurrency, args.retries))
+    run(AdaptiveController(default_delay=args.delay, min_delay=args.min_delay, max_concurrency=args.max_concurrency,
+                           park_after=args.park_after, park_time=args.park_time, max_park=args.max_park,
+                           retry=RetryPolicy(args.retries, base=0.5)))
+
+
+def bench_bodies(args):
+    """ Storage ratio, WAL volume, write throughput and read latency of the HTML storage modes on the `db` dump. """
+    import tempfile
+    from crawler.bodies import BodyCodec, Dictionaries, CODECS, zstandard
+    from crawler.corpus import read_table
+    from crawler.sqlite_storage import SqliteApi
+
+    pages = [(int(row["site_id"]), row["url"], row["html_content"]) for row in read_table("page")
+             if row["html_content"]]
+    raw = sum(len(document.encode("utf-8")) for _, _, document in pages)
+    print("%d pages, %d unique bodies, %.1f MB of HTML" %
+          (len(pages), len({document for _, _, document in pages}), raw / 2 ** 20))
+
+    # (name, html_storage, inline zlib level, codec, pages of a site sampled for its dictionary)
+    modes = [("inline, uncompressed", "inline", 0, None, None), ("inline, zlib", "inline", 6, None, None)]
+    for codec in CODECS:
+        if codec == "zstd" and zstandard is None:
+            print("zstandard is not installed, skipping zstd")
+            continue
+        # without a dictionary: sites never complete their samples
+        modes += [("dedup, %s" % codec, "dedup", 0, codec, len(pages) + 1),
+                  ("dedup, %s + dictionary" % codec, "dedup", 0, codec, args.samples)]
+
+    print("%-26s %7s %9s %9s %10s %9s %9s" % ("", "ratio", "stored", "WAL", "write", "read p50", "read p99"))
+    for name, html_storage, level, codec, samples in modes:
+        path = os.path.join(tempfile.mkdtemp(), "bodies.sqlite")
+        api = SqliteApi(path, compress_level=level, html_storage=html_storage)
+        if codec:
+            api._bodies = BodyCodec(api, codec, Dictionaries(samples))
+        # keep every WAL frame, its size is the write volume
+        api.connection.execute("PRAGMA wal_autocheckpoint = 0")
+
+        start = time.perf_counter()
+        ids = [api.insert_page(site_id, "HTML", url, document, 200, None) for site_id, url, document in pages]
+        elapsed = time.perf_counter() - start
+        wal = os.path.getsize(path + "-wal")
+        stored = api._one("SELECT coalesce(sum(length(html_content)), 0) FROM page") + \
+            api._one("SELECT coalesce(sum(length(data)), 0) FROM content") + \
+            api._one("SELECT coalesce(sum(length(data)), 0) FROM content_dictionary")
+        api.close()
+
+        # a new connection, dictionaries are loaded from the database on first use
+        api = SqliteApi(path, html_storage=html_storage)
+        if codec:
+            api._bodies = BodyCodec(api, codec, Dictionaries())
+        timings = []
+        order = ids * args.repeat
+        random.Random(0).shuffle(order)
+        for page_id in order:
+            start = time.perf_counter()
+            api.page_html(page_id)
+            timings.append(time.perf_counter() - start)
+        api.close()
+        timings.sort()
+        print("%-26s %6.1fx %7.1fMB %7.1fMB %7.1fMB/s %7.2fms %7.2fms" %
+              (name, raw / stored, stored / 2 ** 20, wal / 2 ** 20, raw / 2 ** 20 / elapsed,
+               1000 * timings[len(timings) // 2], 1000 * timings[int(len(timings) * 0.99)]))
+
+
+_FILL_QUERIES = (
+    """
+    INSERT INTO crawldb.site (domain, robots_content, sitemap_content)
+    SELECT 'site' || s || '.gov.si', 'User-agent: *', 'https://site' || s || '.gov.si/sitemap.xml'
+    FROM generate_series(1, %(sites)s) AS s
+    """,
+    # 75% stored HTML, 15% frontier, the rest binary, duplicate and claimed pages
+    """
+    INSERT INTO crawldb.page (site_id, page_type_code, url, http_status_code, accessed_time, is_binary, hash,
+                              simhash, depth, priority)
+    SELECT 1 + i %% %(sites)s,
+           CASE WHEN i %% 100 < 75 THEN 'HTML' WHEN i %% 100 < 90 THEN 'FRONTIER' WHEN i %% 100 < 95 THEN 'BINARY'
+                WHEN i %% 100 < 98 THEN 'DUPLICATE' ELSE 'IN PROGRESS' END,
+           'https://site' || (1 + i %% %(sites)s) || '.gov.si/page/' || i,
+           200, now() - (i %% 100000) * interval '1 minute', false,
+           CASE WHEN i %% 100 < 75 THEN hashtextextended(i::text, 0) END,
+           CASE WHEN i %% 100 < 75 THEN hashtextextended(i::text, 1) END,
+           i %% 10, random()
+    FROM generate_series(1, %(pages)s) AS i
+    """,
+    """
+    INSERT INTO crawldb.page_revisit (page_id, etag, visits, changes, observed_days, change_rate, next_visit)
+    SELECT id, '"' || id || '"', 2, 1, 7, 0.1, now() + (id %% 30 - 15) * interval '1 day'
+    FROM crawldb.page WHERE page_type_code = 'HTML'
+    """,
+    "ANALYZE",
+)
+
+
+def bench_queries(args):
+    """ Latency of the `DBApi` queries on a synthetic `page` table (needs Postgres, uses a scratch database). """
+    import datetime
+    import statistics
+    import psycopg2
+    from crawler.utils import DBConn, DBApi, WriteBatch, db_auth
+    from crawler.migrations import migrate, partition_pages, LATEST
+
+    admin = psycopg2.connect(**db_auth)
+    admin.autocommit = True
+    with admin.cursor() as cursor:
+        cursor.execute("DROP DATABASE IF EXISTS %s" % args.database)
+        cursor.execute("CREATE DATABASE %s" % args.database)
+
+    conn = DBConn(dict(db_auth, database=args.database))
+    try:
+        migrate(conn, args.version or LATEST)
+        if args.partitions:
+            partition_pages(conn, args.partitions)
+        start = time.perf_counter()
+        for sql in _FILL_QUERIES:
+            conn.cursor.execute(sql, {"pages": args.pages, "sites": args.sites})
+            conn.commit()
+        print("Filled %d pages of %d sites in %.1fs" % (args.pages, args.sites, time.perf_counter() - start))
+
+        api = DBApi(conn)
+        rnd = random.Random(0)
+        now = datetime.datetime.now()
+        max_id = api.max_page_id()
+
+        def url(i):
+            return "https://site%d.gov.si/page/%d" % (1 + i % args.sites, i)
+
+        def domain():
+            return "site%d.gov.si" % rnd.randint(1, args.sites)
+
+        def page():
+            return rnd.randint(1, args.pages)
+
+        # stored HTML pages (i % 100 < 75) have known hashes
+        conn.cursor.execute("SELECT hash FROM crawldb.page WHERE id = ANY(%s) AND hash IS NOT NULL",
+                            ([page() for _ in range(1000)], ))
+        hashes = [row[0] for row in conn.cursor.fetchall()]
+        new_urls = ("https://site1.gov.si/new/%d" % n for n in itertools.count())
+
+        def flush_batch():
+            batch = WriteBatch()
+            source = page()
+            for _ in range(50):
+                target = next(new_urls) if rnd.random() < 0.5 else url(page())
+                batch.add_frontier(target, 1, source_id=source)
+                batch.add_link(source, target)
+            batch.flush(api)
+
+        def update_page():
+            api.update_page(page(), "HTML", "<html></html>", 200, now)
+            conn.commit()
+
+        queries = (
+            ("page_for_url", lambda: api.page_for_url(url(page()))),
+            ("existing_urls (100)", lambda: api.existing_urls([url(page()) for _ in range(50)] +
+                                                              [next(new_urls) for _ in range(50)])),
+            ("page_for_hash", lambda: api.page_for_hash(rnd.choice(hashes))),
+            ("revisit_for_url", lambda: api.revisit_for_url(url(page()))),
+            ("site_for_domain", lambda: api.site_for_domain(domain())),
+            ("site_id_for_domain", lambda: api.site_id_for_domain(domain())),
+            ("select_robots_by_domain", lambda: api.select_robots_by_domain(domain())),
+            ("insert_site (existing)", lambda: api.insert_site(domain(), "", "")),
+            ("insert_page (new)", lambda: api.insert_page(1, "HTML", next(new_urls), "", 200, now)),
+            ("insert_page (existing)", lambda: api.insert_page(1, "HTML", url(page()), "", 200, now)),
+            ("update_page", update_page),
+            ("set_page_type (20)", lambda: api.set_page_type([page() for _ in range(20)], "HTML")),
+            ("select_from_frontier", api.select_from_frontier),
+            ("frontier_size", api.frontier_size),
+            ("claim_from_frontier (100)", lambda: api.claim_from_frontier(100, owner="bench")),
+            ("claim_from_frontier shard", lambda: api.claim_from_frontier(100, shard=(0, 8), owner="bench")),
+            ("renew_leases", lambda: api.renew_leases("bench")),
+            ("release_leases", lambda: api.release_leases("other")),
+            ("select_page_html", lambda: api.select_page_html(None)),
+            ("select_fingerprints (since)", lambda: api.select_fingerprints(max_id - 1000, now)),
+            ("iter_urls (since)", lambda: list(api.iter_urls(since_id=max_id - 10000))),
+            ("max_page_id", api.max_page_id),
+            ("requeue_due", lambda: api.requeue_due(now - datetime.timedelta(days=14))),
+            ("revisit_modified (100)", lambda: api.revisit_modified([(url(page()), now) for _ in range(100)])),
+            ("select_sitemaps", api.select_sitemaps),
+            ("WriteBatch.flush (50)", flush_batch),
+        )
+
+        print("%-28s %9s %9s %9s" % ("query", "p50 ms", "p99 ms", "mean ms"))
+        for name, query in queries:
+            timings = []
+            try:
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    query()
+                    timings.append(1000 * (time.perf_counter() - start))
+            except Exception as e:
+                # e.g. a column or constraint added by a later migration than `--version`
+                conn.connection.rollback()
+                print("%-28s failed: %s" % (name, str(e).splitlines()[0]))
+                continue
+            timings.sort()
+            print("%-28s %9.2f %9.2f %9.2f" % (name, timings[len(timings) // 2],
+                                                timings[int(0.99 * (len(timings) - 1))], statistics.mean(timings)))
+    finally:
+        conn.release()
+        if not args.keep:
+            with admin.cursor() as cursor:
+                cursor.execute("DROP DATABASE %s" % args.database)
+        admin.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Crawler benchmarks.")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    fetch = commands.add_parser("fetch", help=bench_fetch.__doc__)
+    fetch.add_argument("--pages", type=int, default=2000)
+    fetch.add_argument("--threads", type=int, default=4)
+    fetch.add_argument("--concurrency", type=int, default=500)
+    fetch.add_argument("--latency", type=float, default=0.05, help="seconds of simulated server latency")
+    fetch.set_defaults(run=bench_fetch)
+
+    client = commands.add_parser("client", help=bench_client.__doc__)
+    client.add_argument("--pages", type=int, default=1000)
+    client.add_argument("--threads", type=int, default=4)
+    client.add_argument("--latency", type=float, default=0.005, help="seconds of simulated server latency")
+    client.add_argument("--connect-latency", type=float, default=0.03,
+                        help="seconds of simulated connection setup")
+    client.set_defaults(run=bench_client)
+
+    recrawl = commands.add_parser("recrawl", help=bench_recrawl.__doc__)
+    recrawl.add_argument("--pages", type=int, default=1000)
+    recrawl.add_argument("--changed", type=float, default=0.1, help="fraction of pages changed between crawls")
+    recrawl.add_argument("--latency", type=float, default=0.0, help="seconds of simulated server latency")
+    recrawl.set_defaults(run=bench_recrawl)
+
+    sitemap = commands.add_parser("sitemap", help=bench_sitemap.__doc__)
+    sitemap.add_argument("--sitemaps", type=int, default=4)
+    sitemap.add_argument("--urls", type=int, default=50000, help="urls per sitemap")
+    sitemap.add_argument("--latency", type=float, default=0.0, help="seconds of simulated server latency")
+    sitemap.set_defaults(run=bench_sitemap)
+
+    writes = commands.add_parser("writes", help=bench_writes.__doc__)
+    writes.add_argument("--pages", type=int, default=50)
+    writes.add_argument("--links", type=int, default=200, help="new links per page")
+    writes.set_defaults(run=bench_writes)
+
+    storage = commands.add_parser("storage", help=bench_storage.__doc__)
+    storage.add_argument("--pages", type=int, default=5000)
+    storage.add_argument("--links", type=int, default=20, help="links per page")
+    storage.add_argument("--threads", type=int, default=4)
+    storage.add_argument("--backends", nargs="+", default=["sqlite"], choices=["postgres", "sqlite"],
+                         help="postgres needs the crawldb Postgres")
+    storage.set_defaults(run=bench_storage)
+
+    shards = commands.add_parser("shards", help=bench_shards.__doc__)
+    shards.add_argument("--pages", type=int, default=400)
+    shards.add_argument("--links", type=int, default=100, help="links per page")
+    shards.add_argument("--scale", type=int, nargs="+", default=[1, 2, 4], help="thread/process counts")
+    shards.set_defaults(run=bench_shards)
+
+    links = commands.add_parser("links", help=bench_links.__doc__)
+    links.add_argument("--pages", type=int, default=None, help="limit the number of pages")
+    links.add_argument("--repeat", type=int, default=3)
+    links.set_defaults(run=bench_links)
+
+    urls = commands.add_parser("urls", help=bench_urls.__doc__)
+    urls.add_argument("--repeat", type=int, default=3)
+    urls.add_argument("--batch", type=int, default=100, help="urls per `UrlEngine.filter` call, like the links of a page")
+    urls.add_argument("--cache-size", type=int, default=100000)
+    urls.set_defaults(run=bench_urls)
+
+    frontier = commands.add_parser("frontier", help=bench_frontier.__doc__)
+    frontier.set_defaults(run=bench_frontier)
+
+    replay = commands.add_parser("replay", help=bench_replay.__doc__)
+    replay.add_argument("--workers", type=int, default=8)
+    replay.add_argument("--write-window", type=float, default=0.0,
+                        help="seconds to collect discovered rows before writing them")
+    replay.add_argument("--pool-size", type=int, default=8, help="keep-alive connections per host")
+    replay.add_argument("--crawl-delay", type=float, default=0.0, help="upper bound for the per-host crawl delay")
+    replay.add_argument("--latency", type=float, default=0.0, help="seconds of simulated server latency")
+    replay.add_argument("--binary-size", type=int, default=50000, help="bytes served for every file and image")
+    replay.add_argument("--idle", type=float, default=1.0,
+                        help="seconds a worker waits for frontier rows before giving up")
+    replay.add_argument("--html-storage", choices=["inline", "dedup"], default="inline")
+    replay.add_argument("--log", help="file for the crawler output, discarded by default")
+    replay.add_argument("--output", help="append the results as a JSON line to this file")
+    replay.add_argument("--keep", action="store_true", help="keep the SQLite database and blobs")
+    replay.set_defaults(run=bench_replay)
+
+    hosts = commands.add_parser("hosts", help=bench_hosts.__doc__)
+    hosts.add_argument("--profiles", nargs="+", default=list(HOST_PROFILES), choices=list(HOST_PROFILES))
+    hosts.add_argument("--pages", type=int, default=100, help="pages per host")
+    hosts.add_argument("--workers", type=int, default=16)
+    hosts.add_argument("--delay", type=float, default=0.25, help="crawl delay, the starting delay of the controller")
+    hosts.add_argument("--min-delay", type=float, default=0.01)
+    hosts.add_argument("--max-concurrency", type=int, default=4)
+    hosts.add_argument("--retries", type=int, default=3)
+    hosts.add_argument("--park-after", type=int, default=3, help="failures in a row that park a host")
+    hosts.add_argument("--park-time", type=float, default=5.0, help="seconds a failing host is first parked")
+    hosts.add_argument("--max-park", type=float, default=30.0,
+                       help="seconds the urls of a host that is down fail without a request")
+    hosts.add_argument("--timeout", type=float, default=5.0)
+    hosts.set_defaults(run=bench_hosts)
+
+    bodies = commands.add_parser("bodies", help=bench_bodies.__doc__)
+    bodies.add_argument("--samples", type=int, default=32, help="pages of a site a dictionary is trained on")
+    bodies.add_argument("--repeat", type=int, default=3, help="reads of every page")
+    bodies.set_defaults(run=bench_bodies)
+
+    queries = commands.add_parser("queries", help=bench_queries.__doc__)
+    queries.add_argument("--pages", type=int, default=5000000)
+    queries.add_argument("--sites", type=int, default=2000)
+    queries.add_argument("--repeat", type=int, default=200, help="runs of every query")
+    queries.add_argument("--version", type=int, default=None,
+                         help="schema version to benchmark, e.g. 8 for the schema before the lookup indexes")
+    queries.add_argument("--partitions", type=int, help="hash-partition crawldb.page")
+    queries.add_argument("--database", default="crawldb_bench", help="scratch database, dropped afterwards")
+    queries.add_argument("--keep", action="store_true", help="keep the scratch database")
+    queries.set_defaults(run=bench_queries)
+
+    args = parser.parse_args(argv)
+    return args.run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,64 @@
+""" Content-addressed on-disk storage for downloaded files and images
+
+Bodies are streamed chunk by chunk into a temporary file while their SHA-256
+is computed, then moved to `<root>/<ab>/<cd>/<sha256>`. Identical files are
+stored once, and a worker never holds more than one chunk in memory.
+"""
+
+import os
+import hashlib
+import tempfile
+
+
+CHUNK_SIZE = 64 * 1024
+DEFAULT_MAX_SIZE = 50 * 2 ** 20
+
+
+class TooLarge(Exception):
+    pass
+
+
+class BlobStore:
+    def __init__(self, root="blobs", max_size=DEFAULT_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(os.path.join(root, "tmp"), exist_ok=True)
+
+    def path(self, key: str):
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def open(self, key: str):
+        return open(self.path(key), "rb")
+
+    def save(self, chunks):
+        """ Store the byte chunks and return `(key, size)`.
+
+            Raises `TooLarge` as soon as more than `max_size` bytes arrive.
+        """
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.join(self.root, "tmp"))
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    size += len(chunk)
+                    if self.max_size and size > self.max_size:
+                        raise TooLarge("more than %d bytes" % self.max_size)
+                    digest.update(chunk)
+                    fp.write(chunk)
+
+            key = digest.hexdigest()
+            path = self.path(key)
+            if os.path.exists(path):
+                # same content was stored before
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(tmp_path, path)
+            return key, size
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
@@ -0,0 +1,190 @@
+""" Compressed, deduplicated HTML bodies
+
+With `--html-storage dedup` page HTML is not written to `page.html_content`
+but once per unique body to the `content` table, keyed by its `hash_document`
+hash (referenced by `page.content_hash`). Bodies are compressed with zstd if
+`zstandard` is installed, with zlib otherwise, using a dictionary trained on
+the first pages of their site: the pages of a gov.si site share most of their
+markup, which the dictionary then provides instead of every body repeating
+it. Bodies are only decompressed when read, see `Storage.page_html`.
+
+    bodies = BodyCodec(api)
+    row = bodies.encode(site_id, document)  # (hash, codec, dictionary_id, size, data)
+    document = bodies.decode(*row[1:3], row[4])
+"""
+
+import zlib
+import threading
+
+from collections import Counter, OrderedDict
+
+from crawler.hashing import hash_document
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+HTML_STORAGE = ("inline", "dedup")
+CODECS = ("zstd", "zlib")
+DEFAULT_CODEC = "zstd" if zstandard is not None else "zlib"
+LEVELS = {"zstd": 3, "zlib": 6}
+
+DICTIONARY_SAMPLES = 32       # pages of a site a dictionary is trained on
+DICTIONARY_SIZE = 64 * 1024
+ZLIB_WINDOW = 32 * 1024       # zlib only uses the last 32 KB of a dictionary
+
+
+def _boilerplate(samples, size):
+    """ Lines found in at least half of `samples`, the most common ones last
+        (zlib finds matches closest to the data cheapest).
+    """
+    counts = Counter()
+    for sample in samples:
+        for line in dict.fromkeys(sample.splitlines(keepends=True)):
+            counts[line] += 1
+    common = [line for line, count in counts.items() if 2 * count >= len(samples)]
+    common.sort(key=counts.get)
+    return b"".join(common)[-size:]
+
+
+def train_dictionary(codec, samples, size=DICTIONARY_SIZE):
+    """ Dictionary for bodies like the byte strings `samples`, `None` if none can be trained. """
+    if codec == "zstd":
+        try:
+            return zstandard.train_dictionary(size, samples).as_bytes()
+        except zstandard.ZstdError:
+            return None  # e.g. too few or too small samples
+    return _boilerplate(samples, min(size, ZLIB_WINDOW)) or None
+
+
+class Dictionaries:
+    """ Process-wide dictionaries by id and the dictionary of every site seen so far. """
+
+    def __init__(self, samples=DICTIONARY_SAMPLES, max_sampled=1000):
+        self.samples = samples
+        self.max_sampled = max_sampled
+        self.lock = threading.Lock()
+        self.by_id = {}              # dictionary id -> (codec, data)
+        self.by_site = {}            # (site id, codec) -> dictionary id, `None` while sampling
+        self.sampled = OrderedDict()  # (site id, codec) -> bodies of sites still sampling, oldest first
+
+    def get(self, dictionary_id):
+        with self.lock:
+            return self.by_id.get(dictionary_id)
+
+    def add(self, dictionary_id, codec, data, site_id=None):
+        with self.lock:
+            self.by_id[dictionary_id] = (codec, data)
+            if site_id is not None:
+                self.by_site[(site_id, codec)] = dictionary_id
+                self.sampled.pop((site_id, codec), None)
+
+
+dictionaries = Dictionaries()
+
+
+class BodyCodec:
+    """ Compresses and decompresses bodies for one `Storage` connection, whose
+        `site_dictionary`, `insert_dictionary` and `select_dictionary` store
+        the dictionaries.
+    """
+
+    def __init__(self, api, codec=DEFAULT_CODEC, shared: Dictionaries = None):
+        if codec == "zstd" and zstandard is None:
+            raise ValueError("the zstd codec needs the zstandard package")
+        self.api = api
+        self.codec = codec
+        self.shared = shared or dictionaries
+        # zstd (de)compressors digest their dictionary once, but can't be shared between threads
+        self.compressors = {}
+        self.decompressors = {}
+
+    def encode(self, site_id, document: str):
+        """ `(hash, codec, dictionary_id, size, data)` row of `document` for the `content` table. """
+        data = document.encode("utf-8")
+        dictionary_id = self.dictionary_for(site_id, data)
+        return hash_document(document), self.codec, dictionary_id, len(data), self.compress(data, dictionary_id)
+
+    def decode(self, codec, dictionary_id, data) -> str:
+        dictionary = self.dictionary(dictionary_id) if dictionary_id is not None else None
+        if codec == "zstd":
+            if zstandard is None:
+                raise RuntimeError("the zstandard package is needed to read zstd compressed bodies")
+            decompressor = self.decompressors.get(dictionary_id)
+            if decompressor is None:
+                dict_data = zstandard.ZstdCompressionDict(dictionary[1]) if dictionary else None
+                decompressor = self.decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dict_data)
+            return decompressor.decompress(bytes(data)).decode("utf-8")
+        decompressor = zlib.decompressobj(zdict=dictionary[1]) if dictionary else zlib.decompressobj()
+        return (decompressor.decompress(data) + decompressor.flush()).decode("utf-8")
+
+    def compress(self, data: bytes, dictionary_id=None):
+        dictionary = self.dictionary(dictionary_id) if dictionary_id is not None else None
+        if self.codec == "zstd":
+            compressor = self.compressors.get(dictionary_id)
+            if compressor is None:
+                dict_data = zstandard.ZstdCompressionDict(dictionary[1]) if dictionary else None
+                compressor = self.compressors[dictionary_id] = zstandard.ZstdCompressor(level=LEVELS["zstd"],
+                                                                                       dict_data=dict_data)
+            return compressor.compress(data)
+        compressor = zlib.compressobj(LEVELS["zlib"], zdict=dictionary[1]) if dictionary \
+            else zlib.compressobj(LEVELS["zlib"])
+        return compressor.compress(data) + compressor.flush()
+
+    def dictionary(self, dictionary_id):
+        """ `(codec, data)` of a stored dictionary. """
+        dictionary = self.shared.get(dictionary_id)
+        if dictionary is None:
+            dictionary = self.api.select_dictionary(dictionary_id)
+            if dictionary is None:
+                raise KeyError("content dictionary %d is missing" % dictionary_id)
+            codec, data = dictionary
+            dictionary = (codec, bytes(data))
+            self.shared.add(dictionary_id, *dictionary)
+        return dictionary
+
+    def dictionary_for(self, site_id, data: bytes):
+        """ Id of the dictionary to compress a body of `site_id` with. Until
+            enough bodies of the site were seen there is none; the body that
+            completes the samples trains and stores it.
+        """
+        if site_id is None:
+            return None
+        shared, key = self.shared, (site_id, self.codec)
+        with shared.lock:
+            known = key in shared.by_site
+            dictionary_id = shared.by_site.get(key)
+            if not known:
+                shared.by_site[key] = None
+        if dictionary_id is not None:
+            return dictionary_id
+        if not known:
+            # first body of the site in this process, it may have a dictionary from an earlier crawl
+            dictionary_id = self.api.site_dictionary(site_id, self.codec)
+            if dictionary_id is not None:
+                self.dictionary(dictionary_id)
+                with shared.lock:
+                    shared.by_site[key] = dictionary_id
+                return dictionary_id
+
+        with shared.lock:
+            if shared.by_site.get(key) is not None:
+                return shared.by_site[key]
+            samples = shared.sampled.setdefault(key, [])
+            shared.sampled.move_to_end(key)
+            samples.append(data)
+            if len(samples) < shared.samples:
+                while len(shared.sampled) > shared.max_sampled:
+                    # bound the memory of sampling many small sites, they start over
+                    shared.sampled.popitem(last=False)
+                return None
+            del shared.sampled[key]
+
+        dictionary = train_dictionary(self.codec, samples)
+        if dictionary is None:
+            return None
+        dictionary_id = self.api.insert_dictionary(site_id, self.codec, dictionary)
+        shared.add(dictionary_id, self.codec, dictionary, site_id)
+        return dictionary_id
@@ -0,0 +1,171 @@
+""" Crash-safe crawl state
+
+Frontier rows are leased: a claim moves them to `IN PROGRESS` together with
+the name of the claiming crawl run (`leased_by`) and an expiry time. A running
+crawl renews its leases periodically; rows of a crawl that died are claimed
+again by anyone once their lease expired, no startup reset is needed.
+
+Every process is a new run (host, pid and a random part), so crawls on the
+same machine never renew or release each other's leases. The run id is saved
+next to the checkpoint (`<path>.run`); a crawl restarted from the checkpoint
+continues that run and takes its leases back at once.
+
+`Checkpoint` periodically writes the in-memory state that is expensive to
+rebuild to a local file: the seen-url filter, the duplicate index, per-host
+crawl delays and throttle timers and the ids of the rows buffered by the
+scheduler (the frontier cursor). On restart the state is loaded, only pages
+stored after the checkpoint are read from the DB and the buffered rows are
+leased again, so resuming a large crawl does not scan `crawldb.page`.
+
+    checkpoint = Checkpoint("crawl.checkpoint")
+    owner = checkpoint.owner  # to claim frontier rows with
+    checkpoint.resume(api, seen, dedup, scheduler)
+    checkpoint.start(seen, dedup, scheduler)
+"""
+
+import os
+import time
+import pickle
+import uuid
+import socket
+import datetime
+import threading
+
+from crawler.storage import Storage, DEFAULT_LEASE, connect
+
+
+VERSION = 1
+DEFAULT_INTERVAL = 60
+
+# this process, unless it resumes the run of a checkpoint
+RUN = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+def lease_owner(shard=None, run=RUN):
+    """ Name leases are held under: the crawl run and the shard index. """
+    owner = run
+    if shard is not None:
+        owner += "/%d" % shard[0]
+    return owner
+
+
+class Checkpoint:
+    def __init__(self, path, shard=None, lease=DEFAULT_LEASE, interval=DEFAULT_INTERVAL):
+        self.path = path
+        self.run = self._run()
+        self.owner = lease_owner(shard, self.run)
+        self.lease = lease
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    def _run(self):
+        """ Run id saved with the checkpoint, otherwise `RUN`, saved at once so
+            that a crash before the first checkpoint can still be resumed.
+        """
+        if not self.path:
+            return RUN
+        try:
+            with open(self.path + ".run") as fp:
+                run = fp.read().strip()
+        except FileNotFoundError:
+            run = None
+        if not run:
+            run = RUN
+            with open(self.path + ".run", "w") as fp:
+                fp.write(run + "\n")
+        return run
+
+    def save(self, conn: Storage, seen=None, dedup=None, scheduler=None):
+        """ Write the state atomically (a crash leaves the previous checkpoint). """
+        if not self.path:
+            return
+        start = time.time()
+        # taken first: every page up to this id is already reflected in the snapshots
+        state = {
+            "version": VERSION,
+            "owner": self.owner,
+            "saved_at": datetime.datetime.now(),
+            "max_page_id": conn.max_page_id(),
+        }
+        state["seen"] = seen.snapshot() if seen is not None else None
+        state["dedup"] = dedup.snapshot() if dedup is not None else None
+        state["scheduler"] = scheduler.snapshot() if scheduler is not None else None
+
+        with self.lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as fp:
+                pickle.dump(state, fp, protocol=pickle.HIGHEST_PROTOCOL)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, self.path)
+        print("Saved checkpoint in %.1fs (%.1f MB)" % (time.time() - start, os.path.getsize(self.path) / 2 ** 20))
+
+    def load(self):
+        """ The saved state, or `None` if there is no usable checkpoint. """
+        if not self.path or not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, "rb") as fp:
+                state = pickle.load(fp)
+        except Exception as e:
+            print("Ignoring unreadable checkpoint %s" % self.path, e)
+            return None
+        if not isinstance(state, dict) or state.get("version") != VERSION:
+            print("Ignoring checkpoint %s of another version" % self.path)
+            return None
+        return state
+
+    def resume(self, conn: Storage, seen=None, dedup=None, scheduler=None):
+        """ Restore the last checkpoint (or warm up from the DB without one) and
+            take back the leases of this owner: rows buffered at the checkpoint are
+            leased again into `scheduler`, all others return to the frontier.
+        """
+        state = self.load() or {}
+        max_page_id = state.get("max_page_id", 0)
+        saved_at = state.get("saved_at")
+
+        if seen is not None:
+            if state.get("seen") is not None and seen.restore(state["seen"]):
+                seen.warm(conn, since_id=max_page_id)
+            else:
+                seen.warm(conn)
+        if dedup is not None:
+            if state.get("dedup") is not None and dedup.restore(state["dedup"]):
+                # pages stored before the checkpoint may have been fetched after it
+                dedup.warm(conn, since_id=max_page_id, since_time=saved_at)
+            else:
+                dedup.warm(conn)
+
+        keep = []
+        if scheduler is not None and state.get("scheduler") is not None and state.get("owner") == self.owner:
+            delays, throttled, ids = state["scheduler"]
+            elapsed = (datetime.datetime.now() - saved_at).total_seconds()
+            throttled = {domain: remaining - elapsed for domain, remaining in throttled.items()
+                         if remaining > elapsed}
+            rows = conn.reclaim_leases(ids, self.owner, self.lease) if ids else []
+            scheduler.restore(delays, throttled, rows)
+            keep = [row[0] for row in rows]
+            print("Resumed %d buffered frontier rows" % len(rows))
+        released = conn.release_leases(self.owner, keep)
+        if released:
+            print("Returned %d interrupted pages to the frontier" % released)
+
+    def start(self, seen=None, dedup=None, scheduler=None):
+        """ Renew the leases of this owner and save checkpoints from a daemon thread. """
+        def run():
+            conn = connect()
+            # leases must be renewed well before they expire
+            step = min(self.interval, self.lease / 3)
+            last_save = time.monotonic()
+            while True:
+                time.sleep(step)
+                try:
+                    conn.renew_leases(self.owner, self.lease)
+                    if self.path and time.monotonic() - last_save >= self.interval:
+                        self.save(conn, seen, dedup, scheduler)
+                        last_save = time.monotonic()
+                except Exception as e:
+                    print("Error while saving checkpoint", e)
+                    conn.rollback()
+
+        threading.Thread(target=run, name="checkpoint", daemon=True).start()
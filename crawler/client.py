@@ -0,0 +1,270 @@
+""" Shared HTTP client
+
+One `requests` session for the whole process, with keep-alive connection
+pools per host (at most `pool_maxsize` connections each) and a TTL cache in
+front of DNS, so fetching many small pages of the same hosts skips the
+lookup and the TCP/TLS handshake. New connections of the session are made
+by `HttpClient.create_connection` (through the connection classes of its
+adapter, urllib3 itself is not patched: Selenium and other urllib3 users
+connect as usual), which also counts them; the ratio of requests to new
+connections is the reuse reported by `stats`. `route` sends every connection
+to fixed local addresses instead, e.g. to a stand-in server replaying a
+recorded crawl (Host headers and TLS are unchanged).
+
+With `http2=True` and `httpx` (with `h2`) installed, requests are sent with
+httpx instead; its own pools are used and new connections are not counted.
+"""
+
+import io
+import time
+import socket
+import threading
+
+from collections import OrderedDict
+
+import requests
+import urllib3.connection
+import urllib3.util.connection
+
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from crawler.metrics import metrics
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+DEFAULT_DNS_TTL = 300
+DEFAULT_POOL_HOSTS = 100
+DEFAULT_POOL_MAXSIZE = 8
+
+
+class DnsCache:
+    """ Addresses of recently resolved hosts, kept for `ttl` seconds. """
+
+    def __init__(self, ttl=DEFAULT_DNS_TTL, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # (host, port) -> (expires, [address, ...])
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def resolve(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        start = time.perf_counter()
+        infos = socket.getaddrinfo(host, port, urllib3.util.connection.allowed_gai_family(), socket.SOCK_STREAM)
+        metrics.observe("dns", time.perf_counter() - start)
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+
+        with self.lock:
+            self.entries[key] = (now + self.ttl, addresses)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return addresses
+
+
+def _is_ip(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except OSError:
+            pass
+    return False
+
+
+class _StreamReader(io.RawIOBase):
+    """ File object over an iterator of byte chunks. """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            self.pending = next(self.chunks, None)
+            if self.pending is None:
+                self.pending = b""
+                return 0
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+class _HttpxResponse:
+    """ The parts of `requests.Response` the crawler uses, over an httpx response. """
+
+    def __init__(self, response):
+        self.response = response
+        self.url = str(response.url)
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self._raw = None
+
+    @property
+    def content(self):
+        return self.response.read()
+
+    @property
+    def text(self):
+        self.response.read()
+        return self.response.text
+
+    @property
+    def raw(self):
+        if self._raw is None:
+            self._raw = _StreamReader(self.response.iter_bytes())
+        return self._raw
+
+    def iter_content(self, chunk_size=1):
+        return self.response.iter_bytes(chunk_size)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError("%d Error for url: %s" % (self.status_code, self.url), response=self)
+
+    def close(self):
+        self.response.close()
+
+
+class _ClientConnection:
+    """ Mixin for urllib3 connections opened by `client.create_connection`. """
+
+    client = None
+
+    def _new_conn(self):
+        address = (getattr(self, "_dns_host", self.host), self.port)
+        try:
+            return self.client.create_connection(address, self.timeout, source_address=self.source_address,
+                                                 socket_options=self.socket_options)
+        except socket.timeout as e:
+            raise ConnectTimeoutError(self, "Connection to %s timed out. (connect timeout=%s)" %
+                                      (self.host, self.timeout)) from e
+        except OSError as e:
+            raise NewConnectionError(self, "Failed to establish a new connection: %s" % e) from e
+
+
+class _ClientAdapter(HTTPAdapter):
+    """ `HTTPAdapter` whose pools make new connections with `client.create_connection`. """
+
+    def __init__(self, client, **kwargs):
+        self.client = client
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        attrs = {"client": self.client}
+        http = type("HTTPConnection", (_ClientConnection, urllib3.connection.HTTPConnection), attrs)
+        https = type("HTTPSConnection", (_ClientConnection, urllib3.connection.HTTPSConnection), attrs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": type("HTTPConnectionPool", (HTTPConnectionPool, ), {"ConnectionCls": http}),
+            "https": type("HTTPSConnectionPool", (HTTPSConnectionPool, ), {"ConnectionCls": https}),
+        }
+
+
+class HttpClient:
+    def __init__(self, pool_hosts=DEFAULT_POOL_HOSTS, pool_maxsize=DEFAULT_POOL_MAXSIZE, dns_ttl=DEFAULT_DNS_TTL,
+                 http2=False):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.routes = {}  # port -> (host, port) connected to instead, `None` for every other port
+        self.configure(pool_hosts, pool_maxsize, dns_ttl, http2)
+
+    def configure(self, pool_hosts=DEFAULT_POOL_HOSTS, pool_maxsize=DEFAULT_POOL_MAXSIZE, dns_ttl=DEFAULT_DNS_TTL,
+                  http2=False):
+        """ (Re)create the pools, e.g. with the command line settings. """
+        self.dns = DnsCache(dns_ttl)
+
+        session = requests.Session()
+        # `pool_hosts` hosts keep their pools, each with up to `pool_maxsize` idle connections
+        adapter = _ClientAdapter(self, pool_connections=pool_hosts, pool_maxsize=pool_maxsize)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self.session = session
+
+        self.httpx = None
+        if http2:
+            if httpx is None:
+                print("httpx is not installed, using HTTP/1.1")
+            else:
+                limits = httpx.Limits(max_connections=pool_hosts * pool_maxsize,
+                                      max_keepalive_connections=pool_hosts * pool_maxsize)
+                self.httpx = httpx.Client(http2=True, verify=False, limits=limits)
+
+    def get(self, url, headers=None, timeout=10, allow_redirects=True, verify=True, stream=False):
+        with self.lock:
+            self.requests += 1
+        if self.httpx is not None:
+            request = self.httpx.build_request("GET", url, headers=headers, timeout=timeout)
+            return _HttpxResponse(self.httpx.send(request, stream=stream, follow_redirects=allow_redirects))
+        return self.session.get(url, headers=headers, timeout=timeout, allow_redirects=allow_redirects,
+                                verify=verify, stream=stream)
+
+    def route(self, routes):
+        """ Connect to `{port: (host, port)}` instead of the requested hosts, the
+            address under `None` takes every other port; empty to connect normally.
+        """
+        self.routes = dict(routes)
+
+    def create_connection(self, address, *args, **kwargs):
+        """ `urllib3.util.connection.create_connection` with cached DNS and `routes`. """
+        if self.routes:
+            address = self.routes.get(address[1], self.routes.get(None, address))
+        host, port = address
+        host = host.strip("[]")
+        addresses = [host] if _is_ip(host) else self.dns.resolve(host, port)
+
+        error = OSError("no addresses for %s" % host)
+        for ip in addresses:
+            start = time.perf_counter()
+            try:
+                sock = urllib3.util.connection.create_connection((ip, port), *args, **kwargs)
+            except OSError as e:
+                error = e
+                continue
+            metrics.observe("connect", time.perf_counter() - start)
+            with self.lock:
+                self.connections += 1
+            return sock
+        raise error
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "connections": self.connections,
+                "reuse": 1 - self.connections / self.requests if self.requests else 0.0,
+                "dns_hits": self.dns.hits,
+                "dns_misses": self.dns.misses,
+            }
+
+    def report(self):
+        stats = self.stats()
+        print("HTTP: %d requests over %d new connections (%.1f%% reused), DNS cache %d hits / %d misses" %
+              (stats["requests"], stats["connections"], 100 * stats["reuse"], stats["dns_hits"], stats["dns_misses"]))
+
+
+# process-wide client used by all workers
+http_client = HttpClient()
+metrics.gauge("http_connections", lambda: http_client.connections)
+metrics.gauge("http_requests", lambda: http_client.requests)
@@ -0,0 +1,146 @@
+""" Read the bundled crawl corpus without a database server
+
+`read_table` streams the rows of one table out of a `pg_dump -Fc` archive
+(the `db` file in the repository root); `read_csv` reads the `export/*.csv`
+files. Both are used by the offline benchmarks.
+"""
+
+import os
+import csv
+import zlib
+import struct
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DUMP_PATH = os.path.join(ROOT, "db")
+EXPORT_DIR = os.path.join(ROOT, "export")
+
+_BLOCK_DATA = 1
+_COPY_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v", "\\": "\\"}
+
+
+class _Archive:
+    """ Minimal reader for custom-format archives (versions 1.10 - 1.13). """
+
+    def __init__(self, fp):
+        self.fp = fp
+        if fp.read(5) != b"PGDMP":
+            raise ValueError("not a pg_dump custom archive")
+        self.version = struct.unpack("BBB", fp.read(3))
+        self.int_size, self.off_size, archive_format = struct.unpack("BBB", fp.read(3))
+        if archive_format != 1 or not (1, 10) <= self.version[:2] <= (1, 13):
+            raise ValueError("unsupported archive format %d version %s" % (archive_format, self.version))
+
+        self.compression = self.read_int()
+        for _ in range(7):  # creation time
+            self.read_int()
+        self.read_string()  # database name
+        self.read_string()  # server version
+        self.read_string()  # pg_dump version
+        self.toc = [self.read_toc_entry() for _ in range(self.read_int())]
+
+    def read_int(self):
+        sign = self.fp.read(1)[0]
+        value = int.from_bytes(self.fp.read(self.int_size), "little")
+        return -value if sign else value
+
+    def read_string(self):
+        length = self.read_int()
+        if length < 0:
+            return None
+        return self.fp.read(length).decode("utf-8")
+
+    def read_toc_entry(self):
+        entry = {"id": self.read_int(), "had_dumper": self.read_int()}
+        self.read_string()  # table oid
+        self.read_string()  # oid
+        entry["tag"] = self.read_string()
+        entry["desc"] = self.read_string()
+        self.read_int()     # section
+        entry["defn"] = self.read_string()
+        self.read_string()  # drop statement
+        entry["copy"] = self.read_string()
+        entry["namespace"] = self.read_string()
+        self.read_string()  # tablespace
+        self.read_string()  # owner
+        self.read_string()  # with oids
+        while self.read_string() is not None:  # dependencies
+            pass
+        flag = self.fp.read(1)[0]
+        offset = int.from_bytes(self.fp.read(self.off_size), "little")
+        entry["offset"] = offset if flag == 2 else None  # K_OFFSET_POS_SET
+        return entry
+
+    def read_data(self, entry):
+        """ Decompressed COPY text of a table data entry, chunk by chunk. """
+        self.fp.seek(entry["offset"])
+        block_type = self.fp.read(1)[0]
+        if block_type != _BLOCK_DATA or self.read_int() != entry["id"]:
+            raise ValueError("unexpected data block for %s" % entry["tag"])
+
+        decompressor = zlib.decompressobj() if self.compression != 0 else None
+        while True:
+            length = self.read_int()
+            if length <= 0:
+                break
+            chunk = self.fp.read(length)
+            yield decompressor.decompress(chunk) if decompressor else chunk
+        if decompressor:
+            yield decompressor.flush()
+
+
+def _unescape(value):
+    if value == "\\N":
+        return None
+    if "\\" not in value:
+        return value
+    out, i = [], 0
+    while i < len(value):
+        char = value[i]
+        if char == "\\" and i + 1 < len(value):
+            out.append(_COPY_ESCAPES.get(value[i + 1], value[i + 1]))
+            i += 2
+        else:
+            out.append(char)
+            i += 1
+    return "".join(out)
+
+
+def read_table(table, path=DUMP_PATH, schema="crawldb"):
+    """ Yield every row of `schema.table` as a dict of column -> text (or `None`). """
+    with open(path, "rb") as fp:
+        archive = _Archive(fp)
+        for entry in archive.toc:
+            if entry["desc"] != "TABLE DATA" or entry["tag"] != table or entry["namespace"] != schema:
+                continue
+            columns = [name.strip().strip('"') for name in
+                       entry["copy"].split("(", 1)[1].split(")", 1)[0].split(",")]
+
+            pending = b""
+            for chunk in archive.read_data(entry):
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    if line == b"\\.":
+                        return
+                    values = line.decode("utf-8").split("\t")
+                    yield dict(zip(columns, map(_unescape, values)))
+            return
+    raise KeyError("table %s.%s not found in %s" % (schema, table, path))
+
+
+def read_csv(name, directory=EXPORT_DIR):
+    """ Rows of `export/<name>.csv` as dicts. """
+    with open(os.path.join(directory, name + ".csv"), newline="", encoding="utf-8") as fp:
+        yield from csv.DictReader(fp)
+
+
+def html_pages(limit=None):
+    """ `(url, html_content)` of stored HTML pages in the dump. """
+    count = 0
+    for row in read_table("page"):
+        if row.get("page_type_code") == "HTML" and row.get("html_content"):
+            yield row["url"], row["html_content"]
+            count += 1
+            if limit and count >= limit:
+                return
@@ -1,8 +1,14 @@
+-- creates the latest schema from scratch, keep in sync with crawler/migrations.py
+-- (which upgrades existing databases)
 
+DROP TABLE IF EXISTS crawldb.schema_version;
 DROP TABLE IF EXISTS crawldb.link;
+DROP TABLE IF EXISTS crawldb.page_revisit;
 DROP TABLE IF EXISTS crawldb.page_data;
 DROP TABLE IF EXISTS crawldb.image;
 DROP TABLE IF EXISTS crawldb.page;
+DROP TABLE IF EXISTS crawldb.content;
+DROP TABLE IF EXISTS crawldb.content_dictionary;
 DROP TABLE IF EXISTS crawldb.data_type;
 DROP TABLE IF EXISTS crawldb.site;
 DROP TABLE IF EXISTS crawldb.page_type;
@@ -26,9 +32,12 @@ CREATE TABLE crawldb.site (
 	"domain"             varchar(500)  ,
 	robots_content       text  ,
 	sitemap_content      text  ,
+	sitemap_time         timestamp,
 	CONSTRAINT pk_site_id PRIMARY KEY ( id )
  );
 
+CREATE UNIQUE INDEX "unq_site_domain" ON crawldb.site ( "domain" );
+
 CREATE TABLE crawldb.page ( 
 	id                   serial  NOT NULL,
 	site_id              integer  ,
@@ -40,19 +49,73 @@ CREATE TABLE crawldb.page (
 	duplicate_page_id    integer,
 	is_binary            boolean,
 	hash								 bigint,
+	simhash              bigint,
+	"depth"              integer,
+	priority             double precision  NOT NULL DEFAULT 0,
+	leased_by            varchar(255),
+	lease_expires        timestamp with time zone,
+	content_hash         bigint,
 	CONSTRAINT pk_page_id PRIMARY KEY ( id ),
 	CONSTRAINT unq_url_idx UNIQUE ( url ) 
  );
 
 CREATE INDEX "idx_page_site_id" ON crawldb.page ( site_id );
 
-CREATE INDEX "idx_page_page_type_code" ON crawldb.page ( page_type_code );
+CREATE INDEX "idx_page_type_accessed" ON crawldb.page ( page_type_code, accessed_time );
+
+CREATE INDEX "idx_page_url_hash" ON crawldb.page USING hash ( url );
+
+CREATE INDEX "idx_page_hash" ON crawldb.page ( hash ) WHERE hash IS NOT NULL;
+
+-- keeps frontier claims (highest priority first) independent of the number of crawled pages
+CREATE INDEX "idx_page_frontier" ON crawldb.page ( priority DESC, id ) WHERE page_type_code = 'FRONTIER';
+
+-- claimed rows only, finds expired leases and the rows of one lease owner
+CREATE INDEX "idx_page_leases" ON crawldb.page ( lease_expires ) WHERE page_type_code = 'IN PROGRESS';
+
+-- compressed HTML stored once per unique body (`page.content_hash`), see crawler/bodies.py
+CREATE TABLE crawldb.content_dictionary ( 
+	id                   serial  NOT NULL,
+	site_id              integer,
+	codec                varchar(8)  NOT NULL,
+	"data"               bytea  NOT NULL,
+	CONSTRAINT pk_content_dictionary_id PRIMARY KEY ( id )
+ );
+
+CREATE INDEX "idx_content_dictionary_site_id" ON crawldb.content_dictionary ( site_id, codec );
+
+CREATE TABLE crawldb.content ( 
+	hash                 bigint  NOT NULL,
+	codec                varchar(8)  NOT NULL,
+	dictionary_id        integer,
+	size                 integer  NOT NULL,
+	"data"               bytea  NOT NULL,
+	CONSTRAINT pk_content_hash PRIMARY KEY ( hash )
+ );
+
+ALTER TABLE crawldb.content ALTER COLUMN "data" SET STORAGE EXTERNAL;
+
+-- validators and change-rate estimate of stored HTML pages, see crawler/recrawl.py
+CREATE TABLE crawldb.page_revisit ( 
+	page_id              integer  NOT NULL,
+	etag                 varchar(255),
+	last_modified        varchar(64),
+	visits               integer  NOT NULL DEFAULT 1,
+	changes              integer  NOT NULL DEFAULT 0,
+	observed_days        double precision  NOT NULL DEFAULT 0,
+	change_rate          double precision,
+	next_visit           timestamp,
+	CONSTRAINT pk_page_revisit_page_id PRIMARY KEY ( page_id )
+ );
+
+CREATE INDEX "idx_page_revisit_next_visit" ON crawldb.page_revisit ( next_visit );
 
 CREATE TABLE crawldb.page_data ( 
 	id                   serial  NOT NULL,
 	page_id              integer  ,
 	data_type_code       varchar(20)  ,
 	"data"               bytea,
+	blob_key             varchar(64),
 	CONSTRAINT pk_page_data_id PRIMARY KEY ( id )
  );
 
@@ -67,6 +130,7 @@ CREATE TABLE crawldb.image (
 	content_type         varchar(50)  ,
 	"data"               bytea  ,
 	accessed_time        timestamp  ,
+	blob_key             varchar(64),
 	CONSTRAINT pk_image_id PRIMARY KEY ( id )
  );
 
@@ -92,6 +156,8 @@ ALTER TABLE crawldb.page ADD CONSTRAINT fk_page_site FOREIGN KEY ( site_id ) REF
 
 ALTER TABLE crawldb.page ADD CONSTRAINT fk_page_page_type FOREIGN KEY ( page_type_code ) REFERENCES crawldb.page_type( code ) ON DELETE RESTRICT;
 
+ALTER TABLE crawldb.page_revisit ADD CONSTRAINT fk_page_revisit_page FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE CASCADE;
+
 ALTER TABLE crawldb.page_data ADD CONSTRAINT fk_page_data_page FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE RESTRICT;
 
 ALTER TABLE crawldb.page_data ADD CONSTRAINT fk_page_data_data_type FOREIGN KEY ( data_type_code ) REFERENCES crawldb.data_type( code ) ON DELETE RESTRICT;
@@ -109,4 +175,28 @@ INSERT INTO crawldb.page_type VALUES
 	('DUPLICATE'),
 	('FRONTIER'),
 	('IN PROGRESS'),
-	('UNKNOWN');
\ No newline at end of file
+	('UNKNOWN');
+
+-- shard (0 .. shards - 1) owning the domain of `url`, domains are compared without `www.`
+CREATE OR REPLACE FUNCTION crawldb.url_shard(url text, shards integer) RETURNS integer AS $$
+	SELECT ((hashtext(lower(substring(url from '^[a-zA-Z][a-zA-Z0-9+.-]*://(?:www\.)?([^/:?#]+)')))::bigint % shards + shards) % shards)::integer
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE TABLE crawldb.schema_version ( 
+	version              integer  NOT NULL,
+	name                 varchar(255),
+	applied_at           timestamp  NOT NULL DEFAULT now(),
+	CONSTRAINT pk_schema_version PRIMARY KEY ( version )
+ );
+
+INSERT INTO crawldb.schema_version (version, name) VALUES 
+	(1, 'baseline'),
+	(2, 'simhash fingerprints'),
+	(3, 'blob store keys'),
+	(4, 'domain shards'),
+	(5, 'revisit schedule'),
+	(6, 'frontier priorities'),
+	(7, 'sitemap ingestion time'),
+	(8, 'frontier leases'),
+	(9, 'lookup indexes'),
+	(10, 'deduplicated bodies');
@@ -0,0 +1,42 @@
+""" Batched frontier access
+
+Rows are claimed from `crawldb.page` in batches by a single statement that
+leases them, moving them from `FRONTIER` to `IN PROGRESS` (`FOR UPDATE SKIP
+LOCKED`, so concurrent workers never claim the same row), and are then served
+from a per-worker in-memory queue.
+"""
+
+from collections import deque
+
+from crawler.storage import Storage, DEFAULT_LEASE
+
+
+DEFAULT_BATCH_SIZE = 20
+
+
+class FrontierQueue:
+    """ In-memory queue of frontier rows claimed by one worker. """
+
+    def __init__(self, conn: Storage, batch_size=DEFAULT_BATCH_SIZE, shard=None, owner=None, lease=DEFAULT_LEASE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.shard = shard
+        self.owner = owner
+        self.lease = lease
+        self.rows = deque()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def get(self):
+        """ Next `(id, url, is_binary, priority)` row, or `None` if the frontier is empty. """
+        if not self.rows:
+            self.rows.extend(self.conn.claim_from_frontier(self.batch_size, shard=self.shard, owner=self.owner,
+                                                           lease=self.lease))
+        return self.rows.popleft() if self.rows else None
+
+    def release(self):
+        """ Hand all unprocessed rows back to the frontier in one statement. """
+        if self.rows:
+            self.conn.set_page_type([row[0] for row in self.rows], "FRONTIER")
+            self.rows.clear()
@@ -1,6 +1,154 @@
+""" Content fingerprints
+
+`hash_document` is a stable 64 bit hash of the exact document (unlike the
+built-in `hash`, it does not change between processes). `simhash` is a 64 bit
+SimHash of the main text: navigation, header and footer repeat on every page
+of a site and would make its pages look alike. Documents whose SimHashes
+differ in at most a few bits are near duplicates. `DuplicateIndex` finds both
+in memory, using banded LSH so near-duplicate lookups only compare a handful
+of candidates.
+"""
+
+import re
+import hashlib
+import threading
+
+
+SIMHASH_BITS = 64
+DEFAULT_DISTANCE = 3
+
+_tags = re.compile(r"<script\b.*?</script>|<style\b.*?</style>|<[^>]+>", re.I | re.S)
+_words = re.compile(r"\w+", re.U)
+_comments = re.compile(r"<!--.*?-->", re.S)
+_main = re.compile(r"<(main|article)\b[^>]*>(.*?)</\1\s*>", re.I | re.S)
+_boilerplate = re.compile(r"<(nav|header|footer|aside|noscript)\b.*?</\1\s*>", re.I | re.S)
+
+
+def _hash64(data: bytes):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def to_bigint(value: int):
+    """ Unsigned 64 bit value as a signed integer for a Postgres `bigint`. """
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def from_bigint(value: int):
+    return value + (1 << 64) if value < 0 else value
+
+
 def hash_document(document):
-    return python_hash(document)
+    return to_bigint(_hash64(document.encode("utf-8", errors="replace")))
+
+
+def _bit_counts(hashes):
+    # count set bits per position with a bit-sliced adder: planes[j] holds bit j of every counter
+    planes = []
+    for carry in hashes:
+        for j, plane in enumerate(planes):
+            planes[j] = plane ^ carry
+            carry &= plane
+            if not carry:
+                break
+        if carry:
+            planes.append(carry)
+    return [sum(((plane >> i) & 1) << j for j, plane in enumerate(planes)) for i in range(SIMHASH_BITS)]
+
+
+def main_text(document: str):
+    """ Visible text of the `<main>` and `<article>` elements of `document`, or
+        without them of the whole page less navigation, header, footer and asides.
+    """
+    document = _comments.sub(" ", document)
+    main = [match.group(2) for match in _main.finditer(document)]
+    return _tags.sub(" ", " ".join(main) if main else _boilerplate.sub(" ", document))
+
+
+def simhash(document: str, shingle=3):
+    """ SimHash over the set of `shingle`-word sequences of the main text. """
+    words = _words.findall(main_text(document).lower())
+    if len(words) < shingle:
+        features = {" ".join(words)}
+    else:
+        features = {" ".join(words[i:i + shingle]) for i in range(len(words) - shingle + 1)}
+
+    hashes = [_hash64(feature.encode("utf-8")) for feature in features]
+    half = len(hashes) / 2
+    value = 0
+    for i, count in enumerate(_bit_counts(hashes)):
+        if count > half:
+            value |= 1 << i
+    return value
+
+
+def hamming(a: int, b: int):
+    return bin(a ^ b).count("1")
+
+
+class DuplicateIndex:
+    """ In-memory exact and near-duplicate index of stored HTML pages.
+
+        SimHashes are split into `distance + 1` bands; two hashes within
+        `distance` bits of each other agree on at least one whole band.
+    """
+
+    def __init__(self, distance=DEFAULT_DISTANCE):
+        self.distance = distance
+        self.bands = distance + 1
+        self.band_bits = SIMHASH_BITS // self.bands
+        self.exact = {}  # hash_document -> page id
+        self.tables = [{} for _ in range(self.bands)]
+        self.lock = threading.Lock()
+
+    def _keys(self, value):
+        mask = (1 << self.band_bits) - 1
+        return [(value >> (band * self.band_bits)) & mask for band in range(self.bands)]
+
+    def add(self, page_id, exact_hash, near_hash):
+        near_hash = from_bigint(near_hash)
+        with self.lock:
+            self.exact.setdefault(exact_hash, page_id)
+            for table, key in zip(self.tables, self._keys(near_hash)):
+                table.setdefault(key, []).append((near_hash, page_id))
+
+    def find(self, exact_hash, near_hash):
+        """ `(page id, exact)` of a stored page that is a duplicate (`exact`) or
+            a near duplicate, or `(None, False)`.
+        """
+        near_hash = from_bigint(near_hash)
+        with self.lock:
+            page_id = self.exact.get(exact_hash)
+            if page_id is not None:
+                return page_id, True
+            for table, key in zip(self.tables, self._keys(near_hash)):
+                for candidate, page_id in table.get(key, ()):
+                    if hamming(candidate, near_hash) <= self.distance:
+                        return page_id, False
+        return None, False
+
+    def __len__(self):
+        return len(self.exact)
+
+    def warm(self, conn, since_id=0, since_time=None):
+        """ Load fingerprints of stored HTML pages, all of them or only those with
+            an id above `since_id` or accessed at `since_time` or later.
+        """
+        for page_id, exact_hash, near_hash in conn.select_fingerprints(since_id, since_time):
+            if near_hash is not None:
+                self.add(page_id, exact_hash, near_hash)
+        print("Loaded %d page fingerprints" % len(self))
 
+    def snapshot(self):
+        with self.lock:
+            return self.distance, dict(self.exact), [{key: list(bucket) for key, bucket in table.items()}
+                                                     for table in self.tables]
 
-def python_hash(document):
-    return hash(document)
+    def restore(self, state):
+        """ Load a `snapshot`, returns `False` if it was taken with another distance. """
+        distance, exact, tables = state
+        if distance != self.distance:
+            return False
+        with self.lock:
+            self.exact = exact
+            self.tables = tables
+        return True
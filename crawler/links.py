@@ -0,0 +1,65 @@
+""" Streaming link extraction
+
+Pulls `<base href>`, every `href` attribute, `<img src>` and the
+`location.href = '...'` targets of `onclick` handlers out of a document with
+the stdlib `html.parser` event API instead of building a BeautifulSoup tree.
+Relative links are resolved against `<base href>` and the url of the page.
+URLs are validated and canonicalised by the cached `url_engine`, since
+navigation links repeat on almost every page of a site.
+"""
+
+import re
+
+from html.parser import HTMLParser
+from urllib.parse import urljoin
+
+from crawler.urls import url_engine
+
+# `location = '...'`, `location.href = '...'` and `location.assign('...')`, also of `window` or `document`
+_location = re.compile(r"""\blocation(?:\.href)?\s*(?:=|\.(?:assign|replace)\s*\()\s*(["'])(.+?)\1""")
+
+
+class LinkExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.base = None
+        self.hrefs = []
+        self.images = []
+
+    def handle_starttag(self, tag, attrs):
+        for name, value in attrs:
+            if value is None:
+                continue
+            if name == "href":
+                self.hrefs.append(value)
+                if tag == "base" and self.base is None:
+                    self.base = value
+            elif name == "src" and tag == "img":
+                self.images.append(value)
+            elif name == "onclick":
+                self.hrefs.extend(match.group(2) for match in _location.finditer(value))
+
+    handle_startendtag = handle_starttag
+
+
+def extract_links(document: str, url: str = None):
+    """ Canonical hrefs and image sources found in `document`, relative ones
+        resolved against its `<base href>` and its `url`.
+    """
+    parser = LinkExtractor()
+    parser.feed(document)
+    parser.close()
+
+    base = parser.base.strip() if parser.base else None
+    if url is not None:
+        base = urljoin(url, base) if base else url
+
+    def resolve(link):
+        # browsers strip the whitespace around attribute urls
+        link = link.strip()
+        return urljoin(base, link) if base else link
+
+    hrefs = [info.url for info in url_engine.parse_many([resolve(href) for href in parser.hrefs]) if info.valid]
+    image_sources = [info.url for info in url_engine.parse_many([resolve(img) for img in parser.images])
+                     if info.valid and "base64" not in info.url]
+    return hrefs, image_sources
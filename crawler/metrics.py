@@ -0,0 +1,197 @@
+""" Crawl metrics
+
+Latency histograms per crawl stage and labelled counters, cheap enough to
+update on every page. They are served in Prometheus text format on a local
+HTTP endpoint and can also be written as periodic JSON snapshots.
+
+    with metrics.timer("fetch"):
+        response = ...
+    metrics.count("pages", page_type_code="HTML")
+"""
+
+import json
+import time
+import bisect
+import threading
+
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+# seconds, upper bounds of the histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """ Upper bound of the bucket holding the `q` quantile. """
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # (stage, labels) -> Histogram
+        self.counters = {}    # (name, labels) -> value
+        self.gauges = {}      # (name, labels) -> value or callable
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, stage, seconds, **labels):
+        key = self._key(stage, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, **labels)
+
+    def count(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        """ Set a gauge; `value` may be a callable evaluated on every read. """
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def error(self, stage, err):
+        self.count("errors", stage=stage, error=type(err).__name__)
+
+    def snapshot(self):
+        with self.lock:
+            histograms = {key: (h.buckets, list(h.counts), h.sum, h.count, h.quantile(0.5), h.quantile(0.99))
+                          for key, h in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        values = {}
+        for key, value in gauges.items():
+            if callable(value):
+                try:
+                    value = value()
+                except Exception as e:
+                    # e.g. the DB is unreachable, report the remaining metrics anyway
+                    print("Error reading gauge %s" % key[0], e)
+                    continue
+            values[key] = value
+        return histograms, counters, values
+
+    def to_json(self):
+        histograms, counters, gauges = self.snapshot()
+
+        def name(key):
+            stage, labels = key
+            return stage + ("{%s}" % ",".join("%s=%s" % label for label in labels) if labels else "")
+
+        return json.dumps({
+            "time": time.time(),
+            "uptime": time.time() - self.started,
+            "stages": {name(key): {"count": count, "sum": total, "p50": p50, "p99": p99}
+                       for key, (_, _, total, count, p50, p99) in histograms.items()},
+            "counters": {name(key): value for key, value in counters.items()},
+            "gauges": {name(key): value for key, value in gauges.items()},
+        }, sort_keys=True)
+
+    def to_prometheus(self):
+        histograms, counters, gauges = self.snapshot()
+
+        def labels(pairs, extra=()):
+            pairs = list(pairs) + list(extra)
+            if not pairs:
+                return ""
+            return "{%s}" % ",".join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                                     for k, v in pairs)
+
+        lines = []
+        for key in sorted(histograms):
+            stage, pairs = key
+            buckets, counts, total, count, _, _ = histograms[key]
+            metric = "crawler_stage_seconds"
+            pairs = (("stage", stage), ) + pairs
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append("%s_bucket%s %d" % (metric, labels(pairs, [("le", bound)]), cumulative))
+            lines.append("%s_bucket%s %d" % (metric, labels(pairs, [("le", "+Inf")]), count))
+            lines.append("%s_sum%s %f" % (metric, labels(pairs), total))
+            lines.append("%s_count%s %d" % (metric, labels(pairs), count))
+        for (name, pairs), value in sorted(counters.items()):
+            lines.append("crawler_%s_total%s %d" % (name, labels(pairs), value))
+        for (name, pairs), value in sorted(gauges.items()):
+            lines.append("crawler_%s%s %s" % (name, labels(pairs), value))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host="127.0.0.1"):
+        """ Serve `/metrics` (Prometheus) and `/metrics.json` from a daemon thread. """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.to_prometheus(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = metrics.to_json(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        print("Serving metrics on http://%s:%d/metrics" % (host, server.server_address[1]))
+        return server
+
+    def write_snapshots(self, path, interval=60):
+        """ Append a JSON snapshot to `path` every `interval` seconds from a daemon thread. """
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    with open(path, "a") as fp:
+                        fp.write(self.to_json() + "\n")
+                except OSError as e:
+                    print("Error writing metrics snapshot", e)
+
+        threading.Thread(target=run, name="metrics-snapshot", daemon=True).start()
+
+
+# process-wide registry used by all workers
+metrics = Metrics()
@@ -0,0 +1,352 @@
+""" Versioned crawldb schema migrations
+
+Every schema change is a numbered migration; the applied ones are recorded in
+`crawldb.schema_version`, so `migrate` brings a new database or one created by
+any earlier `crawldb.sql` up to date. Migrations are written to be re-runnable
+(`IF NOT EXISTS`), a database created before versions were recorded is
+migrated from version 1. Each migration runs in its own transaction; stop the
+crawl first, index builds lock writes to the table.
+
+    python -m crawler.migrations                   # migrate to the latest version
+    python -m crawler.migrations --status
+    python -m crawler.migrations --partitions 16   # ... and hash-partition `page`
+"""
+
+import sys
+import time
+import argparse
+
+from crawler.utils import DBConn
+
+
+# arbitrary key of the advisory lock that keeps concurrent shards from migrating at once
+LOCK_KEY = 4242019
+
+MIGRATIONS = (
+    (1, "baseline", """
+        CREATE SCHEMA IF NOT EXISTS crawldb;
+
+        CREATE TABLE IF NOT EXISTS crawldb.data_type (
+            code                 varchar(20)  NOT NULL,
+            CONSTRAINT pk_data_type_code PRIMARY KEY ( code )
+        );
+
+        CREATE TABLE IF NOT EXISTS crawldb.page_type (
+            code                 varchar(20)  NOT NULL,
+            CONSTRAINT pk_page_type_code PRIMARY KEY ( code )
+        );
+
+        CREATE TABLE IF NOT EXISTS crawldb.site (
+            id                   serial  NOT NULL,
+            "domain"             varchar(500),
+            robots_content       text,
+            sitemap_content      text,
+            CONSTRAINT pk_site_id PRIMARY KEY ( id )
+        );
+
+        CREATE TABLE IF NOT EXISTS crawldb.page (
+            id                   serial  NOT NULL,
+            site_id              integer,
+            page_type_code       varchar(20),
+            url                  varchar(3000),
+            html_content         text,
+            http_status_code     integer,
+            accessed_time        timestamp,
+            duplicate_page_id    integer,
+            is_binary            boolean,
+            hash                 bigint,
+            CONSTRAINT pk_page_id PRIMARY KEY ( id ),
+            CONSTRAINT unq_url_idx UNIQUE ( url ),
+            CONSTRAINT fk_page_site FOREIGN KEY ( site_id ) REFERENCES crawldb.site( id ) ON DELETE RESTRICT,
+            CONSTRAINT fk_page_page_type FOREIGN KEY ( page_type_code ) REFERENCES crawldb.page_type( code ) ON DELETE RESTRICT
+        );
+
+        CREATE INDEX IF NOT EXISTS "idx_page_site_id" ON crawldb.page ( site_id );
+        CREATE INDEX IF NOT EXISTS "idx_page_page_type_code" ON crawldb.page ( page_type_code );
+
+        CREATE TABLE IF NOT EXISTS crawldb.page_data (
+            id                   serial  NOT NULL,
+            page_id              integer,
+            data_type_code       varchar(20),
+            "data"               bytea,
+            CONSTRAINT pk_page_data_id PRIMARY KEY ( id ),
+            CONSTRAINT fk_page_data_page FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE RESTRICT,
+            CONSTRAINT fk_page_data_data_type FOREIGN KEY ( data_type_code ) REFERENCES crawldb.data_type( code ) ON DELETE RESTRICT
+        );
+
+        CREATE INDEX IF NOT EXISTS "idx_page_data_page_id" ON crawldb.page_data ( page_id );
+        CREATE INDEX IF NOT EXISTS "idx_page_data_data_type_code" ON crawldb.page_data ( data_type_code );
+
+        CREATE TABLE IF NOT EXISTS crawldb.image (
+            id                   serial  NOT NULL,
+            page_id              integer,
+            filename             varchar(255),
+            content_type         varchar(50),
+            "data"               bytea,
+            accessed_time        timestamp,
+            CONSTRAINT pk_image_id PRIMARY KEY ( id ),
+            CONSTRAINT fk_image_page_data FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE RESTRICT
+        );
+
+        CREATE INDEX IF NOT EXISTS "idx_image_page_id" ON crawldb.image ( page_id );
+
+        CREATE TABLE IF NOT EXISTS crawldb.link (
+            from_page            integer  NOT NULL,
+            to_page              integer  NOT NULL,
+            CONSTRAINT _0 PRIMARY KEY ( from_page, to_page ),
+            CONSTRAINT fk_link_page FOREIGN KEY ( from_page ) REFERENCES crawldb.page( id ) ON DELETE RESTRICT,
+            CONSTRAINT fk_link_page_1 FOREIGN KEY ( to_page ) REFERENCES crawldb.page( id ) ON DELETE RESTRICT
+        );
+
+        CREATE INDEX IF NOT EXISTS "idx_link_from_page" ON crawldb.link ( from_page );
+        CREATE INDEX IF NOT EXISTS "idx_link_to_page" ON crawldb.link ( to_page );
+
+        INSERT INTO crawldb.data_type VALUES ('PDF'), ('DOC'), ('DOCX'), ('PPT'), ('PPTX') ON CONFLICT DO NOTHING;
+        INSERT INTO crawldb.page_type VALUES ('HTML'), ('BINARY'), ('DUPLICATE'), ('FRONTIER'), ('IN PROGRESS'), ('UNKNOWN')
+            ON CONFLICT DO NOTHING;
+    """),
+
+    (2, "simhash fingerprints", """
+        ALTER TABLE crawldb.page ADD COLUMN IF NOT EXISTS simhash bigint;
+    """),
+
+    (3, "blob store keys", """
+        ALTER TABLE crawldb.page_data ADD COLUMN IF NOT EXISTS blob_key varchar(64);
+        ALTER TABLE crawldb.image ADD COLUMN IF NOT EXISTS blob_key varchar(64);
+    """),
+
+    (4, "domain shards", r"""
+        CREATE OR REPLACE FUNCTION crawldb.url_shard(url text, shards integer) RETURNS integer AS $$
+            SELECT ((hashtext(lower(substring(url from '^[a-zA-Z][a-zA-Z0-9+.-]*://(?:www\.)?([^/:?#]+)')))::bigint % shards + shards) % shards)::integer
+        $$ LANGUAGE sql IMMUTABLE;
+    """),
+
+    (5, "revisit schedule", """
+        CREATE TABLE IF NOT EXISTS crawldb.page_revisit (
+            page_id              integer  NOT NULL,
+            etag                 varchar(255),
+            last_modified        varchar(64),
+            visits               integer  NOT NULL DEFAULT 1,
+            changes              integer  NOT NULL DEFAULT 0,
+            observed_days        double precision  NOT NULL DEFAULT 0,
+            change_rate          double precision,
+            next_visit           timestamp,
+            CONSTRAINT pk_page_revisit_page_id PRIMARY KEY ( page_id ),
+            CONSTRAINT fk_page_revisit_page FOREIGN KEY ( page_id ) REFERENCES crawldb.page( id ) ON DELETE CASCADE
+        );
+
+        CREATE INDEX IF NOT EXISTS "idx_page_revisit_next_visit" ON crawldb.page_revisit ( next_visit );
+    """),
+
+    (6, "frontier priorities", """
+        ALTER TABLE crawldb.page ADD COLUMN IF NOT EXISTS "depth" integer;
+        ALTER TABLE crawldb.page ADD COLUMN IF NOT EXISTS priority double precision NOT NULL DEFAULT 0;
+
+        -- replaces the `( id )` frontier index of older schemas
+        DROP INDEX IF EXISTS crawldb.idx_page_frontier;
+        CREATE INDEX "idx_page_frontier" ON crawldb.page ( priority DESC, id ) WHERE page_type_code = 'FRONTIER';
+    """),
+
+    (7, "sitemap ingestion time", """
+        ALTER TABLE crawldb.site ADD COLUMN IF NOT EXISTS sitemap_time timestamp;
+    """),
+
+    (8, "frontier leases", """
+        ALTER TABLE crawldb.page ADD COLUMN IF NOT EXISTS leased_by varchar(255);
+        ALTER TABLE crawldb.page ADD COLUMN IF NOT EXISTS lease_expires timestamp with time zone;
+
+        CREATE INDEX IF NOT EXISTS "idx_page_leases" ON crawldb.page ( lease_expires ) WHERE page_type_code = 'IN PROGRESS';
+    """),
+
+    (9, "lookup indexes", """
+        -- url equality lookups (`existing_urls`, link targets, revisits) on a hash index, far smaller than
+        -- the unique b-tree on these long strings, which stays for `ON CONFLICT (url)`
+        CREATE INDEX IF NOT EXISTS "idx_page_url_hash" ON crawldb.page USING hash ( url );
+
+        -- `page_for_hash`
+        CREATE INDEX IF NOT EXISTS "idx_page_hash" ON crawldb.page ( hash ) WHERE hash IS NOT NULL;
+
+        -- `select_page_html` and checkpoint resume (`select_fingerprints` by `accessed_time`),
+        -- also serves every `page_type_code` filter the old single column index did
+        CREATE INDEX IF NOT EXISTS "idx_page_type_accessed" ON crawldb.page ( page_type_code, accessed_time );
+        DROP INDEX IF EXISTS crawldb.idx_page_page_type_code;
+
+        -- one row per domain, so `insert_site` can be idempotent; merge duplicates racing workers left behind
+        UPDATE crawldb.page AS p SET site_id = d.keep
+        FROM (
+            SELECT id, min(id) OVER (PARTITION BY "domain") AS keep FROM crawldb.site WHERE "domain" IS NOT NULL
+        ) AS d
+        WHERE p.site_id = d.id AND d.id <> d.keep;
+        DELETE FROM crawldb.site AS s USING crawldb.site AS k
+        WHERE s."domain" = k."domain" AND s.id > k.id;
+        CREATE UNIQUE INDEX IF NOT EXISTS "unq_site_domain" ON crawldb.site ( "domain" );
+    """),
+
+    (10, "deduplicated bodies", """
+        -- compressed HTML stored once per unique body, see crawler/bodies.py
+        CREATE TABLE IF NOT EXISTS crawldb.content_dictionary (
+            id                   serial  NOT NULL,
+            site_id              integer,
+            codec                varchar(8)  NOT NULL,
+            "data"               bytea  NOT NULL,
+            CONSTRAINT pk_content_dictionary_id PRIMARY KEY ( id )
+        );
+        CREATE INDEX IF NOT EXISTS "idx_content_dictionary_site_id" ON crawldb.content_dictionary ( site_id, codec );
+
+        CREATE TABLE IF NOT EXISTS crawldb.content (
+            hash                 bigint  NOT NULL,
+            codec                varchar(8)  NOT NULL,
+            dictionary_id        integer,
+            size                 integer  NOT NULL,
+            "data"               bytea  NOT NULL,
+            CONSTRAINT pk_content_hash PRIMARY KEY ( hash )
+        );
+        -- already compressed, don't let TOAST try again
+        ALTER TABLE crawldb.content ALTER COLUMN "data" SET STORAGE EXTERNAL;
+
+        ALTER TABLE crawldb.page ADD COLUMN IF NOT EXISTS content_hash bigint;
+    """),
+)
+
+LATEST = MIGRATIONS[-1][0]
+
+# `crawldb.page` indexes and constraints of the latest version, recreated by `partition_pages`
+_PAGE_INDEXES = """
+    ALTER TABLE crawldb.page ADD CONSTRAINT unq_url_idx UNIQUE ( url );
+    CREATE INDEX "idx_page_id" ON crawldb.page ( id );
+    CREATE INDEX "idx_page_site_id" ON crawldb.page ( site_id );
+    CREATE INDEX "idx_page_frontier" ON crawldb.page ( priority DESC, id ) WHERE page_type_code = 'FRONTIER';
+    CREATE INDEX "idx_page_leases" ON crawldb.page ( lease_expires ) WHERE page_type_code = 'IN PROGRESS';
+    CREATE INDEX "idx_page_url_hash" ON crawldb.page USING hash ( url );
+    CREATE INDEX "idx_page_hash" ON crawldb.page ( hash ) WHERE hash IS NOT NULL;
+    CREATE INDEX "idx_page_type_accessed" ON crawldb.page ( page_type_code, accessed_time );
+    ALTER TABLE crawldb.page ADD CONSTRAINT fk_page_site FOREIGN KEY ( site_id ) REFERENCES crawldb.site( id ) ON DELETE RESTRICT;
+    ALTER TABLE crawldb.page ADD CONSTRAINT fk_page_page_type FOREIGN KEY ( page_type_code ) REFERENCES crawldb.page_type( code ) ON DELETE RESTRICT;
+"""
+
+# foreign keys to `crawldb.page( id )`, which a partitioned `page` (unique only per url) can not have
+_PAGE_REFERENCES = (
+    ("link", "fk_link_page"),
+    ("link", "fk_link_page_1"),
+    ("image", "fk_image_page_data"),
+    ("page_data", "fk_page_data_page"),
+    ("page_revisit", "fk_page_revisit_page"),
+)
+
+
+def current_version(conn: DBConn):
+    """ Latest applied migration, 0 for an empty database. """
+    cursor = conn.cursor
+    cursor.execute("SELECT to_regclass('crawldb.schema_version')")
+    if cursor.fetchone()[0] is None:
+        return 0
+    cursor.execute("SELECT coalesce(max(version), 0) FROM crawldb.schema_version")
+    return cursor.fetchone()[0]
+
+
+def is_partitioned(conn: DBConn):
+    conn.cursor.execute("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('crawldb.page')")
+    row = conn.cursor.fetchone()
+    return bool(row and row[0])
+
+
+def migrate(conn: DBConn, target=LATEST):
+    """ Apply the migrations up to `target`, returns the applied versions. """
+    cursor = conn.cursor
+    cursor.execute("SELECT pg_advisory_lock(%s)", (LOCK_KEY, ))
+    applied = []
+    try:
+        cursor.execute("""
+            CREATE SCHEMA IF NOT EXISTS crawldb;
+            CREATE TABLE IF NOT EXISTS crawldb.schema_version (
+                version              integer  NOT NULL,
+                name                 varchar(255),
+                applied_at           timestamp  NOT NULL DEFAULT now(),
+                CONSTRAINT pk_schema_version PRIMARY KEY ( version )
+            );
+        """)
+        conn.commit()
+        version = current_version(conn)
+        for number, name, sql in MIGRATIONS:
+            if number <= version or number > target:
+                continue
+            start = time.time()
+            try:
+                cursor.execute(sql)
+                cursor.execute("INSERT INTO crawldb.schema_version (version, name) VALUES (%s, %s)", (number, name))
+                conn.commit()
+            except Exception:
+                conn.connection.rollback()
+                raise
+            applied.append(number)
+            print("Applied migration %d (%s) in %.1fs" % (number, name, time.time() - start))
+    finally:
+        cursor.execute("SELECT pg_advisory_unlock(%s)", (LOCK_KEY, ))
+        conn.commit()
+    return applied
+
+
+def partition_pages(conn: DBConn, partitions):
+    """ Rebuild `crawldb.page` as `partitions` hash partitions.
+
+        Rows are spread by `url` rather than by site: `ON CONFLICT (url)`
+        needs a unique index on the url alone, and a partitioned table can only
+        enforce one that contains the partition key. For the same reason
+        `id` is no longer enforced unique and the foreign keys to it are
+        dropped; ids still come from the page sequence.
+    """
+    if current_version(conn) < LATEST:
+        raise RuntimeError("migrate to version %d before partitioning" % LATEST)
+    if is_partitioned(conn):
+        print("crawldb.page is already partitioned")
+        return
+
+    start = time.time()
+    cursor = conn.cursor
+    try:
+        for table, constraint in _PAGE_REFERENCES:
+            cursor.execute("ALTER TABLE crawldb.%s DROP CONSTRAINT IF EXISTS %s" % (table, constraint))
+        cursor.execute("ALTER TABLE crawldb.page RENAME TO page_unpartitioned")
+        cursor.execute("ALTER SEQUENCE crawldb.page_id_seq OWNED BY NONE")
+        cursor.execute("CREATE TABLE crawldb.page (LIKE crawldb.page_unpartitioned INCLUDING DEFAULTS) "
+                       "PARTITION BY HASH ( url )")
+        for remainder in range(partitions):
+            cursor.execute("CREATE TABLE crawldb.page_p%d PARTITION OF crawldb.page "
+                           "FOR VALUES WITH (MODULUS %d, REMAINDER %d)" % (remainder, partitions, remainder))
+        cursor.execute("INSERT INTO crawldb.page SELECT * FROM crawldb.page_unpartitioned")
+        cursor.execute("DROP TABLE crawldb.page_unpartitioned")
+        # indexes are cheaper to build after the copy
+        cursor.execute(_PAGE_INDEXES)
+        cursor.execute("ALTER SEQUENCE crawldb.page_id_seq OWNED BY crawldb.page.id")
+        conn.commit()
+    except Exception:
+        conn.connection.rollback()
+        raise
+    print("Partitioned crawldb.page into %d partitions in %.1fs" % (partitions, time.time() - start))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Create or upgrade the crawldb schema.")
+    parser.add_argument("--status", action="store_true", help="only print the current and latest version")
+    parser.add_argument("--target", type=int, default=LATEST, help="migrate up to this version")
+    parser.add_argument("--partitions", type=int,
+                        help="afterwards rebuild crawldb.page as this many hash partitions (by url)")
+    args = parser.parse_args(argv)
+
+    conn = DBConn()
+    try:
+        if args.status:
+            print("crawldb schema version %d of %d%s" % (current_version(conn), LATEST,
+                                                         ", page is partitioned" if is_partitioned(conn) else ""))
+            return 0
+        if not migrate(conn, args.target):
+            print("crawldb schema is at version %d" % current_version(conn))
+        if args.partitions:
+            partition_pages(conn, args.partitions)
+    finally:
+        conn.release()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,320 @@
+""" Per-host politeness scheduler
+
+Frontier rows are buffered in one priority queue per domain. Every domain
+has a next-allowed time; `get` hands out the highest priority URL of the
+domain that became ready first, so a worker only waits when every buffered
+domain is throttled.
+
+With an `AdaptiveController` (`crawler.adaptive`) the delay and the number
+of requests in flight of every domain follow its responses, workers report
+them with `record` and `release`, and transient failures are buffered again
+for a retry after a backoff.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+
+from crawler.adaptive import AdaptiveController
+from crawler.robots import DEFAULT_CRAWL_DELAY
+
+
+class HostStats:
+    def __init__(self):
+        self.dispatched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait):
+        self.dispatched += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    @property
+    def avg_wait(self):
+        return self.total_wait / self.dispatched if self.dispatched else 0.0
+
+
+class PolitenessScheduler:
+    """ Thread-safe scheduler shared by all workers.
+
+        `refill(n)` is called (by one thread at a time) to pull up to `n`
+        `(id, url, is_binary)` rows from the frontier whenever fewer than
+        `low_water` rows are buffered (not counting those of parked domains).
+
+        Every row returned by `get` must be passed to `release` once it is
+        done with; with a `controller` the fetch outcome goes to `record`.
+    """
+
+    def __init__(self, domain_of, refill=None, batch_size=100, low_water=20,
+                 default_delay=DEFAULT_CRAWL_DELAY, refill_backoff=1.0, max_delay=None, timeout=60,
+                 controller: AdaptiveController = None):
+        self.domain_of = domain_of
+        self.refill = refill
+        self.batch_size = batch_size
+        self.low_water = low_water
+        # upper bound for every crawl delay, e.g. 0 against a local stand-in server
+        self.max_delay = max_delay
+        self.default_delay = self._capped(default_delay)
+        self.refill_backoff = refill_backoff
+        self.timeout = timeout
+        self.controller = controller
+
+        self.cond = threading.Condition()
+        self.queues = {}        # domain -> heap of (-priority, seq, enqueued_at, row)
+        self.seq = itertools.count()
+        self.next_allowed = {}  # domain -> monotonic time of the next allowed fetch
+        self.delays = {}        # domain -> crawl delay in seconds
+        self.heap = []          # (ready_time, domain) for every domain with queued rows, unless blocked
+        self.blocked = set()    # domains with queued rows and as many requests in flight as allowed
+        self.retries = []       # heap of (due, seq, row) waiting for a retry
+        self.attempts = {}      # row id -> failed fetches
+        self.host_stats = {}
+        self.buffered = 0
+        self.refilling = False
+        self.refill_after = 0.0
+
+    def put(self, row):
+        with self.cond:
+            self._put(row, time.monotonic())
+            self.cond.notify()
+
+    def _put(self, row, now):
+        domain = self.domain_of(row[1])
+        queue = self.queues.get(domain)
+        if not queue:
+            queue = self.queues[domain] = []
+            heapq.heappush(self.heap, (self.next_allowed.get(domain, now), domain))
+        heapq.heappush(queue, (-row[3], next(self.seq), now, row))
+        self.buffered += 1
+
+    def set_delay(self, domain, delay):
+        """ Record the crawl delay (e.g. from robots.txt) for `domain`. """
+        delay = self._capped(delay)
+        with self.cond:
+            self.delays[domain] = delay
+            if self.controller is not None:
+                self.controller.set_delay(domain, delay)
+                delay = self._delay(domain)
+            # the fetch that triggered this call was scheduled with the old delay
+            last = self.next_allowed.get(domain)
+            if last is not None:
+                self.next_allowed[domain] = max(last, time.monotonic() + delay)
+
+    def _capped(self, delay):
+        return delay if self.max_delay is None else min(delay, self.max_delay)
+
+    def _delay(self, domain):
+        if self.controller is not None:
+            if self.controller.is_down(domain, time.monotonic()):
+                return 0.0  # its urls fail without a request
+            return self._capped(self.controller.interval(domain))
+        return self.delays.get(domain, self.default_delay)
+
+    def _allowed(self, domain, default):
+        allowed = self.next_allowed.get(domain, default)
+        if self.controller is not None:
+            allowed = max(allowed, self.controller.parked_until(domain))
+        return allowed
+
+    def get(self, timeout=None):
+        """ Return the next ready row, or `None` after `timeout` (default `self.timeout`) seconds. """
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.retries and self.retries[0][0] <= now:
+                    self._put(heapq.heappop(self.retries)[2], now)
+                if self.heap and self.heap[0][0] <= now:
+                    ready_time, domain = self.heap[0]
+                    allowed = self._allowed(domain, ready_time)
+                    if allowed > ready_time:
+                        # delay was raised by `set_delay` (or the domain parked) after this entry was pushed
+                        heapq.heapreplace(self.heap, (allowed, domain))
+                        continue
+                    if self.controller is not None and not self.controller.can_start(domain):
+                        # pushed again by `release`
+                        heapq.heappop(self.heap)
+                        self.blocked.add(domain)
+                        continue
+                    return self._pop(now)
+
+                if self.refill is not None and self._available(now) < self.low_water \
+                        and not self.refilling and now >= self.refill_after:
+                    self._refill()
+                    continue
+
+                wait = deadline - now
+                if wait <= 0:
+                    return None
+                if self.heap:
+                    wait = min(wait, self.heap[0][0] - now)
+                if self.retries:
+                    wait = min(wait, self.retries[0][0] - now)
+                if self.refill is not None and self.refill_after > now:
+                    wait = min(wait, self.refill_after - now)
+                self.cond.wait(wait)
+
+    def _pop(self, now):
+        _, domain = heapq.heappop(self.heap)
+        queue = self.queues[domain]
+        _, _, enqueued_at, row = heapq.heappop(queue)
+        self.buffered -= 1
+
+        self.next_allowed[domain] = now + self._delay(domain)
+        if queue:
+            heapq.heappush(self.heap, (self.next_allowed[domain], domain))
+        else:
+            del self.queues[domain]
+        if self.controller is not None:
+            self.controller.start(domain)
+
+        self.host_stats.setdefault(domain, HostStats()).record(now - enqueued_at)
+        return row
+
+    def _available(self, now):
+        """ Buffered rows not held back by a parked domain. """
+        if self.controller is None:
+            return self.buffered
+        return self.buffered - sum(len(self.queues.get(domain, ())) for domain in self.controller.parked_domains(now))
+
+    def record(self, row, latency, error=None):
+        """ Outcome of fetching `row`: a response after `latency` seconds, or
+            the exception `error`. Returns `True` if the row is fetched again
+            later, then the failure is not to be stored.
+        """
+        if self.controller is None:
+            return False
+        with self.cond:
+            domain = self.domain_of(row[1])
+            now = time.monotonic()
+            delay = self._delay(domain)
+            self.controller.record(domain, now, latency, error)
+            # a park or a longer interval applies from now on, a shorter one from the next request
+            allowed = max(self.next_allowed.get(domain, now), self.controller.parked_until(domain))
+            if self._delay(domain) > delay:
+                allowed = max(allowed, now + self._delay(domain))
+            self.next_allowed[domain] = allowed
+            if error is None:
+                self.attempts.pop(row[0], None)
+                return False
+            attempt = self.attempts.get(row[0], 0) + 1
+            delay = self.controller.retry.delay(attempt, error)
+            if delay is None:
+                self.attempts.pop(row[0], None)
+                return False
+            self.attempts[row[0]] = attempt
+            heapq.heappush(self.retries, (now + delay, next(self.seq), row))
+            self.cond.notify()
+            return True
+
+    def defer(self, row):
+        """ Seconds until `row`, of a domain that is down, is tried again, or
+            `None` once it used up its retries. Counts as a failed attempt.
+        """
+        if self.controller is None:
+            return None
+        with self.cond:
+            domain = self.domain_of(row[1])
+            attempt = self.attempts.get(row[0], 0) + 1
+            if attempt > self.controller.retry.retries:
+                self.attempts.pop(row[0], None)
+                return None
+            self.attempts[row[0]] = attempt
+            return max(0.0, self.controller.host(domain).down_until - time.monotonic())
+
+    def is_down(self, url):
+        """ Whether the domain of `url` is down, see `AdaptiveController`. """
+        if self.controller is None:
+            return False
+        with self.cond:
+            return self.controller.is_down(self.domain_of(url), time.monotonic())
+
+    def release(self, row):
+        """ The worker is done with `row`, another request to its domain may start. """
+        if self.controller is None:
+            return
+        with self.cond:
+            domain = self.domain_of(row[1])
+            self.controller.release(domain)
+            if domain in self.blocked and self.controller.can_start(domain):
+                self.blocked.discard(domain)
+                if self.queues.get(domain):
+                    heapq.heappush(self.heap, (self._allowed(domain, time.monotonic()), domain))
+                    self.cond.notify()
+
+    def _refill(self):
+        # called with the lock held, DB round trips happen without it
+        self.refilling = True
+        self.cond.release()
+        try:
+            rows = self.refill(self.batch_size)
+        except Exception as e:
+            print("Error while refilling scheduler", e)
+            rows = []
+        finally:
+            self.cond.acquire()
+            self.refilling = False
+
+        now = time.monotonic()
+        for row in rows:
+            self._put(row, now)
+        if not rows:
+            self.refill_after = now + self.refill_backoff
+        self.cond.notify_all()
+
+    def snapshot(self):
+        """ Crawl delays, remaining throttle time per domain and ids of the buffered rows. """
+        with self.cond:
+            now = time.monotonic()
+            throttled = {domain: allowed - now for domain, allowed in self.next_allowed.items() if allowed > now}
+            ids = [entry[3][0] for queue in self.queues.values() for entry in queue]
+            ids.extend(entry[2][0] for entry in self.retries)
+            return dict(self.delays), throttled, ids
+
+    def restore(self, delays, throttled, rows=()):
+        """ Load `snapshot` timers and buffer `rows`, domains stay throttled for the remaining time. """
+        with self.cond:
+            now = time.monotonic()
+            self.delays.update((domain, self._capped(delay)) for domain, delay in delays.items())
+            if self.controller is not None:
+                for domain, delay in delays.items():
+                    self.controller.set_delay(domain, self._capped(delay))
+            for domain, remaining in throttled.items():
+                self.next_allowed[domain] = max(self.next_allowed.get(domain, now), now + remaining)
+            for row in rows:
+                self._put(row, now)
+            self.cond.notify_all()
+
+    def stats(self):
+        """ Per-host queue depth and wait-time statistics. """
+        with self.cond:
+            now = time.monotonic()
+            domains = set(self.queues) | set(self.host_stats)
+            result = {}
+            for domain in domains:
+                stats = self.host_stats.get(domain, HostStats())
+                result[domain] = {
+                    "queued": len(self.queues.get(domain, ())),
+                    "dispatched": stats.dispatched,
+                    "avg_wait": stats.avg_wait,
+                    "max_wait": stats.max_wait,
+                    "throttled_for": max(0.0, self._allowed(domain, now) - now),
+                    "delay": self._delay(domain),
+                }
+                if self.controller is not None:
+                    result[domain].update(self.controller.stats(domain))
+            return result
+
+    def report(self):
+        stats = self.stats()
+        print("%-30s %7s %10s %9s %9s %7s %6s %7s" %
+              ("domain", "queued", "dispatched", "avg wait", "max wait", "delay", "limit", "errors"))
+        for domain in sorted(stats, key=lambda d: -stats[d]["queued"]):
+            s = stats[domain]
+            print("%-30s %7d %10d %8.2fs %8.2fs %6.2fs %6d %7d" % (domain, s["queued"], s["dispatched"], s["avg_wait"],
+                                                                  s["max_wait"], s["delay"], s.get("limit", 1),
+                                                                  s.get("errors", 0)))
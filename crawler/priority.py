@@ -0,0 +1,58 @@
+""" Frontier priorities
+
+A frontier url starts with a static score from its depth (links followed from
+a seed), sitemap membership and url pattern rules. On top of that it collects
+OPIC cash: every crawled page hands one unit of cash, split evenly, to the
+pages it links to, so urls linked from many pages rise in the frontier.
+
+Scores are stored in `crawldb.page.priority` and frontier rows are claimed in
+`priority DESC, id` order (a partial index serves the top rows), so a
+restarted crawl resumes in the same order.
+"""
+
+import re
+
+
+CASH_PER_PAGE = 1.0
+
+# (pattern, weight) applied to the lower-cased url, all matching rules add up
+DEFAULT_RULES = (
+    (r"^https?://[^/]+/?$", 2.0),                                  # site root
+    (r"/(sl/)?(novice|aktualno|sporocila|obvestila|storitve|podrocja|zakonodaja)\b", 1.0),
+    (r"/(en|de|it|hu)/", -0.5),                                     # translations of pages we already get
+    (r"[?&](page|stran|start|offset|sort|order|print|lang)=", -1.0),
+    (r"/(tag|tags|iskanje|search|koledar|calendar|arhiv|archive)\b", -1.0),
+    (r"/(login|prijava|registracija|wp-admin)\b", -2.0),
+    (r"\?", -0.5),
+)
+
+
+class PriorityScorer:
+    def __init__(self, rules=DEFAULT_RULES, depth_weight=1.0, sitemap_bonus=1.0, cash_weight=1.0):
+        self.rules = [(re.compile(pattern), weight) for pattern, weight in rules]
+        self.depth_weight = depth_weight
+        self.sitemap_bonus = sitemap_bonus
+        self.cash_weight = cash_weight
+
+    def rule_score(self, url: str):
+        url = url.lower()
+        return sum(weight for pattern, weight in self.rules if pattern.search(url))
+
+    def score(self, url: str, depth=0, in_sitemap=False):
+        """ Static priority of a newly discovered `url`. """
+        return (self.depth_weight / (1 + (depth or 0)) +
+                (self.sitemap_bonus if in_sitemap else 0.0) +
+                self.rule_score(url))
+
+    def cash(self, links):
+        """ `{to_id: cash}` handed out by newly stored `(from_id, to_id)` links. """
+        outlinks = {}
+        for from_id, _ in links:
+            outlinks[from_id] = outlinks.get(from_id, 0) + 1
+        cash = {}
+        for from_id, to_id in links:
+            cash[to_id] = cash.get(to_id, 0.0) + self.cash_weight * CASH_PER_PAGE / outlinks[from_id]
+        return cash
+
+
+default_scorer = PriorityScorer()
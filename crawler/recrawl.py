@@ -0,0 +1,87 @@
+""" Incremental recrawl
+
+Every stored HTML page keeps its `ETag`/`Last-Modified` validators and an
+estimate of how often it changes in `crawldb.page_revisit`. Pages whose next
+visit is due are put back into the frontier and fetched with a conditional
+request, so an unchanged page costs a 304 (or, without validators, only a
+hash comparison) instead of a full rewrite of the page and its links.
+
+The change rate is the estimator of Cho and Garcia-Molina for pages visited
+at (roughly) regular intervals: with `n` revisits of which `x` found the page
+changed, `rate = -ln((n - x + 0.5) / (n + 0.5)) / mean interval`. A page is
+revisited once it has changed with probability `target`.
+"""
+
+import math
+import datetime
+
+
+DEFAULT_RATE = 1 / 7  # changes per day assumed for a page visited only once
+
+
+class Revisit:
+    """ What is known about a stored page before fetching it again. """
+
+    def __init__(self, page_id, etag, last_modified, hash, visits, changes, observed_days, accessed_time):
+        self.page_id = page_id
+        self.etag = etag
+        self.last_modified = last_modified
+        self.hash = hash
+        self.visits = visits
+        self.changes = changes
+        self.observed_days = observed_days
+        self.accessed_time = accessed_time
+
+    def headers(self):
+        """ Conditional request headers. """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class RecrawlPolicy:
+    def __init__(self, target=0.5, min_days=1.0, max_days=30.0, default_rate=DEFAULT_RATE):
+        self.target = target
+        self.min_days = min_days
+        self.max_days = max_days
+        self.default_rate = default_rate
+
+    def change_rate(self, intervals, changes, observed_days):
+        """ Estimated changes per day after `changes` of `intervals` revisits. """
+        if intervals <= 0 or observed_days <= 0:
+            return self.default_rate
+        mean_interval = observed_days / intervals
+        return max(0.0, -math.log((intervals - changes + 0.5) / (intervals + 0.5)) / mean_interval)
+
+    def interval(self, rate):
+        """ Days until the page has changed with probability `target`. """
+        if rate <= 0:
+            return self.max_days
+        days = -math.log(1 - self.target) / rate
+        return min(self.max_days, max(self.min_days, days))
+
+    def visit(self, page_id, revisit: Revisit, changed, accessed_time, etag=None, last_modified=None):
+        """ `crawldb.page_revisit` row after visiting `page_id` at `accessed_time`.
+
+            `revisit` is `None` on the first visit. Missing validators keep the
+            stored ones, a 304 usually omits them.
+        """
+        if revisit is None:
+            visits, changes, observed_days = 1, 0, 0.0
+        else:
+            elapsed = (accessed_time - revisit.accessed_time).total_seconds() / 86400 if revisit.accessed_time else 0
+            visits = revisit.visits + 1
+            changes = revisit.changes + bool(changed)
+            observed_days = revisit.observed_days + max(0.0, elapsed)
+            etag = etag or revisit.etag
+            last_modified = last_modified or revisit.last_modified
+
+        rate = self.change_rate(visits - 1, changes, observed_days)
+        next_visit = accessed_time + datetime.timedelta(days=self.interval(rate))
+        return page_id, etag, last_modified, visits, changes, observed_days, rate, next_visit
+
+
+default_policy = RecrawlPolicy()
@@ -0,0 +1,325 @@
+""" Optional Selenium rendering
+
+HTML is parsed from the `requests` body by default. A page is rendered in
+headless Chrome only when it looks JavaScript dependent, when its domain is
+configured to always render, or while a domain is being sampled: the first
+few pages of every domain are rendered and the link counts of both versions
+are compared to decide whether the domain needs rendering at all.
+"""
+
+import os
+import re
+import sys
+import time
+import threading
+
+from contextlib import contextmanager
+
+from selenium import webdriver
+from selenium.webdriver.chrome.options import Options
+
+from crawler.metrics import metrics
+
+
+_script = re.compile(r"<script\b", re.I)
+_link = re.compile(r"<a\b[^>]*\bhref\s*=", re.I)
+_body = re.compile(r"<body\b[^>]*>(.*)</body>", re.I | re.S)
+_strip = re.compile(r"<script\b.*?</script>|<style\b.*?</style>|<[^>]+>", re.I | re.S)
+_app_markers = re.compile(
+    r"\bng-app\b|data-reactroot|<app-root|id=[\"'](?:root|app)[\"']\s*>\s*</div>|<noscript>[^<]*javascript",
+    re.I)
+
+
+ALWAYS, NEVER, AUTO = "always", "never", "auto"
+
+
+def chrome_driver():
+    chrome_options = Options()
+    chrome_options.add_argument("--headless")
+    chrome_options.add_argument('--ignore-certificate-errors')
+    # chrome_options.accept_untrusted_certs = True
+
+    if sys.platform == "win32":
+        driver_path = os.path.join(os.getcwd(), "chromedriver.exe")
+    else:
+        driver_path = os.path.join(os.getcwd(), "chromedriver")
+
+    driver = webdriver.Chrome(driver_path, options=chrome_options)
+    driver.set_page_load_timeout(10)
+    return driver
+
+
+def count_links(document: str):
+    return len(_link.findall(document))
+
+
+def looks_js_dependent(document: str):
+    """ Cheap check whether static `document` needs JavaScript to show content. """
+    if _app_markers.search(document):
+        return True
+
+    scripts = len(_script.findall(document))
+    if not scripts:
+        return False
+
+    match = _body.search(document)
+    text = _strip.sub(" ", match.group(1) if match else document)
+    # almost no visible text, or hardly any links next to a lot of script
+    return len(text.split()) < 30 or (count_links(document) < 2 and scripts >= 3)
+
+
+def process_tree_rss(pid: int):
+    """ Resident memory in bytes of process `pid` and all its descendants (Linux only). """
+    children = {}
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else ():
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % entry) as fp:
+                # the command name may contain spaces, fields after it are fixed
+                ppid = int(fp.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    rss, stack = 0, [pid]
+    page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+    while stack:
+        current = stack.pop()
+        try:
+            with open("/proc/%d/statm" % current) as fp:
+                rss += int(fp.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            pass
+        stack.extend(children.get(current, ()))
+    return rss
+
+
+class PooledDriver:
+    def __init__(self, driver):
+        self.driver = driver
+        self.pages = 0
+
+    @property
+    def pid(self):
+        try:
+            return self.driver.service.process.pid
+        except AttributeError:
+            return None
+
+    def alive(self):
+        try:
+            process = self.driver.service.process
+            if process is not None and process.poll() is not None:
+                return False
+            self.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def memory(self):
+        pid = self.pid
+        return process_tree_rss(pid) if pid else 0
+
+    def quit(self):
+        try:
+            self.driver.quit()
+        except Exception as e:
+            print("Error while quitting Chrome driver", e)
+
+
+class DriverPool:
+    """ At most `size` Chrome drivers, leased to workers one at a time.
+
+        A driver is replaced after `max_pages` pages, when Chrome and its
+        children use more than `max_memory` bytes (checked every
+        `memory_check_every` pages) or when it has crashed.
+    """
+
+    def __init__(self, size=2, factory=chrome_driver, max_pages=500, max_memory=1024 * 2 ** 20,
+                 memory_check_every=25):
+        self.size = size
+        self.factory = factory
+        self.max_pages = max_pages
+        self.max_memory = max_memory
+        self.memory_check_every = memory_check_every
+
+        self.cond = threading.Condition()
+        self.idle = []
+        self.created = 0
+        self.closed = False
+
+        self.leases = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recycled = {"pages": 0, "memory": 0, "crashed": 0}
+
+    @contextmanager
+    def lease(self):
+        start = time.monotonic()
+        pooled = self._acquire()
+        wait = time.monotonic() - start
+        self._record_wait(wait)
+        metrics.observe("render_wait", wait)
+
+        failed = False
+        try:
+            yield pooled.driver
+        except Exception:
+            failed = True
+            raise
+        finally:
+            pooled.pages += 1
+            reason = self._recycle_reason(pooled, failed)
+            if reason:
+                self._discard(pooled, reason)
+            else:
+                self._release(pooled)
+
+    def _acquire(self):
+        with self.cond:
+            while True:
+                if self.idle:
+                    return self.idle.pop()
+                if self.created < self.size:
+                    self.created += 1
+                    break
+                self.cond.wait()
+        try:
+            return PooledDriver(self.factory())
+        except Exception:
+            with self.cond:
+                self.created -= 1
+                self.cond.notify()
+            raise
+
+    def _recycle_reason(self, pooled, failed):
+        if failed and not pooled.alive():
+            return "crashed"
+        if pooled.pages >= self.max_pages:
+            return "pages"
+        if self.max_memory and pooled.pages % self.memory_check_every == 0 \
+                and pooled.memory() > self.max_memory:
+            return "memory"
+        return None
+
+    def _release(self, pooled):
+        with self.cond:
+            if self.closed:
+                self.created -= 1
+            else:
+                self.idle.append(pooled)
+                self.cond.notify()
+                return
+        pooled.quit()
+
+    def _discard(self, pooled, reason):
+        pooled.quit()
+        with self.cond:
+            self.created -= 1
+            self.recycled[reason] += 1
+            self.cond.notify()
+
+    def _record_wait(self, wait):
+        with self.cond:
+            self.leases += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def stats(self):
+        with self.cond:
+            return {
+                "drivers": self.created,
+                "idle": len(self.idle),
+                "leases": self.leases,
+                "avg_wait": self.total_wait / self.leases if self.leases else 0.0,
+                "max_wait": self.max_wait,
+                "recycled": dict(self.recycled),
+            }
+
+    def report(self):
+        stats = self.stats()
+        print("Chrome pool: %d leases, avg wait %.2fs, max wait %.2fs, recycled %s" %
+              (stats["leases"], stats["avg_wait"], stats["max_wait"], stats["recycled"]))
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            idle, self.idle = self.idle, []
+            self.created -= len(idle)
+        for pooled in idle:
+            pooled.quit()
+
+
+class RenderPolicy:
+    """ Decides per page whether to render, learning a rule for every domain. """
+
+    def __init__(self, always=(), never=(), sample=3, link_gap=1.5, default=None):
+        # `default` applies to domains without a rule instead of sampling them
+        self.default = default
+        self.rules = {domain: ALWAYS for domain in always}
+        self.rules.update((domain, NEVER) for domain in never)
+        self.sample = sample
+        self.link_gap = link_gap
+        self.samples = {}  # domain -> [pages, static links, rendered links]
+        self.lock = threading.Lock()
+
+    def should_render(self, domain, document):
+        with self.lock:
+            rule = self.rules.get(domain, self.default)
+        if rule is None:
+            # still sampling this domain
+            return True
+        if rule == AUTO:
+            return looks_js_dependent(document)
+        return rule == ALWAYS
+
+    def learn(self, domain, static_document, rendered_document):
+        with self.lock:
+            if domain in self.rules:
+                return
+            sample = self.samples.setdefault(domain, [0, 0, 0])
+            sample[0] += 1
+            sample[1] += count_links(static_document)
+            sample[2] += count_links(rendered_document)
+            if sample[0] >= self.sample:
+                self.rules[domain] = ALWAYS if sample[2] > self.link_gap * sample[1] + 1 else AUTO
+                del self.samples[domain]
+
+
+class Renderer:
+    """ Selenium rendering with a Chrome pool sized independently of the fetch workers. """
+
+    def __init__(self, pool: DriverPool, policy: RenderPolicy = None):
+        self.pool = pool
+        self.policy = policy or RenderPolicy()
+        self.lock = threading.Lock()
+        self.pages = 0
+        self.rendered = 0
+
+    def document_for(self, url: str, domain: str, document: str):
+        """ `document` as fetched, or the page source rendered by Chrome. """
+        render = self.policy.should_render(domain, document)
+        with self.lock:
+            self.pages += 1
+            self.rendered += render
+        if not render:
+            return document
+
+        with self.pool.lease() as driver, metrics.timer("render"):
+            driver.get(url)
+            rendered = driver.page_source
+        self.policy.learn(domain, document, rendered)
+        return rendered
+
+    @property
+    def rendered_fraction(self):
+        return self.rendered / self.pages if self.pages else 0.0
+
+    def report(self):
+        print("Rendered %d of %d HTML pages with Chrome (%.1f%%)" %
+              (self.rendered, self.pages, 100 * self.rendered_fraction))
+        self.pool.report()
+
+    def close(self):
+        self.pool.close()
@@ -0,0 +1,89 @@
+""" Process-wide cache of parsed robots.txt rules and site metadata
+
+Once a domain is known, `Worker.site_info` answers from memory: no DB query
+and no robots.txt parsing. After `ttl` seconds an entry expires and robots.txt
+is fetched again; the least recently used domains are evicted beyond
+`max_size` entries.
+"""
+
+import time
+import threading
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib import robotparser
+
+
+DEFAULT_CRAWL_DELAY = 4
+
+
+class SiteInfo:
+    def __init__(self, site_id, parser: robotparser.RobotFileParser = None):
+        self.site_id = site_id
+        self.parser = parser
+        # `Crawl-delay` of robots.txt, `None` without one (the scheduler then picks the delay)
+        self.crawl_delay = None
+        if parser is not None:
+            try:
+                crawl_delay = parser.crawl_delay('*')
+                if crawl_delay is not None:
+                    self.crawl_delay = int(crawl_delay)
+            except (AttributeError, ValueError):
+                pass
+        self.loaded_at = time.monotonic()
+
+    def allows(self, url: str):
+        return self.parser is None or self.parser.can_fetch("*", url)
+
+
+class SiteCache:
+    def __init__(self, ttl=3600, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # domain -> SiteInfo, least recently used first
+        self.loading_locks = {}  # domain -> [lock, threads loading or waiting for it]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, domain):
+        with self.lock:
+            info = self.entries.get(domain)
+            if info is None or time.monotonic() - info.loaded_at > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(domain)
+            self.hits += 1
+            return info
+
+    def expired(self, domain):
+        """ Whether `domain` was loaded before but its entry is older than `ttl`. """
+        with self.lock:
+            info = self.entries.get(domain)
+            return info is not None and time.monotonic() - info.loaded_at > self.ttl
+
+    def put(self, domain, info: SiteInfo):
+        with self.lock:
+            self.entries[domain] = info
+            self.entries.move_to_end(domain)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return info
+
+    @contextmanager
+    def loading(self, domain):
+        """ Serialize loading of one domain so it is fetched and inserted only once. """
+        with self.lock:
+            loading = self.loading_locks.setdefault(domain, [threading.Lock(), 0])
+            loading[1] += 1
+        try:
+            with loading[0]:
+                yield
+        finally:
+            with self.lock:
+                loading[1] -= 1
+                if not loading[1]:
+                    del self.loading_locks[domain]
+
+
+site_cache = SiteCache()
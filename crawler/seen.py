@@ -0,0 +1,139 @@
+""" Seen-URL set shared by all workers
+
+A Bloom filter answers "definitely not seen" without touching the database.
+Only URLs the filter reports as possibly seen are confirmed against
+`crawldb.page`, with one query per batch of URLs.
+
+    python -m crawler.seen 10000000
+"""
+
+import sys
+import math
+import time
+import hashlib
+import threading
+
+from crawler.storage import Storage
+
+
+DEFAULT_CAPACITY = 10000000
+DEFAULT_ERROR_RATE = 0.01
+
+
+class BloomFilter:
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.capacity = capacity
+        self.size = int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        # Kirsch-Mitzenmacher double hashing over one 128 bit digest
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        """ Add `key`, return `True` if it was not (reported as) present before. """
+        added = False
+        for position in self._positions(key):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                added = True
+        if added:
+            self.count += 1
+        return added
+
+    def __contains__(self, key: str):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(key))
+
+    @property
+    def memory(self):
+        """ Size of the bit array in bytes. """
+        return len(self.bits)
+
+    def error_rate(self, count=None):
+        """ Expected false-positive rate after `count` insertions. """
+        count = self.count if count is None else count
+        return (1 - math.exp(-self.hashes * count / self.size)) ** self.hashes
+
+
+class SeenUrls:
+    """ Thread-safe seen-URL filter, confirmed against the DB on a hit. """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, error_rate=DEFAULT_ERROR_RATE):
+        self.bloom = BloomFilter(capacity, error_rate)
+        self.lock = threading.Lock()
+        self.lookups = 0
+        self.db_confirmations = 0
+        self.false_positives = 0
+
+    def warm(self, conn: Storage, since_id=0):
+        """ Load every url stored in `crawldb.page` (with an id above `since_id`). """
+        start = time.time()
+        for url in conn.iter_urls(since_id=since_id):
+            self.add(url)
+        print("Loaded %d urls into seen-set in %.1fs (%.1f MB)" %
+              (self.bloom.count, time.time() - start, self.bloom.memory / 2 ** 20))
+
+    def snapshot(self):
+        with self.lock:
+            return self.bloom.size, self.bloom.hashes, bytes(self.bloom.bits), self.bloom.count
+
+    def restore(self, state):
+        """ Load a `snapshot`, returns `False` if it was taken with other filter parameters. """
+        size, hashes, bits, count = state
+        with self.lock:
+            if (size, hashes) != (self.bloom.size, self.bloom.hashes):
+                return False
+            self.bloom.bits = bytearray(bits)
+            self.bloom.count = count
+        return True
+
+    def add(self, url: str):
+        with self.lock:
+            self.bloom.add(url)
+
+    def filter_unseen(self, urls, conn: Storage):
+        """ Unique `urls` (in order) that are not stored in `crawldb.page`. """
+        urls = list(dict.fromkeys(urls))
+        with self.lock:
+            maybe = [url for url in urls if url in self.bloom]
+            self.lookups += len(urls)
+
+        if not maybe:
+            return urls
+
+        confirmed = set(conn.existing_urls(maybe))
+        with self.lock:
+            self.db_confirmations += 1
+            self.false_positives += len(maybe) - len(confirmed)
+        return [url for url in urls if url not in confirmed]
+
+    def contains(self, url: str, conn: Storage):
+        return not self.filter_unseen([url], conn)
+
+
+if __name__ == "__main__":
+    # memory footprint and false-positive rate of the filter at `n` urls
+    n = int(sys.argv[1]) if len(sys.argv) >= 2 else DEFAULT_CAPACITY
+    bloom = BloomFilter(capacity=n)
+
+    start = time.time()
+    for i in range(n):
+        bloom.add("http://www.gov.si/page/%d" % i)
+    elapsed = time.time() - start
+
+    probes = 100000
+    false_positives = sum("http://www.gov.si/other/%d" % i in bloom for i in range(probes))
+
+    print("urls:               %d" % n)
+    print("bits / hashes:      %d / %d" % (bloom.size, bloom.hashes))
+    print("memory:             %.1f MB (%.1f bits per url)" % (bloom.memory / 2 ** 20, bloom.size / n))
+    print("insert rate:        %.0f urls/sec" % (n / elapsed))
+    print("expected FP rate:   %.4f" % bloom.error_rate())
+    print("measured FP rate:   %.4f (%d probes)" % (false_positives / probes, probes))
@@ -0,0 +1,67 @@
+""" Domain-sharded crawl across processes or nodes
+
+Every domain hashes (`crawldb.url_shard`) to exactly one of N shards and only
+that shard claims the domain's frontier rows, so its robots rules and
+politeness timers live in one process. Shards coordinate only through the
+`crawldb` schema, so they may run on one machine or on many.
+
+    python -m crawler.shard --processes 4 8              # 4 local shards with 8 workers each
+    python -m crawler.shard --shard 0 --shards 8 --setup 8   # shard 0 of 8 on this node
+    python -m crawler.shard --shard 1 --shards 8 8           # ... shard 1 on another node
+"""
+
+import sys
+import argparse
+import multiprocessing
+
+from crawler.storage import configure, connect
+from crawler.urls import Scope, url_engine
+from crawler.web_crawler import argument_parser, crawl, prepare_frontier
+
+
+def run_shard(crawler_argv, index, count, setup=False):
+    args = argument_parser().parse_args(crawler_argv)
+    print("Shard %d/%d starting" % (index, count))
+    crawl(args, shard=(index, count), setup=setup)
+    print("Shard %d/%d finished" % (index, count))
+
+
+def run_local(crawler_argv, processes):
+    """ Seed the frontier once, then run `processes` shards as local processes. """
+    args = argument_parser().parse_args(crawler_argv)
+    configure(args.backend, args.sqlite_path, args.html_storage)
+    url_engine.configure(Scope(args.scope))
+    api = connect()
+    prepare_frontier(api, recrawl=args.recrawl)
+    api.close()
+
+    shards = [
+        multiprocessing.Process(target=run_shard, args=(crawler_argv, index, processes), name="shard-%d" % index)
+        for index in range(processes)
+    ]
+    for process in shards:
+        process.start()
+    for process in shards:
+        process.join()
+    return max(process.exitcode for process in shards)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Domain-sharded crawl; other arguments go to the crawler.")
+    parser.add_argument("--processes", type=int, help="run this many shards as local processes")
+    parser.add_argument("--shard", type=int, help="index of the single shard to run on this node")
+    parser.add_argument("--shards", type=int, help="total number of shards across all nodes")
+    parser.add_argument("--setup", action="store_true",
+                        help="with --shard: requeue interrupted pages and seed the frontier first")
+    args, crawler_argv = parser.parse_known_args(argv)
+
+    if args.processes:
+        return run_local(crawler_argv, args.processes)
+    if args.shard is None or not args.shards or not 0 <= args.shard < args.shards:
+        parser.error("either --processes or a valid --shard/--shards pair is required")
+    run_shard(crawler_argv, args.shard, args.shards, setup=args.setup)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
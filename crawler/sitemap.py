@@ -1,14 +1,176 @@
-# https://github.com/stchris/untangle
-import untangle
-
-
-def parse_xml(xml: str):
-    tree = untangle.parse(xml)
-    urlset = tree.urlset
-    if not urlset:
-        return []
-    urls = urlset.url
-    if not urls:
-        return []
-    sitemap_urls = [url.loc.cdata for url in urls]
-    return sitemap_urls
+""" Streaming sitemap ingestion
+
+Sitemaps are fetched by a small thread pool and parsed incrementally with
+`iterparse`, so a 50k url sitemap (plain or gzip) never exists as a tree in
+memory. `<sitemapindex>` files are followed; children whose `<lastmod>` is
+not newer than the previous ingestion are skipped. Urls are handed to the
+caller in chunks through a bounded queue, ready for bulk frontier inserts.
+
+    reader = SitemapReader()
+    for chunk in reader.urls(["https://www.gov.si/sitemap.xml"]):
+        ...  # [(url, lastmod or None), ...]
+"""
+
+import io
+import gzip
+import queue
+import datetime
+import threading
+
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from xml.etree.ElementTree import iterparse
+
+from crawler.client import http_client
+
+
+DEFAULT_THREADS = 4
+CHUNK_SIZE = 1000
+MAX_SITEMAPS = 1000
+
+_GZIP_MAGIC = b"\x1f\x8b"
+
+
+@lru_cache(maxsize=4096)
+def parse_lastmod(value):
+    """ W3C datetime of a `<lastmod>` as a naive local datetime, or `None`. """
+    if not value:
+        return None
+    value = value.strip()
+    if value.endswith("Z"):
+        value = value[:-1] + "+00:00"
+    try:
+        parsed = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        # stored times (`accessed_time`) are naive local times
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed
+
+
+def sitemap_locations(robots_lines):
+    """ Sitemap urls listed in robots.txt. """
+    locations = []
+    for line in robots_lines:
+        name, _, value = line.partition(":")
+        if name.strip().lower() == "sitemap" and value.strip():
+            locations.append(value.strip())
+    return locations
+
+
+def iter_sitemap(fp):
+    """ Yield `(kind, loc, lastmod)` for every `<url>` (kind "url") or `<sitemap>`
+        (kind "sitemap") entry of a plain or gzip compressed sitemap stream.
+    """
+    fp = io.BufferedReader(fp) if not hasattr(fp, "peek") else fp
+    if fp.peek(2)[:2] == _GZIP_MAGIC:
+        fp = gzip.GzipFile(fileobj=fp)
+
+    root = None
+    loc = lastmod = None
+    for event, element in iterparse(fp, events=("start", "end")):
+        if root is None:
+            root = element
+            continue
+        if event != "end":
+            continue
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag == "loc":
+            loc = (element.text or "").strip()
+        elif tag == "lastmod":
+            lastmod = parse_lastmod(element.text)
+        elif tag in ("url", "sitemap"):
+            if loc:
+                yield tag, loc, lastmod
+            loc = lastmod = None
+            # drop parsed entries, memory stays bounded by one entry
+            root.clear()
+
+
+class SitemapReader:
+    def __init__(self, threads=DEFAULT_THREADS, chunk_size=CHUNK_SIZE, max_sitemaps=MAX_SITEMAPS, timeout=10,
+                 get=None):
+        self.threads = threads
+        self.chunk_size = chunk_size
+        self.max_sitemaps = max_sitemaps
+        self.timeout = timeout
+        self.get = get or http_client.get
+
+    def urls(self, locations, since=None):
+        """ Yield chunks of `(url, lastmod)` from the sitemaps at `locations`,
+            following sitemap indexes. With `since`, indexed sitemaps that were
+            not modified after it are skipped.
+        """
+        chunks = queue.Queue(maxsize=2 * self.threads)
+        lock = threading.Lock()
+        # one pending count is held by the caller until all `locations` are submitted,
+        # a location failing fast must not finish the reading before the next one starts
+        state = {"pending": 1, "started": 0, "closed": False}
+        done = object()
+
+        def finish():
+            with lock:
+                state["pending"] -= 1
+                finished = state["pending"] == 0
+            if finished:
+                chunks.put(done)
+
+        def submit(location):
+            with lock:
+                if state["started"] >= self.max_sitemaps:
+                    return
+                state["started"] += 1
+                state["pending"] += 1
+            executor.submit(read, location)
+
+        def read(location):
+            try:
+                chunk = []
+                for kind, loc, lastmod in self._entries(location):
+                    if state["closed"]:
+                        break
+                    if kind == "sitemap":
+                        if since is None or lastmod is None or lastmod > since:
+                            submit(loc)
+                        continue
+                    chunk.append((loc, lastmod))
+                    if len(chunk) >= self.chunk_size:
+                        chunks.put(chunk)
+                        chunk = []
+                if chunk:
+                    chunks.put(chunk)
+            except Exception as e:
+                # runs in the pool, nobody else would see the error
+                print("Error reading sitemap {}".format(location), e)
+            finally:
+                finish()
+
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            for location in dict.fromkeys(locations):
+                submit(location)
+            finish()
+            chunk = None
+            try:
+                while True:
+                    chunk = chunks.get()
+                    if chunk is done:
+                        break
+                    yield chunk
+            finally:
+                # the caller may stop early, unblock the readers and let them finish
+                state["closed"] = True
+                while chunk is not done:
+                    chunk = chunks.get()
+
+    def _entries(self, location):
+        response = self.get(location, timeout=self.timeout, stream=True)
+        try:
+            response.raise_for_status()
+            # undo Content-Encoding, `iter_sitemap` handles gzip files itself
+            response.raw.decode_content = True
+            # the buffered reader in `iter_sitemap` may read again after the last byte
+            response.raw.auto_close = False
+            yield from iter_sitemap(response.raw)
+        finally:
+            response.close()
@@ -0,0 +1,469 @@
+""" Embedded SQLite storage backend
+
+The crawldb tables in one local file, for single-node crawls and tests that
+should not need a database server. The database runs in WAL mode, so readers
+never block the single writer; every connection (one per worker thread)
+writes in autocommit mode or short `BEGIN IMMEDIATE` transactions, never
+holding the write lock across a fetch. HTML bodies are stored zlib
+compressed in `page`, or with `html_storage="dedup"` once per unique body in
+the `content` table (see `crawler.bodies`).
+
+    python -m crawler.web_crawler --backend sqlite --sqlite-path crawl.sqlite 8
+"""
+
+import re
+import json
+import time
+import zlib
+import sqlite3
+import datetime
+import threading
+
+from contextlib import contextmanager
+
+from crawler.storage import Storage, DEFAULT_LEASE, DEFAULT_SQLITE_PATH
+from crawler.utils import WriteBatch
+
+
+DEFAULT_COMPRESS_LEVEL = 6
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS site (
+        id                   INTEGER PRIMARY KEY,
+        "domain"             TEXT UNIQUE,
+        robots_content       TEXT,
+        sitemap_content      TEXT,
+        sitemap_time         timestamp
+    );
+
+    CREATE TABLE IF NOT EXISTS page (
+        id                   INTEGER PRIMARY KEY,
+        site_id              INTEGER,
+        page_type_code       TEXT,
+        url                  TEXT UNIQUE,
+        html_content         BLOB,
+        http_status_code     INTEGER,
+        accessed_time        timestamp,
+        duplicate_page_id    INTEGER,
+        is_binary            INTEGER,
+        hash                 INTEGER,
+        simhash              INTEGER,
+        "depth"              INTEGER,
+        priority             REAL NOT NULL DEFAULT 0,
+        leased_by            TEXT,
+        lease_expires        REAL,
+        content_hash         INTEGER
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_page_site_id ON page ( site_id );
+    CREATE INDEX IF NOT EXISTS idx_page_frontier ON page ( priority DESC, id ) WHERE page_type_code = 'FRONTIER';
+    CREATE INDEX IF NOT EXISTS idx_page_leases ON page ( lease_expires ) WHERE page_type_code = 'IN PROGRESS';
+    CREATE INDEX IF NOT EXISTS idx_page_hash ON page ( hash ) WHERE hash IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS idx_page_type_accessed ON page ( page_type_code, accessed_time );
+
+    CREATE TABLE IF NOT EXISTS page_revisit (
+        page_id              INTEGER PRIMARY KEY,
+        etag                 TEXT,
+        last_modified        TEXT,
+        visits               INTEGER NOT NULL DEFAULT 1,
+        changes              INTEGER NOT NULL DEFAULT 0,
+        observed_days        REAL NOT NULL DEFAULT 0,
+        change_rate          REAL,
+        next_visit           timestamp
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_page_revisit_next_visit ON page_revisit ( next_visit );
+
+    CREATE TABLE IF NOT EXISTS content_dictionary (
+        id                   INTEGER PRIMARY KEY,
+        site_id              INTEGER,
+        codec                TEXT NOT NULL,
+        "data"               BLOB NOT NULL
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_content_dictionary_site_id ON content_dictionary ( site_id, codec );
+
+    CREATE TABLE IF NOT EXISTS content (
+        id                   INTEGER PRIMARY KEY,
+        hash                 INTEGER NOT NULL UNIQUE,
+        codec                TEXT NOT NULL,
+        dictionary_id        INTEGER,
+        size                 INTEGER NOT NULL,
+        "data"               BLOB NOT NULL
+    );
+
+    CREATE TABLE IF NOT EXISTS page_data (
+        id                   INTEGER PRIMARY KEY,
+        page_id              INTEGER,
+        data_type_code       TEXT,
+        "data"               BLOB,
+        blob_key             TEXT
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_page_data_page_id ON page_data ( page_id );
+
+    CREATE TABLE IF NOT EXISTS image (
+        id                   INTEGER PRIMARY KEY,
+        page_id              INTEGER,
+        filename             TEXT,
+        content_type         TEXT,
+        "data"               BLOB,
+        accessed_time        timestamp,
+        blob_key             TEXT
+    );
+
+    CREATE INDEX IF NOT EXISTS idx_image_page_id ON image ( page_id );
+
+    CREATE TABLE IF NOT EXISTS link (
+        from_page            INTEGER NOT NULL,
+        to_page              INTEGER NOT NULL,
+        PRIMARY KEY ( from_page, to_page )
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_link_to_page ON link ( to_page );
+"""
+
+# a list parameter, e.g. `"id IN " + _EACH` with `_list(page_ids)` as its value
+_EACH = "(SELECT value FROM json_each(?))"
+
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("timestamp", lambda value: datetime.datetime.fromisoformat(value.decode()))
+
+_initialized = set()
+_init_lock = threading.Lock()
+
+
+def _list(values):
+    return json.dumps(list(values))
+
+
+_host_end = re.compile(r"[/:?#]")
+
+
+def url_shard(url, shards):
+    """ Shard (0 .. shards - 1) owning the domain of `url`, domains are compared without `www.`. """
+    # the host ends where `crawldb.url_shard` ends it: at a path, port, query or fragment
+    domain = _host_end.split(url.split("://", 1)[-1], 1)[0].lower()
+    if domain.startswith("www."):
+        domain = domain[4:]
+    return zlib.crc32(domain.encode("utf-8")) % shards
+
+
+class SqliteApi(Storage):
+    def __init__(self, path=DEFAULT_SQLITE_PATH, compress_level=DEFAULT_COMPRESS_LEVEL, html_storage="inline"):
+        self.path = path
+        self.compress_level = compress_level
+        self.html_storage = html_storage
+        # autocommit: statements outside `_transaction` never hold the write lock
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False,
+                                          detect_types=sqlite3.PARSE_DECLTYPES)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.create_function("url_shard", 2, url_shard, deterministic=True)
+        self.cursor = self.connection.cursor()
+        self.commits = 0
+        with _init_lock:
+            if path not in _initialized:
+                self.connection.executescript(SCHEMA)
+                columns = [row[1] for row in self.connection.execute("PRAGMA table_info(page)")]
+                if "content_hash" not in columns:
+                    # a file created before the `content` table
+                    self.connection.execute("ALTER TABLE page ADD COLUMN content_hash INTEGER")
+                _initialized.add(path)
+
+    @contextmanager
+    def _transaction(self):
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.cursor
+        except BaseException:
+            self.cursor.execute("ROLLBACK")
+            raise
+        self.cursor.execute("COMMIT")
+        self.commits += 1
+
+    def _compress(self, html_content):
+        if html_content is None:
+            return None
+        return zlib.compress(html_content.encode("utf-8"), self.compress_level)
+
+    @staticmethod
+    def _decompress(data):
+        return zlib.decompress(data).decode("utf-8") if data is not None else None
+
+    def _body(self, site_id, html_content):
+        """ `(html_content, content row)`: the compressed body for `page`, or with `dedup` its `content` row. """
+        if html_content is None or self.html_storage != "dedup":
+            return self._compress(html_content), None
+        return None, self.bodies.encode(site_id, html_content)
+
+    def _write_page(self, sql, data, body):
+        """ Execute the page write `sql`, with `body` in the same transaction; returns its first row. """
+        if body is None:
+            return self.cursor.execute(sql, data).fetchone()
+        with self._transaction() as cursor:
+            cursor.execute("INSERT OR IGNORE INTO content (hash, codec, dictionary_id, size, data) "
+                           "VALUES (?, ?, ?, ?, ?)", body)
+            return cursor.execute(sql, data).fetchone()
+
+    def _one(self, sql, data=()):
+        row = self.cursor.execute(sql, data).fetchone()
+        return row[0] if row else None
+
+    def _all(self, sql, data=()):
+        return self.cursor.execute(sql, data).fetchall()
+
+    # every statement commits on its own
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.connection.close()
+
+    def write_batch(self, batch: WriteBatch):
+        inserted = {}
+        with self._transaction() as cursor:
+            if batch.pages:
+                sources = batch.sources()
+                depths = {}
+                if sources:
+                    depths = dict(cursor.execute("SELECT id, coalesce(depth, 0) FROM page WHERE id IN " + _EACH,
+                                                 (_list(sources), )).fetchall())
+                for row in batch.frontier_rows(depths):
+                    new = cursor.execute("INSERT INTO page (site_id, page_type_code, url, is_binary, depth, priority) "
+                                         "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (url) DO NOTHING RETURNING id",
+                                         row).fetchone()
+                    if new:
+                        inserted[row[2]] = new[0]
+
+            if batch.links:
+                ids = dict(inserted)
+                missing = list({url for _, url in batch.links if url not in ids})
+                if missing:
+                    ids.update((url, id) for id, url in cursor.execute("SELECT id, url FROM page WHERE url IN " + _EACH,
+                                                                       (_list(missing), )))
+                links = []
+                for from_id, url in batch.links:
+                    if url in ids and cursor.execute("INSERT OR IGNORE INTO link (from_page, to_page) VALUES (?, ?) "
+                                                     "RETURNING from_page", (from_id, ids[url])).fetchone():
+                        links.append((from_id, ids[url]))
+                cursor.executemany("UPDATE page SET priority = priority + ? WHERE id = ? AND page_type_code = 'FRONTIER'",
+                                   [(cash, id) for id, cash in batch.scorer.cash(links).items()])
+
+            cursor.executemany("INSERT INTO image (page_id, filename, content_type, data, accessed_time, blob_key) "
+                               "VALUES (?, ?, ?, ?, ?, ?)", batch.images)
+            cursor.executemany("INSERT INTO page_data (page_id, data_type_code, data, blob_key) VALUES (?, ?, ?, ?)",
+                               batch.page_data)
+            cursor.executemany("INSERT INTO page_revisit (page_id, etag, last_modified, visits, changes, observed_days, change_rate, next_visit) "
+                               "VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+                               "ON CONFLICT (page_id) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified, "
+                               "visits = excluded.visits, changes = excluded.changes, observed_days = excluded.observed_days, "
+                               "change_rate = excluded.change_rate, next_visit = excluded.next_visit",
+                               list(batch.visits.values()))
+            cursor.executemany("UPDATE page SET page_type_code = 'HTML', accessed_time = ? WHERE id = ?",
+                               [(accessed_time, id) for id, accessed_time in batch.unchanged.items()])
+        return inserted
+
+    # sites ...
+
+    def insert_site(self, domain, robots_content, sitemap_content):
+        sql = "INSERT INTO site (domain, robots_content, sitemap_content) VALUES (?, ?, ?) " \
+              "ON CONFLICT (domain) DO UPDATE SET domain = excluded.domain RETURNING id"
+        return self._one(sql, (domain, robots_content, sitemap_content))
+
+    def site_for_domain(self, domain):
+        return self.cursor.execute("SELECT id, robots_content FROM site WHERE domain = ?", (domain, )).fetchone()
+
+    def site_id_for_domain(self, domain):
+        return self._one("SELECT id FROM site WHERE domain = ?", (domain, ))
+
+    def select_site_by_domain(self, domain):
+        return self.cursor.execute("SELECT id FROM site WHERE domain = ?", (domain, )).fetchone()
+
+    def select_robots_by_domain(self, domain):
+        return self.cursor.execute("SELECT robots_content FROM site WHERE domain = ?", (domain, )).fetchone()
+
+    def select_sitemaps(self):
+        return self._all("SELECT id, sitemap_content, sitemap_time FROM site WHERE sitemap_content LIKE 'http%'")
+
+    def set_sitemap_time(self, site_id, time):
+        self.cursor.execute("UPDATE site SET sitemap_time = ? WHERE id = ?", (time, site_id))
+
+    def set_robots(self, site_id, robots_content, sitemap_content):
+        self.cursor.execute("UPDATE site SET robots_content = ?, sitemap_content = ? WHERE id = ?",
+                            (robots_content, sitemap_content, site_id))
+
+    # pages ...
+
+    def insert_page(self, site_id, page_type_code, url, html_content, http_status_code, accessed_time, hash=-1,
+                    duplicate_page_id=-1, is_binary=False, simhash=None):
+        html_content, body = self._body(site_id, html_content)
+        sql = "INSERT INTO page (site_id, page_type_code, url, html_content, http_status_code, accessed_time, " \
+              "duplicate_page_id, is_binary, hash, simhash, content_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) " \
+              "ON CONFLICT (url) DO NOTHING RETURNING id"
+        row = self._write_page(sql, (site_id, page_type_code, url, html_content, http_status_code, accessed_time,
+                                     duplicate_page_id, is_binary, hash, simhash, body and body[0]), body)
+        return row[0] if row else None
+
+    def update_page(self, page_id, page_type_code, html_content, http_status_code, accessed_time,
+                    duplicate_page_id=-1, hash=-1, is_binary=False, simhash=None, site_id=None):
+        if html_content is not None and site_id is None and self.html_storage == "dedup":
+            site_id = self._one("SELECT site_id FROM page WHERE id = ?", (page_id, ))
+        html_content, body = self._body(site_id, html_content)
+        sql = "UPDATE page SET page_type_code = ?, html_content = ?, http_status_code = ?, accessed_time = ?, " \
+              "duplicate_page_id = ?, hash = ?, is_binary = ?, simhash = ?, content_hash = ?, leased_by = NULL, " \
+              "lease_expires = NULL WHERE id = ?"
+        self._write_page(sql, (page_type_code, html_content, http_status_code, accessed_time,
+                               duplicate_page_id, hash, is_binary, simhash, body and body[0], page_id), body)
+
+    def set_page_type(self, page_ids, page_type_code):
+        self.cursor.execute("UPDATE page SET page_type_code = ?, leased_by = NULL, lease_expires = NULL "
+                            "WHERE id IN " + _EACH, (page_type_code, _list(page_ids)))
+
+    def insert_page_data(self, page_id, data_type_code, data):
+        return self._one("INSERT INTO page_data (page_id, data_type_code, data) VALUES (?, ?, ?) RETURNING id",
+                         (page_id, data_type_code, data))
+
+    def insert_image(self, page_id, filename, content_type, data, accessed_time):
+        return self._one("INSERT INTO image (page_id, filename, content_type, data, accessed_time) "
+                         "VALUES (?, ?, ?, ?, ?) RETURNING id", (page_id, filename, content_type, data, accessed_time))
+
+    def insert_link(self, page_id_from, page_id_to):
+        if not page_id_from or not page_id_to:
+            return
+        self.cursor.execute("INSERT OR IGNORE INTO link (from_page, to_page) VALUES (?, ?)", (page_id_from, page_id_to))
+
+    def page_for_url(self, url):
+        return self._one("SELECT id FROM page WHERE url = ?", (url, ))
+
+    def page_for_hash(self, hash):
+        return self._one("SELECT id FROM page WHERE hash = ? LIMIT 1", (hash, ))
+
+    def page_id_for_page_in_frontier(self, site_id, url):
+        return self._one("SELECT id FROM page WHERE site_id = ? AND url = ? AND page_type_code = 'FRONTIER'",
+                         (site_id, url))
+
+    def existing_urls(self, urls):
+        return [row[0] for row in self._all("SELECT url FROM page WHERE url IN " + _EACH, (_list(urls), ))]
+
+    def iter_urls(self, batch_size=10000, since_id=0):
+        cursor = self.connection.execute("SELECT url FROM page WHERE id > ?", (since_id, ))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
+
+    def max_page_id(self):
+        return self._one("SELECT coalesce(max(id), 0) FROM page")
+
+    def select_all_pages(self):
+        columns = [row[1] for row in self._all("PRAGMA table_info(page)")]
+        html = columns.index("html_content")
+        return [row[:html] + (self._decompress(row[html]), ) + row[html + 1:] for row in self._all("SELECT * FROM page")]
+
+    def select_page_html(self, url):
+        return self.cursor.execute("SELECT id FROM page WHERE page_type_code = 'HTML' ORDER BY accessed_time LIMIT 1"
+                                   ).fetchone()
+
+    def page_html(self, page_id):
+        row = self.cursor.execute("SELECT p.html_content, c.codec, c.dictionary_id, c.data FROM page AS p "
+                                  "LEFT JOIN content AS c ON c.hash = p.content_hash WHERE p.id = ?",
+                                  (page_id, )).fetchone()
+        if row is None:
+            return None
+        html_content, codec, dictionary_id, data = row
+        if data is not None:
+            return self.bodies.decode(codec, dictionary_id, data)
+        return self._decompress(html_content)
+
+    def select_fingerprints(self, since_id=0, since_time=None):
+        return self._all("SELECT id, hash, simhash FROM page WHERE page_type_code = 'HTML' AND hash IS NOT NULL "
+                         "AND (id > ? OR accessed_time >= ?)", (since_id, since_time))
+
+    # frontier ...
+
+    def select_from_frontier(self):
+        return self.cursor.execute("SELECT id, url, is_binary, priority FROM page WHERE page_type_code = 'FRONTIER' "
+                                   "ORDER BY priority DESC, id LIMIT 1").fetchone()
+
+    def frontier_size(self):
+        return self._one("SELECT count(*) FROM page WHERE page_type_code = 'FRONTIER'")
+
+    def claim_from_frontier(self, limit, shard=None, owner=None, lease=DEFAULT_LEASE):
+        shard_filter, shard_data = "", ()
+        if shard is not None:
+            index, count = shard
+            shard_filter, shard_data = "AND url_shard(url, ?) = ?", (count, index)
+        now = time.time()
+        # the write lock is held from the first select, no other connection claims the same rows
+        with self._transaction() as cursor:
+            ids = [row[0] for row in cursor.execute(
+                "SELECT id FROM page WHERE page_type_code = 'IN PROGRESS' AND (lease_expires IS NULL OR lease_expires < ?) "
+                + shard_filter + " ORDER BY lease_expires LIMIT ?", (now, ) + shard_data + (limit, ))]
+            if len(ids) < limit:
+                ids += [row[0] for row in cursor.execute(
+                    "SELECT id FROM page WHERE page_type_code = 'FRONTIER' " + shard_filter +
+                    " ORDER BY priority DESC, id LIMIT ?", shard_data + (limit - len(ids), ))]
+            if not ids:
+                return []
+            rows = {row[0]: row for row in cursor.execute(
+                "UPDATE page SET page_type_code = 'IN PROGRESS', leased_by = ?, lease_expires = ? "
+                "WHERE id IN " + _EACH + " RETURNING id, url, is_binary, priority", (owner, now + lease, _list(ids)))}
+        return [rows[id] for id in ids]
+
+    def renew_leases(self, owner, lease=DEFAULT_LEASE):
+        return self.cursor.execute("UPDATE page SET lease_expires = ? WHERE page_type_code = 'IN PROGRESS' "
+                                   "AND leased_by = ?", (time.time() + lease, owner)).rowcount
+
+    def reclaim_leases(self, page_ids, owner, lease=DEFAULT_LEASE):
+        return self._all("UPDATE page SET lease_expires = ? WHERE id IN " + _EACH +
+                         " AND page_type_code = 'IN PROGRESS' AND leased_by = ? RETURNING id, url, is_binary, priority",
+                         (time.time() + lease, _list(page_ids), owner))
+
+    def postpone_leases(self, page_ids, delay):
+        return self.cursor.execute("UPDATE page SET leased_by = NULL, lease_expires = ? WHERE id IN " + _EACH +
+                                   " AND page_type_code = 'IN PROGRESS'", (time.time() + delay, _list(page_ids))).rowcount
+
+    def release_leases(self, owner, keep=()):
+        return self.cursor.execute("UPDATE page SET page_type_code = 'FRONTIER', leased_by = NULL, lease_expires = NULL "
+                                   "WHERE page_type_code = 'IN PROGRESS' AND leased_by = ? AND id NOT IN " + _EACH,
+                                   (owner, _list(keep))).rowcount
+
+    # compression dictionaries ...
+
+    def site_dictionary(self, site_id, codec):
+        return self._one("SELECT max(id) FROM content_dictionary WHERE site_id = ? AND codec = ?", (site_id, codec))
+
+    def insert_dictionary(self, site_id, codec, data):
+        return self._one("INSERT INTO content_dictionary (site_id, codec, data) VALUES (?, ?, ?) RETURNING id",
+                         (site_id, codec, data))
+
+    def select_dictionary(self, dictionary_id):
+        return self.cursor.execute("SELECT codec, data FROM content_dictionary WHERE id = ?",
+                                   (dictionary_id, )).fetchone()
+
+    # revisits ...
+
+    def revisit_for_url(self, url):
+        return self.cursor.execute("""
+            SELECT r.page_id, r.etag, r.last_modified, p.hash, r.visits, r.changes, r.observed_days, p.accessed_time
+            FROM page p JOIN page_revisit r ON r.page_id = p.id
+            WHERE p.url = ?
+        """, (url, )).fetchone()
+
+    def revisit_modified(self, entries):
+        with self._transaction() as cursor:
+            cursor.executemany("""
+                UPDATE page_revisit SET next_visit = min(coalesce(next_visit, :lastmod), :lastmod)
+                WHERE page_id = (SELECT id FROM page WHERE url = :url AND accessed_time < :lastmod)
+            """, [{"url": url, "lastmod": lastmod} for url, lastmod in entries])
+
+    def requeue_due(self, now):
+        return self.cursor.execute("UPDATE page SET page_type_code = 'FRONTIER' WHERE page_type_code = 'HTML' "
+                                   "AND id IN (SELECT page_id FROM page_revisit WHERE next_visit <= ?)", (now, )).rowcount
@@ -0,0 +1,268 @@
+""" Storage backends
+
+`Storage` is everything the crawler asks of its database. `DBApi`
+(`crawler.utils`) implements it on the crawldb Postgres schema, `SqliteApi`
+(`crawler.sqlite_storage`) on a single local SQLite file in WAL mode with
+compressed HTML, for single-node crawls and tests without a database server.
+
+With `html_storage="dedup"` both store HTML compressed and once per unique
+body in the `content` table instead of `page.html_content`, see
+`crawler.bodies`.
+
+Every worker thread uses its own connection from `connect()`; the backend is
+chosen once per process with `configure`, e.g. from `--backend`.
+
+    configure("sqlite", "crawl.sqlite", html_storage="dedup")
+    api = connect()
+"""
+
+import abc
+
+from crawler.bodies import BodyCodec, HTML_STORAGE
+
+
+BACKENDS = ("postgres", "sqlite")
+DEFAULT_SQLITE_PATH = "crawl.sqlite"
+DEFAULT_LEASE = 600  # seconds a claimed frontier row stays reserved without renewal
+
+_backend = {"name": "postgres", "path": DEFAULT_SQLITE_PATH, "html_storage": "inline"}
+
+
+def configure(backend="postgres", path=DEFAULT_SQLITE_PATH, html_storage="inline"):
+    """ Backend returned by `connect` from now on, `path` is the SQLite file. """
+    if backend not in BACKENDS:
+        raise ValueError("unknown storage backend %r" % backend)
+    if html_storage not in HTML_STORAGE:
+        raise ValueError("unknown HTML storage %r" % html_storage)
+    _backend.update(name=backend, path=path, html_storage=html_storage)
+
+
+def connect() -> "Storage":
+    """ A new connection to the configured backend. """
+    if _backend["name"] == "sqlite":
+        from crawler.sqlite_storage import SqliteApi
+        return SqliteApi(_backend["path"], html_storage=_backend["html_storage"])
+    from crawler.utils import DBConn, DBApi
+    return DBApi(DBConn(), html_storage=_backend["html_storage"])
+
+
+class Storage(abc.ABC):
+    """ One connection to the crawl database, used by one thread at a time.
+
+        Pages are `crawldb.page` rows; ids, page type codes and the row tuples
+        returned are the same for every backend.
+    """
+
+    html_storage = "inline"
+    _bodies = None
+
+    @property
+    def bodies(self) -> BodyCodec:
+        """ Codec of the `content` table, for `html_storage="dedup"`. """
+        if self._bodies is None:
+            self._bodies = BodyCodec(self)
+        return self._bodies
+
+    # transactions ...
+
+    @abc.abstractmethod
+    def commit(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def rollback(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def close(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def write_batch(self, batch):
+        """ Write a `WriteBatch` in one transaction, returns `{url: page_id}` of inserted pages. """
+        raise NotImplementedError
+
+    # sites ...
+
+    @abc.abstractmethod
+    def insert_site(self, domain, robots_content, sitemap_content):
+        """ Id of the new site, or of the stored site with `domain`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def site_for_domain(self, domain):
+        """ `(id, robots_content)` or `None`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def site_id_for_domain(self, domain):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def select_site_by_domain(self, domain):
+        """ `(id, )` or `None`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def select_robots_by_domain(self, domain):
+        """ `(robots_content, )` or `None`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def select_sitemaps(self):
+        """ `(site_id, sitemap locations, sitemap_time)` of sites with sitemaps. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_sitemap_time(self, site_id, time):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_robots(self, site_id, robots_content, sitemap_content):
+        """ Replace the stored robots.txt and sitemap locations of a site. """
+        raise NotImplementedError
+
+    # pages ...
+
+    @abc.abstractmethod
+    def insert_page(self, site_id, page_type_code, url, html_content, http_status_code, accessed_time, hash=-1,
+                    duplicate_page_id=-1, is_binary=False, simhash=None):
+        """ Id of the new page, `None` if a page with `url` already exists. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_page(self, page_id, page_type_code, html_content, http_status_code, accessed_time,
+                    duplicate_page_id=-1, hash=-1, is_binary=False, simhash=None, site_id=None):
+        """ Store the outcome of a page and end its lease. `site_id` of the page
+            saves a lookup when `html_content` goes to the `content` table.
+        """
+        raise NotImplementedError
+
+    def remove_page(self, url, time):
+        self.update_page(self.page_for_url(url), "UNKNOWN", None, 500, time)
+
+    @abc.abstractmethod
+    def set_page_type(self, page_ids, page_type_code):
+        """ Also ends the leases of the pages. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert_page_data(self, page_id, data_type_code, data):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert_image(self, page_id, filename, content_type, data, accessed_time):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert_link(self, page_id_from, page_id_to):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def page_for_url(self, url):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def page_for_hash(self, hash):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def page_id_for_page_in_frontier(self, site_id, url):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def existing_urls(self, urls):
+        """ The subset of `urls` that are stored. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_urls(self, batch_size=10000, since_id=0):
+        """ Stream the urls of pages with an id above `since_id`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def max_page_id(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def select_all_pages(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def select_page_html(self, url):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def page_html(self, page_id):
+        """ Stored HTML of a page, decompressed, or `None`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def select_fingerprints(self, since_id=0, since_time=None):
+        """ `(id, hash, simhash)` of HTML pages, with `since_id`/`since_time` only newer or recently accessed ones. """
+        raise NotImplementedError
+
+    # frontier ...
+
+    @abc.abstractmethod
+    def select_from_frontier(self):
+        """ Highest priority `(id, url, is_binary, priority)` frontier row or `None`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def frontier_size(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def claim_from_frontier(self, limit, shard=None, owner=None, lease=DEFAULT_LEASE):
+        """ Lease up to `limit` rows, expired leases first, and return their `(id, url, is_binary, priority)`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def renew_leases(self, owner, lease=DEFAULT_LEASE):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def reclaim_leases(self, page_ids, owner, lease=DEFAULT_LEASE):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def postpone_leases(self, page_ids, delay):
+        """ Hand claimed rows back, claimable again (by any crawl) after `delay` seconds. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def release_leases(self, owner, keep=()):
+        raise NotImplementedError
+
+    # compression dictionaries of the `content` table ...
+
+    @abc.abstractmethod
+    def site_dictionary(self, site_id, codec):
+        """ Id of the latest `codec` dictionary trained for `site_id`, or `None`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def insert_dictionary(self, site_id, codec, data):
+        """ Id of the new dictionary, committed at once: bodies compressed with it may be written in any transaction. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def select_dictionary(self, dictionary_id):
+        """ `(codec, data)` or `None`. """
+        raise NotImplementedError
+
+    # revisits ...
+
+    @abc.abstractmethod
+    def revisit_for_url(self, url):
+        """ `(page_id, etag, last_modified, hash, visits, changes, observed_days, accessed_time)` or `None`. """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def revisit_modified(self, entries):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def requeue_due(self, now):
+        raise NotImplementedError
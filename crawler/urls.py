@@ -0,0 +1,178 @@
+""" Parsed, cached urls
+
+Every url the crawler looks at is parsed once by `UrlEngine.parse` into a
+`UrlInfo`: its canonical form (the `urlcanon` semantic form stored in
+`crawldb.page`), host, site domain, registered domain, path extension and
+whether it is valid and in scope. The checks the crawler makes on a url are
+then attribute lookups on the record instead of separate parses, regular
+expressions and substring tests. Results are kept in an LRU cache, since the
+navigation links of a site repeat on almost every page.
+
+Scope rules match the host against domain suffixes (`.gov.si` matches
+`www.gov.si` and `gov.si`, but not `gov.si.example.com` or a query string
+mentioning `.gov.si`); files are classified by the extension of the last path
+segment, not by a substring anywhere in the url.
+
+    info = url_engine.parse("https://www.GOV.si/a/../Porocilo.PDF")
+    info.url, info.domain, info.file_type  # 'https://www.gov.si/Porocilo.PDF', 'gov.si', 'PDF'
+    url_engine.filter(hrefs)               # unique canonical in-scope urls
+
+    python -m crawler.bench urls
+"""
+
+import re
+
+from functools import lru_cache
+
+import urlcanon
+
+
+CACHE_SIZE = 100000
+SCOPE = (".gov.si",)
+SCHEMES = ("http", "https", "ftp")  # what `validators.url` accepted
+FETCH_SCHEMES = ("http", "https")
+
+# extension -> `crawldb.data_type` code of files stored as page data
+FILE_TYPES = {"pdf": "PDF", "doc": "DOC", "docx": "DOCX", "ppt": "PPT", "pptx": "PPTX"}
+# content type -> data type code, for files served without an extension
+FILE_CONTENT_TYPES = {
+    "application/pdf": "PDF",
+    "application/msword": "DOC",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "DOCX",
+    "application/vnd.ms-powerpoint": "PPT",
+    "application/vnd.openxmlformats-officedocument.presentationml.presentation": "PPTX",
+}
+
+_WHITESPACE = re.compile(r"[\s\x00-\x1f\x7f]")
+_HOSTNAME = re.compile(r"^(?:[a-z0-9¡-￿](?:[a-z0-9¡-￿-]{0,61}[a-z0-9¡-￿])?\.)+"
+                       r"(?:[a-z¡-￿]{2,63}|xn--[a-z0-9-]{1,59})$")
+_IP4 = re.compile(r"^(?:(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)\.){3}(?:25[0-5]|2[0-4]\d|1\d\d|[1-9]?\d)$")
+_IP6 = re.compile(r"^\[[0-9a-f:.]+\]$")
+_EXTENSION = re.compile(r"^[a-z0-9]{1,8}$")
+
+
+def file_type_for_content_type(content_type: str):
+    """ Data type code of a file served as `content_type`, or `None`. """
+    return FILE_CONTENT_TYPES.get((content_type or "").split(";", 1)[0].strip().lower())
+
+
+class Scope:
+    """ Hosts equal to or below one of the domain `suffixes`, fetched over `schemes`. """
+
+    def __init__(self, suffixes=SCOPE, schemes=FETCH_SCHEMES):
+        self.suffixes = tuple("." + suffix.strip(".").lower() for suffix in suffixes)
+        self.domains = frozenset(suffix[1:] for suffix in self.suffixes)
+        self.schemes = frozenset(schemes)
+
+    def contains(self, scheme, host):
+        return scheme in self.schemes and (host in self.domains or host.endswith(self.suffixes))
+
+    def registered_domain(self, host):
+        """ `host` without its subdomains: the label below the longest matching
+            suffix (scope suffixes count as public suffixes, e.g. `gu.gov.si`),
+            otherwise the last two labels.
+        """
+        if _IP4.match(host) or _IP6.match(host):
+            return host
+        suffix = max((suffix for suffix in self.suffixes if host.endswith(suffix)), key=len, default=None)
+        if suffix is None:
+            return ".".join(host.rsplit(".", 2)[-2:])
+        return host[:-len(suffix)].rsplit(".", 1)[-1] + suffix
+
+
+class UrlInfo:
+    """ One parsed url. Invalid urls (relative urls, other schemes, malformed
+        hosts and ports, whitespace, as rejected by `validators.url`) still get
+        their canonical form, but are never in scope.
+    """
+
+    __slots__ = ("url", "valid", "scheme", "host", "port", "domain", "registered_domain", "extension",
+                 "file_type", "in_scope")
+
+    def __init__(self, url, valid, scheme, host, port, domain, registered_domain, extension, file_type, in_scope):
+        self.url = url
+        self.valid = valid
+        self.scheme = scheme
+        self.host = host
+        self.port = port
+        self.domain = domain
+        self.registered_domain = registered_domain
+        self.extension = extension
+        self.file_type = file_type
+        self.in_scope = in_scope
+
+    def __repr__(self):
+        return "UrlInfo(%s)" % ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__)
+
+
+class UrlEngine:
+    def __init__(self, scope: Scope = None, cache_size=CACHE_SIZE):
+        self.cache_size = cache_size
+        self.configure(scope or Scope())
+
+    def configure(self, scope: Scope):
+        """ Use `scope` from now on, cached results of the previous scope are dropped. """
+        self.scope = scope
+        self._cached = lru_cache(maxsize=self.cache_size)(self._parse)
+
+    def parse(self, url: str) -> UrlInfo:
+        return self._cached(url)
+
+    def parse_many(self, urls):
+        """ `UrlInfo` of every url in `urls`, in order. """
+        parse = self._cached
+        return [parse(url) for url in urls]
+
+    def filter(self, urls, scoped=True):
+        """ Unique canonical forms of the valid (and with `scoped` in-scope) `urls`, in order. """
+        parse = self._cached
+        canonical = {}
+        for url in urls:
+            info = parse(url)
+            if info.in_scope if scoped else info.valid:
+                canonical[info.url] = None
+        return list(canonical)
+
+    def cache_info(self):
+        return self._cached.cache_info()
+
+    def _parse(self, url: str) -> UrlInfo:
+        parsed = urlcanon.parse_url(url)
+        # validated on the url as written, canonicalisation fixes up much of what is wrong with it
+        scheme = parsed.scheme.decode("utf-8", "replace").lower()
+        valid = (scheme in SCHEMES and parsed.slashes == b"//" and not parsed.leading_junk
+                 and not parsed.trailing_junk and _WHITESPACE.search(url) is None)
+        if valid:
+            host = parsed.host.decode("utf-8", "replace").lower()
+            port = parsed.port
+            valid = any(pattern.match(host) for pattern in (_HOSTNAME, _IP4, _IP6)) \
+                and (not port or (port.isdigit() and 0 < int(port) <= 65535))
+
+        urlcanon.semantic(parsed)
+        canonical = str(parsed)
+        host = parsed.host.decode("utf-8", "replace")
+        port = parsed.port.decode("ascii", "replace") if parsed.port else None
+        domain = host[4:] if host.startswith("www.") else host
+        if port:
+            domain += ":" + port
+
+        segment = parsed.path.rsplit(b"/", 1)[-1]
+        extension = segment.rsplit(b".", 1)[-1].decode("utf-8", "replace").lower() if b"." in segment else None
+        if extension is not None and not _EXTENSION.match(extension):
+            extension = None
+
+        return UrlInfo(
+            url=canonical,
+            valid=valid,
+            scheme=scheme,
+            host=host,
+            port=port,
+            domain=domain,
+            registered_domain=self.scope.registered_domain(host) if host else None,
+            extension=extension,
+            file_type=FILE_TYPES.get(extension),
+            in_scope=valid and self.scope.contains(scheme, host),
+        )
+
+
+url_engine = UrlEngine()
@@ -1,5 +1,13 @@
+import time
+import sqlite3
+
 import psycopg2
 
+from psycopg2.extras import execute_values
+
+from crawler.priority import PriorityScorer, default_scorer
+from crawler.storage import Storage, DEFAULT_LEASE
+
 """
 docker run --rm --name pg-docker -e POSTGRES_PASSWORD=docker -d -p 5432:5432 postgres
 docker exec -it pg-docker psql -U postgres
@@ -19,39 +27,270 @@ class DBConn:
     def __init__(self, db_auth=db_auth):
         self.connection = psycopg2.connect(**db_auth)
         self.cursor = self.connection.cursor()
+        self.commits = 0
 
     def release(self):
         self.connection.close()
 
     def commit(self):
         self.connection.commit()
+        self.commits += 1
+
+
+class BatchError(Exception):
+    """ Rows of `errors` (page id -> exception) were not written, the rows of
+        the other pages of the batch were.
+    """
+
+    def __init__(self, errors, inserted=None):
+        super().__init__("; ".join("page %s: %s" % (page_id, error) for page_id, error in errors.items()))
+        self.errors = errors
+        self.inserted = inserted or {}
+
+
+def is_storage_error(error):
+    """ Whether `error` was raised by the database, not by fetching or parsing a page. """
+    return isinstance(error, (BatchError, sqlite3.Error, psycopg2.Error))
+
+
+class WriteBatch:
+    """ Rows discovered while processing pages, written in one transaction.
+
+        Frontier pages are inserted first, with their depth and priority; the ids
+        of links' target urls are then resolved (new and already stored pages
+        alike) before links, images and `page_data` are inserted. Newly stored
+        links pass their source's OPIC cash on to frontier targets. With
+        `max_age` > 0 rows of several pages are collected until the batch is `due`.
+
+        If the transaction fails, the rows of every page are written again on
+        their own, so a bad row only loses the rows of the page it belongs to.
+    """
+
+    def __init__(self, max_age=0.0, max_rows=5000, scorer: PriorityScorer = default_scorer):
+        self.max_age = max_age
+        self.max_rows = max_rows
+        self.scorer = scorer
+        self.clear()
+
+    def clear(self):
+        self.pages = {}      # url -> (site_id, url, is_binary, source page id, in sitemap)
+        self.links = set()   # (from_page_id, to_url)
+        self.images = []
+        self.page_data = []
+        self.visits = {}     # page_id -> `crawldb.page_revisit` row
+        self.unchanged = {}  # page_id -> accessed_time of revisited pages that did not change
+        self.started = time.monotonic()
+
+    def __len__(self):
+        return len(self.pages) + len(self.links) + len(self.images) + len(self.page_data) + len(self.visits)
+
+    def due(self):
+        return len(self) >= self.max_rows or time.monotonic() - self.started >= self.max_age
+
+    def add_frontier(self, url, site_id, is_binary=False, source_id=None, in_sitemap=False):
+        self.pages.setdefault(url, (site_id, url, is_binary, source_id, in_sitemap))
+
+    def add_link(self, from_page_id, to_url):
+        if from_page_id:
+            self.links.add((from_page_id, to_url))
+
+    def add_image(self, page_id, filename, content_type, data, accessed_time, blob_key=None):
+        self.images.append((page_id, filename, content_type, data, accessed_time, blob_key))
+
+    def add_page_data(self, page_id, data_type_code, data, blob_key=None):
+        self.page_data.append((page_id, data_type_code, data, blob_key))
+
+    def add_visit(self, row, unchanged_at=None):
+        """ Upsert a `crawldb.page_revisit` row; with `unchanged_at` the page itself
+            is only marked visited again instead of being rewritten.
+        """
+        self.visits[row[0]] = row
+        if unchanged_at is not None:
+            self.unchanged[row[0]] = unchanged_at
+
+    def sources(self):
+        """ Ids of the pages the frontier urls were found on. """
+        return list({source_id for *_, source_id, _ in self.pages.values() if source_id})
+
+    def frontier_rows(self, depths):
+        """ `(site_id, "FRONTIER", url, is_binary, depth, priority)` rows given `{source_id: depth}`. """
+        rows = []
+        for site_id, url, is_binary, source_id, in_sitemap in self.pages.values():
+            depth = depths.get(source_id, 0) + 1 if source_id else 0
+            rows.append((site_id, "FRONTIER", url, is_binary, depth, self.scorer.score(url, depth, in_sitemap)))
+        return rows
+
+    def split(self):
+        """ `(page_id, batch)` with the rows of every page the rows were found
+            on, also the frontier rows its links point to.
+        """
+        parts = {}
+
+        def part(page_id):
+            batch = parts.get(page_id)
+            if batch is None:
+                batch = parts[page_id] = WriteBatch(self.max_age, self.max_rows, self.scorer)
+            return batch
+
+        for url, row in self.pages.items():
+            part(row[3]).pages[url] = row
+        for from_id, url in self.links:
+            batch = part(from_id)
+            batch.links.add((from_id, url))
+            if url in self.pages:
+                batch.pages.setdefault(url, self.pages[url])
+        for row in self.images:
+            part(row[0]).images.append(row)
+        for row in self.page_data:
+            part(row[0]).page_data.append(row)
+        for page_id, row in self.visits.items():
+            part(page_id).visits[page_id] = row
+        for page_id, accessed_time in self.unchanged.items():
+            part(page_id).unchanged[page_id] = accessed_time
+        return list(parts.items())
+
+    def flush(self, api: Storage):
+        """ Write everything with a single commit and return `{url: page_id}`
+            of the pages inserted by this batch. Raises `BatchError` with the
+            pages whose rows could not be written.
+        """
+        try:
+            try:
+                return api.write_batch(self)
+            except Exception as e:
+                parts = self.split()
+                if len(parts) == 1:
+                    raise BatchError({parts[0][0]: e}) from e
+            inserted, errors = {}, {}
+            for page_id, part in parts:
+                try:
+                    inserted.update(api.write_batch(part))
+                except Exception as e:
+                    errors[page_id] = e
+            if errors:
+                raise BatchError(errors, inserted)
+            return inserted
+        finally:
+            self.clear()
+
+
+class DBApi(Storage):
+    def __init__(self, conn: DBConn, html_storage="inline"):
+        self.conn = conn
+        self.html_storage = html_storage
+
+    def commit(self):
+        self.conn.commit()
 
+    def rollback(self):
+        self.conn.connection.rollback()
 
-class DBApi:
-    def __init__(self, conn: DBConn):
-        self.conn = conn
+    def close(self):
+        self.conn.release()
+
+    def write_batch(self, batch: WriteBatch):
+        conn = self.conn
+        cursor = conn.cursor
+        inserted = {}
+        try:
+            if batch.pages:
+                sources = batch.sources()
+                depths = {}
+                if sources:
+                    cursor.execute("SELECT id, coalesce(depth, 0) FROM crawldb.page WHERE id = ANY(%s)", (sources, ))
+                    depths = dict(cursor.fetchall())
+                rows = execute_values(
+                    cursor,
+                    "INSERT INTO crawldb.page (site_id, page_type_code, url, is_binary, depth, priority) VALUES %s "
+                    "ON CONFLICT (url) DO NOTHING RETURNING id, url",
+                    batch.frontier_rows(depths), fetch=True)
+                inserted = {url: id for id, url in rows}
+
+            if batch.links:
+                ids = dict(inserted)
+                missing = list({url for _, url in batch.links if url not in ids})
+                if missing:
+                    cursor.execute("SELECT id, url FROM crawldb.page WHERE url = ANY(%s)", (missing, ))
+                    ids.update((url, id) for id, url in cursor.fetchall())
+                links = [(from_id, ids[url]) for from_id, url in batch.links if url in ids]
+                if links:
+                    links = execute_values(cursor,
+                                           "INSERT INTO crawldb.link (from_page, to_page) VALUES %s "
+                                           "ON CONFLICT DO NOTHING RETURNING from_page, to_page",
+                                           links, fetch=True)
+                cash = batch.scorer.cash(links)
+                if cash:
+                    execute_values(cursor,
+                                   "UPDATE crawldb.page AS p SET priority = p.priority + v.cash "
+                                   "FROM (VALUES %s) AS v (id, cash) "
+                                   "WHERE p.id = v.id AND p.page_type_code = 'FRONTIER'",
+                                   list(cash.items()))
+
+            if batch.images:
+                execute_values(cursor,
+                               "INSERT INTO crawldb.image (page_id, filename, content_type, data, accessed_time, blob_key) VALUES %s",
+                               batch.images)
+            if batch.page_data:
+                execute_values(cursor,
+                               "INSERT INTO crawldb.page_data (page_id, data_type_code, data, blob_key) VALUES %s",
+                               batch.page_data)
+            if batch.visits:
+                execute_values(cursor,
+                               "INSERT INTO crawldb.page_revisit (page_id, etag, last_modified, visits, changes, observed_days, change_rate, next_visit) VALUES %s "
+                               "ON CONFLICT (page_id) DO UPDATE SET etag = EXCLUDED.etag, last_modified = EXCLUDED.last_modified, "
+                               "visits = EXCLUDED.visits, changes = EXCLUDED.changes, observed_days = EXCLUDED.observed_days, "
+                               "change_rate = EXCLUDED.change_rate, next_visit = EXCLUDED.next_visit",
+                               list(batch.visits.values()))
+            if batch.unchanged:
+                execute_values(cursor,
+                               "UPDATE crawldb.page AS p SET page_type_code = 'HTML', accessed_time = v.accessed_time "
+                               "FROM (VALUES %s) AS v (id, accessed_time) WHERE p.id = v.id",
+                               list(batch.unchanged.items()))
+            conn.commit()
+        except Exception:
+            conn.connection.rollback()
+            raise
+        return inserted
 
     # inserts / updates ...
 
-    # save `site` and return ID
+    # save `site` and return ID, the ID of the stored `site` if `domain` already exists
     def insert_site(self, domain, robots_content, sitemap_content):
-        sql = "INSERT INTO crawldb.site (domain, robots_content, sitemap_content) VALUES (%s, %s, %s) RETURNING ID"
+        sql = "INSERT INTO crawldb.site (domain, robots_content, sitemap_content) VALUES (%s, %s, %s) ON CONFLICT (domain) DO UPDATE SET domain = EXCLUDED.domain RETURNING ID"
         return self._execute_one(sql, (domain, robots_content, sitemap_content))
 
+    # `WITH` clause storing `html_content` once in `content` with `html_storage="dedup"`, its data and the content hash;
+    # it runs in the same statement (round trip) as the page write
+    def _store_body(self, site_id, html_content):
+        if html_content is None or self.html_storage != "dedup":
+            return "", (), None
+        row = self.bodies.encode(site_id, html_content)
+        sql = "WITH body AS (INSERT INTO crawldb.content (hash, codec, dictionary_id, size, data) VALUES (%s, %s, %s, %s, %s) ON CONFLICT (hash) DO NOTHING) "
+        return sql, row, row[0]
+
     # save `page` linked to specific `site` and return ID
-    def insert_page(self, site_id, page_type_code, url, html_content, http_status_code, accessed_time, hash=-1, duplicate_page_id=-1, is_binary=False):
+    def insert_page(self, site_id, page_type_code, url, html_content, http_status_code, accessed_time, hash=-1, duplicate_page_id=-1, is_binary=False, simhash=None):
+        # returns `None` if a page with `url` already exists
         try:
-            sql = "INSERT INTO crawldb.page (site_id, page_type_code, url, html_content, http_status_code, accessed_time, duplicate_page_id, is_binary, hash) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING ID"
-            return self._execute_one(sql, (site_id, page_type_code, url, html_content, http_status_code, accessed_time, duplicate_page_id, is_binary, hash))
+            body_sql, body, content_hash = self._store_body(site_id, html_content)
+            if content_hash is not None:
+                html_content = None
+            sql = body_sql + "INSERT INTO crawldb.page (site_id, page_type_code, url, html_content, http_status_code, accessed_time, duplicate_page_id, is_binary, hash, simhash, content_hash) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) ON CONFLICT (url) DO NOTHING RETURNING ID"
+            return self._execute_one(sql, body + (site_id, page_type_code, url, html_content, http_status_code, accessed_time, duplicate_page_id, is_binary, hash, simhash, content_hash))
         except Exception as e:
             self.conn.connection.rollback()
-            # TODO: - DUPLICATES SHOULDN'T COME THROUGH, BUT THEY DO :S
+            print("Error inserting page %s" % url, e)
             return None
 
     # update existing page
-    def update_page(self, page_id, page_type_code, html_content, http_status_code, accessed_time, duplicate_page_id=-1, hash=-1, is_binary=False):
-        sql = "UPDATE crawldb.page set page_type_code = %s, html_content = %s, http_status_code = %s, accessed_time = %s, duplicate_page_id = %s, hash=%s, is_binary = %s WHERE id = %s;"
-        self.conn.cursor.execute(sql, (page_type_code, html_content, http_status_code, accessed_time, duplicate_page_id, hash, is_binary, page_id))
+    def update_page(self, page_id, page_type_code, html_content, http_status_code, accessed_time, duplicate_page_id=-1, hash=-1, is_binary=False, simhash=None, site_id=None):
+        if html_content is not None and site_id is None and self.html_storage == "dedup":
+            site_id = self._execute_one("SELECT site_id FROM crawldb.page WHERE id = %s", (page_id, ))
+        body_sql, body, content_hash = self._store_body(site_id, html_content)
+        if content_hash is not None:
+            html_content = None
+        sql = body_sql + "UPDATE crawldb.page set page_type_code = %s, html_content = %s, http_status_code = %s, accessed_time = %s, duplicate_page_id = %s, hash=%s, is_binary = %s, simhash = %s, content_hash = %s, leased_by = NULL, lease_expires = NULL WHERE id = %s;"
+        self.conn.cursor.execute(sql, body + (page_type_code, html_content, http_status_code, accessed_time, duplicate_page_id, hash, is_binary, simhash, content_hash, page_id))
 
     # save `page_data` linked to specific `page` and return ID
     def insert_page_data(self, page_id, data_type_code, data):
@@ -63,10 +302,6 @@ class DBApi:
         sql = "INSERT INTO crawldb.image (page_id, filename, content_type, data, accessed_time) VALUES (%s, %s, %s, %s, %s) RETURNING ID"
         return self._execute_one(sql, (page_id, filename, content_type, data, accessed_time))
 
-    def remove_page(self, url, time):
-        page_id = self.page_for_url(url)
-        self.update_page(page_id, "UNKNOWN", None, 500, time)
-
     # save `link`
     def insert_link(self, page_id_from, page_id_to):
         if not page_id_from or not page_id_to:
@@ -74,12 +309,44 @@ class DBApi:
         sql = "INSERT INTO crawldb.link (from_page, to_page) VALUES (%s, %s)"
         return self.conn.cursor.execute(sql, (page_id_from, page_id_to))
 
-    # all pages that are `in progress`
-    def in_progress_to_frontier(self):
-        sql = "UPDATE crawldb.page SET page_type_code='FRONTIER' WHERE page_type_code='IN PROGRESS'"
+    # set `page_type_code` of many pages at once
+    def set_page_type(self, page_ids, page_type_code):
+        sql = "UPDATE crawldb.page SET page_type_code = %s, leased_by = NULL, lease_expires = NULL WHERE id = ANY(%s)"
+        self.conn.cursor.execute(sql, (page_type_code, list(page_ids)))
+        self.conn.commit()
+
+    # sitemap `(url, lastmod)` entries: stored pages modified after their last visit are due at `lastmod`
+    def revisit_modified(self, entries):
+        execute_values(self.conn.cursor, """
+            UPDATE crawldb.page_revisit AS r SET next_visit = least(r.next_visit, v.lastmod)
+            FROM crawldb.page AS p, (VALUES %s) AS v (url, lastmod)
+            WHERE p.url = v.url AND r.page_id = p.id AND p.accessed_time < v.lastmod
+        """, entries)
+        self.conn.commit()
+
+    def set_sitemap_time(self, site_id, time):
+        sql = "UPDATE crawldb.site SET sitemap_time = %s WHERE id = %s"
+        self.conn.cursor.execute(sql, (time, site_id))
+        self.conn.commit()
+
+    # robots.txt of a site fetched again after its cache entry expired
+    def set_robots(self, site_id, robots_content, sitemap_content):
+        sql = "UPDATE crawldb.site SET robots_content = %s, sitemap_content = %s WHERE id = %s"
+        self.conn.cursor.execute(sql, (robots_content, sitemap_content, site_id))
+        self.conn.commit()
+
+    # put stored HTML pages whose next visit is due back into the frontier
+    def requeue_due(self, now):
+        sql = """
+            UPDATE crawldb.page SET page_type_code = 'FRONTIER'
+            WHERE page_type_code = 'HTML' AND id IN (
+                SELECT page_id FROM crawldb.page_revisit WHERE next_visit <= %s
+            )
+        """
         cursor = self.conn.cursor
-        cursor.execute(sql, ())
+        cursor.execute(sql, (now, ))
         self.conn.commit()
+        return cursor.rowcount
 
     # selections ...
 
@@ -97,6 +364,17 @@ class DBApi:
         sql = "SELECT * FROM crawldb.page"
         return self._execute_all(sql, ())
 
+    # (id, hash, simhash) of stored HTML pages, with `since_id`/`since_time` only newer or recently accessed ones
+    def select_fingerprints(self, since_id=0, since_time=None):
+        sql = """
+            SELECT id, hash, simhash FROM crawldb.page
+            WHERE page_type_code='HTML' AND hash IS NOT NULL AND (id > %s OR accessed_time >= %s)
+        """
+        return self._execute_all(sql, (since_id, since_time))
+
+    def max_page_id(self):
+        return self._execute_one("SELECT coalesce(max(id), 0) FROM crawldb.page", ())
+
     def page_for_hash(self, hash):
         sql = "SELECT id FROM crawldb.page WHERE hash=%s"
         return self._execute_one(sql, (hash, ))
@@ -110,13 +388,89 @@ class DBApi:
         return result
 
     def select_from_frontier(self):
-        sql = "SELECT id, url, is_binary FROM crawldb.page WHERE page_type_code='FRONTIER' ORDER BY accessed_time"
+        sql = "SELECT id, url, is_binary, priority FROM crawldb.page WHERE page_type_code='FRONTIER' ORDER BY priority DESC, id LIMIT 1"
         cursor = self.conn.cursor
         cursor.execute(sql, ())
         self.conn.commit()
         result = cursor.fetchone()
         return result
 
+    # number of urls waiting in the frontier, counted on the partial frontier index
+    def frontier_size(self):
+        sql = "SELECT count(*) FROM crawldb.page WHERE page_type_code='FRONTIER'"
+        return self._execute_one(sql, ())
+
+    # atomically lease up to `limit` rows to `owner` for `lease` seconds and return them: rows whose
+    # lease expired (their owner died) first, then the highest priority `FRONTIER` rows;
+    # with `shard=(index, count)` only rows whose domain belongs to that shard
+    def claim_from_frontier(self, limit, shard=None, owner=None, lease=DEFAULT_LEASE):
+        shard_filter = ""
+        shard_data = ()
+        if shard is not None:
+            index, count = shard
+            shard_filter = "AND crawldb.url_shard(url, %s) = %s"
+            shard_data = (count, index)
+        sql = """
+            WITH expired AS (
+                SELECT id FROM crawldb.page
+                WHERE page_type_code = 'IN PROGRESS' AND (lease_expires IS NULL OR lease_expires < now()) {0}
+                ORDER BY lease_expires
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            ), fresh AS (
+                SELECT id FROM crawldb.page
+                WHERE page_type_code = 'FRONTIER' {0}
+                ORDER BY priority DESC, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE crawldb.page
+            SET page_type_code = 'IN PROGRESS', leased_by = %s, lease_expires = now() + %s * interval '1 second'
+            WHERE id IN (SELECT id FROM (SELECT id FROM expired UNION ALL SELECT id FROM fresh) AS claimable LIMIT %s)
+            RETURNING id, url, is_binary, priority
+        """.format(shard_filter)
+        data = shard_data + (limit, ) + shard_data + (limit, owner, lease, limit)
+        return self._execute_all(sql, data)
+
+    # extend the leases of all rows `owner` still holds
+    def renew_leases(self, owner, lease=DEFAULT_LEASE):
+        sql = """
+            UPDATE crawldb.page SET lease_expires = now() + %s * interval '1 second'
+            WHERE page_type_code = 'IN PROGRESS' AND leased_by = %s
+        """
+        self.conn.cursor.execute(sql, (lease, owner))
+        self.conn.commit()
+        return self.conn.cursor.rowcount
+
+    # re-lease rows `owner` held before a restart, returns the rows still held
+    def reclaim_leases(self, page_ids, owner, lease=DEFAULT_LEASE):
+        sql = """
+            UPDATE crawldb.page SET lease_expires = now() + %s * interval '1 second'
+            WHERE id = ANY(%s) AND page_type_code = 'IN PROGRESS' AND leased_by = %s
+            RETURNING id, url, is_binary, priority
+        """
+        return self._execute_all(sql, (lease, list(page_ids), owner))
+
+    # hand claimed rows back, anyone may claim them again after `delay` seconds
+    def postpone_leases(self, page_ids, delay):
+        sql = """
+            UPDATE crawldb.page SET leased_by = NULL, lease_expires = now() + %s * interval '1 second'
+            WHERE id = ANY(%s) AND page_type_code = 'IN PROGRESS'
+        """
+        self.conn.cursor.execute(sql, (delay, list(page_ids)))
+        self.conn.commit()
+        return self.conn.cursor.rowcount
+
+    # give every other row leased by `owner` back to the frontier
+    def release_leases(self, owner, keep=()):
+        sql = """
+            UPDATE crawldb.page SET page_type_code = 'FRONTIER', leased_by = NULL, lease_expires = NULL
+            WHERE page_type_code = 'IN PROGRESS' AND leased_by = %s AND NOT id = ANY(%s)
+        """
+        self.conn.cursor.execute(sql, (owner, list(keep)))
+        self.conn.commit()
+        return self.conn.cursor.rowcount
+
     def select_robots_by_domain(self, domain):
         sql = "SELECT robots_content FROM crawldb.site WHERE domain=%s"
         cursor = self.conn.cursor
@@ -125,6 +479,19 @@ class DBApi:
         result = cursor.fetchone()
         return result
 
+    # (site_id, newline separated sitemap locations, last ingestion time) of sites with sitemaps
+    def select_sitemaps(self):
+        sql = "SELECT id, sitemap_content, sitemap_time FROM crawldb.site WHERE sitemap_content LIKE 'http%%'"
+        return self._execute_all(sql, ())
+
+    # (id, robots_content) of `site` with `domain`
+    def site_for_domain(self, domain):
+        sql = "SELECT id, robots_content FROM crawldb.site WHERE domain = %s"
+        cursor = self.conn.cursor
+        cursor.execute(sql, (domain, ))
+        self.conn.commit()
+        return cursor.fetchone()
+
     # find `site` with `domain`
     def site_id_for_domain(self, domain):
         sql = "SELECT * FROM crawldb.site WHERE domain = %s"
@@ -135,6 +502,68 @@ class DBApi:
         sql = "SELECT * FROM crawldb.page WHERE site_id = %s AND url = %s AND page_type_code = 'FRONTIER'"
         return self._execute_one(sql, (site_id, url))
 
+    # subset of `urls` that are stored in `page`
+    def existing_urls(self, urls):
+        sql = "SELECT url FROM crawldb.page WHERE url = ANY(%s)"
+        return [row[0] for row in self._execute_all(sql, (list(urls), ))]
+
+    # stream urls of pages with an id above `since_id` from `page` without loading them at once
+    def iter_urls(self, batch_size=10000, since_id=0):
+        with self.conn.connection.cursor(name="iter_urls") as cursor:
+            cursor.itersize = batch_size
+            cursor.execute("SELECT url FROM crawldb.page WHERE id > %s", (since_id, ))
+            for row in cursor:
+                yield row[0]
+        self.conn.commit()
+
+    # stored HTML of a page, from `page.html_content` or decompressed from `content`
+    def page_html(self, page_id):
+        sql = """
+            SELECT p.html_content, c.codec, c.dictionary_id, c.data
+            FROM crawldb.page p LEFT JOIN crawldb.content c ON c.hash = p.content_hash
+            WHERE p.id = %s
+        """
+        cursor = self.conn.cursor
+        cursor.execute(sql, (page_id, ))
+        self.conn.commit()
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        html_content, codec, dictionary_id, data = row
+        if data is not None:
+            return self.bodies.decode(codec, dictionary_id, data)
+        return html_content
+
+    # compression dictionaries of `content` ...
+
+    def site_dictionary(self, site_id, codec):
+        sql = "SELECT max(id) FROM crawldb.content_dictionary WHERE site_id = %s AND codec = %s"
+        return self._execute_one(sql, (site_id, codec))
+
+    # committed at once, bodies compressed with it may be written in any later transaction
+    def insert_dictionary(self, site_id, codec, data):
+        sql = "INSERT INTO crawldb.content_dictionary (site_id, codec, data) VALUES (%s, %s, %s) RETURNING id"
+        return self._execute_one(sql, (site_id, codec, data))
+
+    def select_dictionary(self, dictionary_id):
+        sql = "SELECT codec, data FROM crawldb.content_dictionary WHERE id = %s"
+        cursor = self.conn.cursor
+        cursor.execute(sql, (dictionary_id, ))
+        self.conn.commit()
+        return cursor.fetchone()
+
+    # (page_id, etag, last_modified, hash, visits, changes, observed_days, accessed_time) of a stored page
+    def revisit_for_url(self, url):
+        sql = """
+            SELECT r.page_id, r.etag, r.last_modified, p.hash, r.visits, r.changes, r.observed_days, p.accessed_time
+            FROM crawldb.page p JOIN crawldb.page_revisit r ON r.page_id = p.id
+            WHERE p.url = %s
+        """
+        cursor = self.conn.cursor
+        cursor.execute(sql, (url, ))
+        self.conn.commit()
+        return cursor.fetchone()
+
     # find `page` with `url`
     def page_for_url(self, url):
         sql = "SELECT * FROM crawldb.page WHERE url = %s"
@@ -1,82 +1,148 @@
 """ Basic web crawl implementation """
 
 import sys
-import os
+import argparse
+import functools
 import time
 import datetime
 
 
 import requests
 import urllib3
-import urlcanon
-import validators
 
-from selenium import webdriver
-from bs4 import BeautifulSoup
-from selenium.webdriver.chrome.options import Options
 from concurrent.futures import ThreadPoolExecutor, Future, ALL_COMPLETED, wait
-from urllib import robotparser, parse
-
-from crawler.utils import DBConn, DBApi
-from crawler.sitemap import *
+from urllib import robotparser
+
+from crawler.utils import BatchError, WriteBatch, is_storage_error
+from crawler.storage import Storage, BACKENDS, DEFAULT_LEASE, DEFAULT_SQLITE_PATH, configure, connect
+from crawler.politeness import PolitenessScheduler
+from crawler.adaptive import AdaptiveController, RetryPolicy, HostDown, status_of, DEFAULT_MIN_DELAY, \
+    DEFAULT_MAX_CONCURRENCY, DEFAULT_RETRIES
+from crawler.frontier import FrontierQueue
+from crawler.seen import SeenUrls
+from crawler.blobs import BlobStore, TooLarge, CHUNK_SIZE
+from crawler.bodies import HTML_STORAGE
+from crawler.robots import SiteInfo, site_cache, DEFAULT_CRAWL_DELAY
+from crawler.render import DriverPool, Renderer, RenderPolicy, ALWAYS
+from crawler.sitemap import SitemapReader, sitemap_locations
 from crawler.hashing import *
+from crawler.links import extract_links
+from crawler.urls import Scope, SCOPE, url_engine, file_type_for_content_type
+from crawler.metrics import metrics
+from crawler.client import http_client
+from crawler.recrawl import Revisit, RecrawlPolicy, default_policy
+from crawler.checkpoint import Checkpoint, lease_owner, DEFAULT_INTERVAL
 
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-supported_files = ["pdf", "doc", "docx", "ppt", "pptx"]
-connections = None
 
 
 class Worker:
     """ Base class for web crawler.
     """
 
-    def __init__(self, id):
+    def __init__(self, id, conn: Storage = None, renderer: Renderer = None, scheduler: PolitenessScheduler = None,
+                 seen: SeenUrls = None, write_window=0.0, dedup: DuplicateIndex = None, blobs: BlobStore = None,
+                 shard=None, recrawl: RecrawlPolicy = None, owner=None, lease=DEFAULT_LEASE):
         self.id = id
-        self.driver = None
         self.root_name = ""
         self.current_page = ""
-
-    def get_chrome_driver(self):
-        chrome_options = Options()
-        chrome_options.add_argument("--headless")
-        chrome_options.add_argument('--ignore-certificate-errors')
-        # chrome_options.accept_untrusted_certs = True
-
-        if sys.platform == "win32":
-            driver_path = os.path.join(os.getcwd(), "chromedriver.exe")
-        else:
-            driver_path = os.path.join(os.getcwd(), "chromedriver")
-
-        self.driver = webdriver.Chrome(driver_path, options=chrome_options)
-        self.driver.set_page_load_timeout(10)
-
-    def add_to_frontier(self, url, site_id, is_binary=False):
-        page_id = self.conn.insert_page(site_id, "FRONTIER", url, None, None, None, is_binary=is_binary)
-        return page_id
+        # without a renderer HTML is always parsed straight from the HTTP body
+        self.renderer = renderer
+        self._conn = conn
+        # when set, politeness delays are enforced by the shared scheduler instead of sleeping
+        self.scheduler = scheduler
+        # shared seen-url filter, `None` falls back to a DB lookup per url
+        self.seen = seen
+        # in-memory fingerprints of stored pages, `None` falls back to a DB lookup per page
+        self.dedup = dedup
+        # files and images are streamed here instead of being stored in the DB
+        self.blobs = blobs
+        # `(index, count)` to claim only urls of domains owned by this shard
+        self.shard = shard
+        # claimed frontier rows are leased under this name for `lease` seconds
+        self.owner = owner or lease_owner(shard)
+        self.lease = lease
+        # when set, stored pages are fetched with conditional requests and revisited by this policy
+        self.recrawl = recrawl
+        # frontier pages, links, images and files are written in bulk
+        self.batch = WriteBatch(max_age=write_window)
+        # frontier row being crawled: its outcome is stored on it and fetch outcomes are reported to the scheduler
+        self.row = None
+
+    def queue_frontier(self, url, site_id, is_binary=False, source_id=None, in_sitemap=False):
+        if self.seen is not None:
+            self.seen.add(url)
+        self.batch.add_frontier(url, site_id, is_binary, source_id, in_sitemap)
+
+    def flush_writes(self, force=False):
+        if len(self.batch) and (force or self.batch.due()):
+            try:
+                with metrics.timer("db_write"):
+                    self.batch.flush(self.conn)
+            except BatchError as e:
+                if self.row is None or self.row[0] in e.errors:
+                    raise
+                # only rows of other pages collected in the write window were lost
+                print("Error writing rows of earlier pages", e)
+                metrics.error("db_write", e)
 
     @property
-    def conn(self) -> DBApi:
-        return connections[self.id]
-
-    def parse_robots(self, url: str):
-        """  Standard robot parser
+    def conn(self) -> Storage:
+        # opened on first use, by the thread running this worker
+        if self._conn is None:
+            self._conn = connect()
+        return self._conn
+
+    def site_info(self, url: str) -> SiteInfo:
+        """ Site id, robots rules and crawl delay for the domain of `url`.
+        """
+        site_domain = self.get_domain_from_url(url)
+        info = site_cache.get(site_domain)
+        if info is not None:
+            return info
+
+        with site_cache.loading(site_domain):
+            # another worker may have loaded it meanwhile
+            info = site_cache.get(site_domain)
+            if info is None:
+                with metrics.timer("robots"):
+                    site_id, robots_parser = self.parse_robots(url, refetch=site_cache.expired(site_domain))
+                info = site_cache.put(site_domain, SiteInfo(site_id, robots_parser))
+        return info
+
+    def parse_robots(self, url: str, refetch=False):
+        """  Standard robot parser, with `refetch` robots.txt of a known site is
+            fetched again instead of read from the DB
         """
         site_domain = self.get_domain_from_url(url)
-        robots_content = self.conn.select_robots_by_domain(site_domain)
+        site = self.conn.site_for_domain(site_domain)
 
         robots_location = "http://" + site_domain + "/robots.txt"
         robots_parser = robotparser.RobotFileParser()
         robots_parser.set_url(robots_location)
 
-        # site_id = self.conn.site_id_for_domain(site_domain)
-        if robots_content:
+        if site and refetch:
+            site_id, robots_content = site
+            try:
+                response = http_client.get(robots_location, timeout=10)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as err:
+                # keep the rules we have
+                print("Unexpected error when refetching robots.txt for {}".format(url), err)
+            else:
+                robots_content = response.text
+                locations = sitemap_locations(robots_content.split("\n"))
+                self.conn.set_robots(site_id, robots_content, "\n".join(locations))
+            robots_parser.parse((robots_content or "").splitlines())
+            return site_id, robots_parser
+        elif site:
             # we have already saw this site
-            site_id = self.conn.site_id_for_domain(site_domain)
-            robots_parser.parse(robots_content)
+            site_id, robots_content = site
+            robots_parser.parse((robots_content or "").splitlines())
             return site_id, robots_parser
         else:
             try:
-                response = requests.get(robots_location, timeout=10)
+                response = http_client.get(robots_location, timeout=10)
                 response.raise_for_status()
                 robots_content = response.text.split("\n")
             except requests.exceptions.RequestException as err:
@@ -88,149 +154,274 @@ class Worker:
 
             robots_parser.parse(robots_content)
 
-            # Sitemap parsing
-            sitemaps = [line for line in robots_content if "Sitemap" in line]
-            links = [link.split(" ")[1] for link in sitemaps]
+            # only the sitemap locations are stored, their urls go to the frontier
+            locations = sitemap_locations(robots_content)
+            site_id = self.conn.insert_site(site_domain, response.text, "\n".join(locations))
+            if locations:
+                self.ingest_sitemaps(site_id, locations)
 
-            sitemaps_content = ""
-
-            urls_to_add = []
+            return site_id, robots_parser
 
-            for link in links:
-                req = requests.get(link)
-                sitemap_urls = parse_xml(req.text)
-                sitemaps_content += req.text + "\n"
-                for url in sitemap_urls:
-                    if not self.is_government_url(url) or self.is_already_visited(url):
-                        continue
-                    urls_to_add.append(url)
+    def ingest_sitemaps(self, site_id: int, locations, since=None):
+        """ Queue the unvisited urls of the sitemaps at `locations`; stored pages
+            whose `<lastmod>` is newer than their last visit are due for a revisit.
+        """
+        started = datetime.datetime.now()
+        added = 0
+        for chunk in SitemapReader().urls(locations, since):
+            urls = url_engine.filter(url for url, _ in chunk)
+            for url in self.unvisited(urls):
+                self.queue_frontier(url, site_id, in_sitemap=True)
+                added += 1
+            self.flush_writes(force=True)
+            modified = [(url_engine.parse(url).url, lastmod) for url, lastmod in chunk if lastmod is not None]
+            if modified:
+                self.conn.revisit_modified(modified)
+        self.conn.set_sitemap_time(site_id, started)
+        print("Added %d urls from sitemap!" % added)
 
-            site_id = self.conn.insert_site(site_domain, response.text, sitemaps_content)
-            for url in urls_to_add:
-                page_id = self.add_to_frontier(url, site_id)
-                print("Added " + url + " to `FRONTIER` page with id " + str(page_id))
+    def parse_url(self, url: str, is_binary: bool):
+        url, site_id, crawl_delay, allowed = self.prepare_url(url, is_binary)
+        if not allowed:
+            self.disallow(url)
+            return
 
-            print("Added %d urls from sitemap!" % len(urls_to_add))
+        if self.scheduler is not None:
+            if crawl_delay is not None:
+                self.scheduler.set_delay(self.get_domain_from_url(url), crawl_delay)
+        else:
+            time.sleep(DEFAULT_CRAWL_DELAY if crawl_delay is None else crawl_delay)
 
-            return site_id, robots_parser
+        # fetch url
+        self.fetch_url(url, site_id, is_binary)
 
-    def parse_url(self, url: str, is_binary: bool):
+    def prepare_url(self, url: str, is_binary: bool):
+        """ Canonicalize `url`, resolve its site id, its robots.txt crawl delay
+            (`None` without one) and whether robots.txt allows fetching it.
+        """
         # unify url representation
-        url = str(self.to_canonical_form(url))
+        url = self.to_canonical_form(url)
 
         if is_binary:
-            site_id = self.conn.site_id_for_domain(self.get_domain_from_url(url))
-            robot_parser = None
-        else:
-            # get robot parser object for current site domain.
-            site_id, robot_parser = self.parse_robots(url)
+            # images and files may live on other hosts, don't fetch their robots.txt
+            site_domain = self.get_domain_from_url(url)
+            info = site_cache.get(site_domain)
+            site_id = info.site_id if info else self.conn.site_id_for_domain(site_domain)
+            return url, site_id, None, True
 
-        default_crawl_delay = 4
-        try:
-            if not robot_parser is None:
-                crawl_delay = robot_parser.crawl_delay('*')
-                if not crawl_delay is None:
-                    default_crawl_delay = int(crawl_delay)
-        except AttributeError:
-            pass
-        time.sleep(default_crawl_delay)
-
-        # fetch url
-        self.fetch_url(url, site_id, is_binary)
+        info = self.site_info(url)
+        return url, info.site_id, info.crawl_delay, info.allows(url)
 
     def fetch_url(self, url: str, site_id: int, is_binary):
+        response = None
         try:
-            response = self.get_response(url)  # this can raise exception
-            status_code = response.status_code
-            time.sleep(0.2)
-
-            if self.should_download_and_save_file(url) or \
-                "msword" in response.headers["Content-Type"] or \
-                "powerpoint" in response.headers["Content-Type"] or \
-                "/vnd.openxmlformats-officedocument.wordprocessingml.document" in response.headers["Content-Type"] or \
-                "/vnd.openxmlformats-officedocument.presentationml.presentation" in response.headers["Content-Type"]:
-
-                self.save_file(url, response)
-            elif is_binary or "image" in response.headers["Content-Type"]:
-                self.save_image(url, response)
-            elif "text/html" in response.headers["Content-Type"]:
-                # open with selenium to render all the javascript
-                try:
-                    self.driver.get(url)
-                    print("Did receive HTML content from: " + str(url))
-                    self.parse_page_content(site_id, url, status_code, datetime.datetime.now())
-                except Exception as e:
-                    print("An error occured while parsing page content: " + str(e) + " from url " + str(url))
-                    page_id = self.conn.page_id_for_page_in_frontier(site_id, url)
-                    if page_id:
-                        self.conn.update_page(page_id, "HTML", None, 500, datetime.datetime.now())
-                    else:
-                        self.conn.insert_page(site_id, "HTML", url, None, 500, datetime.datetime.now())
-            else:
-                print("Content at " + str(url) + " is of unknown content-type. Removing from frontier ...")
-                self.conn.remove_page(url, datetime.datetime.now())
+            revisit = self.revisit_for(url, is_binary)
+            if self.scheduler is not None and self.scheduler.is_down(url):
+                if self.defer():
+                    return
+                raise HostDown("%s is down" % self.get_domain_from_url(url))
+            started = time.monotonic()
+            try:
+                with metrics.timer("fetch"):
+                    response = self.get_response(url, revisit.headers() if revisit else None)
+            except Exception as err:
+                if getattr(err, "response", None) is not None:
+                    err.response.close()
+                if self.record_fetch(started, err):
+                    print("Retrying {} later".format(url), err)
+                    metrics.count("retries", reason=str(status_of(err) or type(err).__name__))
+                    return
+                raise
+            self.record_fetch(started)
+            metrics.count("fetches", domain=self.get_domain_from_url(url))
+            if self.scheduler is None:
+                # the scheduler spaces out requests per host, a pause would only idle this worker
+                time.sleep(0.2)
+            self.handle_response(url, site_id, is_binary, response, revisit)
         except Exception as err:
-            print("Error at {}".format(url), err)
-            page_id = self.conn.page_id_for_page_in_frontier(site_id, url)
-            if page_id:
-                self.conn.update_page(page_id, "HTML", None, 404, datetime.datetime.now())
-            else:
-                self.conn.insert_page(site_id, "HTML", url, None, 404, datetime.datetime.now())
+            self.handle_error(url, site_id, err)
+        finally:
+            if response is not None:
+                # the body is streamed, give the connection back even if it wasn't read
+                response.close()
+
+    def defer(self):
+        """ Hand the current row, of a host that is down, back to the frontier
+            until the host is tried again. `False` once it used up its retries.
+        """
+        delay = self.scheduler.defer(self.row) if self.row is not None else None
+        if delay is None:
+            return False
+        print("Host of {} is down, trying again in {:.0f}s".format(self.row[1], delay))
+        self.conn.postpone_leases([self.row[0]], delay)
+        metrics.count("retries", reason="down")
+        return True
+
+    def record_fetch(self, started, error=None):
+        """ Report the fetch of the current row, started at `started`, to the
+            scheduler. `True` if it will be fetched again after `error`.
+        """
+        if self.scheduler is None or self.row is None:
+            return False
+        return self.scheduler.record(self.row, time.monotonic() - started, error)
+
+    def page_id(self, url: str):
+        """ Id of the page `url` is stored as: the claimed row being crawled
+            (stored under the url it was found as, which may not be canonical)
+            or the page stored under `url`.
+        """
+        if self.row is not None:
+            return self.row[0]
+        return self.conn.page_for_url(url)
+
+    def revisit_for(self, url: str, is_binary) -> Revisit:
+        """ Validators and visit history of `url` if it is being recrawled. """
+        if self.recrawl is None or is_binary:
+            return None
+        row = self.conn.revisit_for_url(url)
+        return Revisit(*row) if row else None
+
+    def handle_response(self, url: str, site_id: int, is_binary, response, revisit: Revisit = None):
+        """ Store fetched `response` according to its content type.
+        """
+        status_code = response.status_code
+        if status_code == 304:
+            self.not_modified(url, response, revisit)
+            return
 
-    def parse_page_content(self, site_id: int, url: str, status_code, accessed_time):
-        document = self.driver.page_source
-        hashed = hash_document(document)
+        content_type = response.headers["Content-Type"]
+
+        if self.should_download_and_save_file(url) or file_type_for_content_type(content_type):
+            self.save_file(url, response)
+        elif is_binary or "image" in content_type:
+            self.save_image(url, response)
+        elif "text/html" in content_type:
+            try:
+                document = response.text
+                if self.renderer is not None:
+                    # open with selenium to render the javascript if the page needs it
+                    document = self.renderer.document_for(url, self.get_domain_from_url(url), document)
+                print("Did receive HTML content from: " + str(url))
+                self.parse_page_content(site_id, url, status_code, datetime.datetime.now(), document,
+                                        headers=response.headers, revisit=revisit)
+            except Exception as e:
+                print("An error occured while parsing page content: " + str(e) + " from url " + str(url))
+                metrics.error("db_write" if is_storage_error(e) else "parse", e)
+                self.store_failure(url, site_id, 500)
+        else:
+            print("Content at " + str(url) + " is of unknown content-type. Removing from frontier ...")
+            self.conn.remove_page(url, datetime.datetime.now())
+            metrics.count("pages", page_type_code="UNKNOWN")
+
+    def not_modified(self, url: str, response, revisit: Revisit):
+        print("Not modified: " + url)
+        metrics.count("revisits", result="not_modified")
+        if revisit is None:
+            # answered a request that wasn't conditional, leave the page alone
+            return
+        self.record_visit(revisit.page_id, revisit, False, response.headers, unchanged=True)
+        self.flush_writes()
+
+    def record_visit(self, page_id, revisit: Revisit, changed, headers, unchanged=False):
+        """ Queue the validators and updated change-rate estimate of `page_id`. """
+        accessed_time = datetime.datetime.now()
+        policy = self.recrawl or default_policy
+        row = policy.visit(page_id, revisit, changed, accessed_time, headers.get("ETag"), headers.get("Last-Modified"))
+        self.batch.add_visit(row, accessed_time if unchanged else None)
+
+    def disallow(self, url: str):
+        print("Url " + url + " is disallowed by robots.txt. Removing from frontier ...")
+        page_id = self.page_id(url)
+        if page_id:
+            self.conn.update_page(page_id, "UNKNOWN", None, None, datetime.datetime.now())
+            self.conn.commit()
+        metrics.count("disallowed")
+
+    def handle_error(self, url: str, site_id: int, err):
+        print("Error at {}".format(url), err)
+        metrics.error("db_write" if is_storage_error(err) else "fetch", err)
+        # errors without a response are stored as 404
+        self.store_failure(url, site_id, status_of(err) or 404)
+
+    def store_failure(self, url: str, site_id: int, status_code):
+        """ Store `url` as a page without content. """
+        page_id = self.page_id(url)
+        if page_id:
+            self.conn.update_page(page_id, "HTML", None, status_code, datetime.datetime.now())
+        else:
+            self.conn.insert_page(site_id, "HTML", url, None, status_code, datetime.datetime.now())
+
+    def parse_page_content(self, site_id: int, url: str, status_code, accessed_time, document: str,
+                           headers=None, revisit: Revisit = None):
+        with metrics.timer("hash"):
+            hashed = hash_document(document)
+            if revisit is not None and revisit.hash == hashed:
+                # fetched in full (no validators), but nothing changed since the last visit
+                print("Unchanged page at url: " + url)
+                metrics.count("revisits", result="unchanged")
+                self.record_visit(revisit.page_id, revisit, False, headers or {}, unchanged=True)
+                self.flush_writes()
+                return
+            near_hashed = to_bigint(simhash(document))
 
-        existing_page_id = self.conn.page_for_url(url)
+        existing_page_id = self.page_id(url)
 
         try:
-            duplicate_id = self.conn.page_for_hash(hashed)
-            if duplicate_id:
+            if self.dedup is not None:
+                duplicate_id, exact = self.dedup.find(hashed, near_hashed)
+            else:
+                duplicate_id, exact = self.conn.page_for_hash(hashed), True
+            if duplicate_id == existing_page_id:
+                duplicate_id = None
+            if duplicate_id and exact:
                 if existing_page_id:
                     self.conn.update_page(existing_page_id, "DUPLICATE", None, status_code, accessed_time, duplicate_page_id=duplicate_id)
                     print("Updated page to `DUPLICATE` with id " + str(existing_page_id) + " at url: " + url)
                 else:
                     page_id = self.conn.insert_page(site_id, "DUPLICATE", url, None, status_code, accessed_time, duplicate_page_id=duplicate_id)
                     print("Added `DUPLICATE` page with id " + str(page_id) + " at url: " + url)
+                metrics.count("pages", page_type_code="DUPLICATE")
                 return
             else:
+                # a near duplicate may still differ in what matters, it is stored (and its links followed)
+                # with a reference to the page it resembles
+                near_id = duplicate_id or -1
+                if duplicate_id:
+                    print("Page at url: " + url + " is a near duplicate of page " + str(duplicate_id))
+                    metrics.count("near_duplicates")
                 if existing_page_id:
-                    self.conn.update_page(existing_page_id, "HTML", document, status_code, accessed_time, hash=hashed)
+                    self.conn.update_page(existing_page_id, "HTML", document, status_code, accessed_time, duplicate_page_id=near_id, hash=hashed, simhash=near_hashed, site_id=site_id)
                     print("Updated page to `HTML` with id " + str(existing_page_id) + " at url: " + url)
                 else:
-                    existing_page_id = self.conn.insert_page(site_id, "HTML", url, document, status_code, accessed_time, hash=hashed)
+                    existing_page_id = self.conn.insert_page(site_id, "HTML", url, document, status_code, accessed_time, hash=hashed, duplicate_page_id=near_id, simhash=near_hashed)
                     if not existing_page_id:
                         return
                     print("Added `HTML` page with id " + str(existing_page_id) + " at url: " + url)
+                if self.dedup is not None:
+                    self.dedup.add(existing_page_id, hashed, near_hashed)
+                metrics.count("pages", page_type_code="HTML")
+                if revisit is not None:
+                    metrics.count("revisits", result="changed")
+                self.record_visit(existing_page_id, revisit, True, headers or {})
         except Exception as e:
             print(e)
+            metrics.error("db_write", e)
             return
 
         if not existing_page_id:
             print()
 
-        soup = BeautifulSoup(document, 'html.parser')
-
-        base_url_for_image = None
-        base_tags_urls = [base_url.get('href') for base_url in soup.findAll('base')]
-        if len(base_tags_urls) > 0:
-            base_url_for_image = base_tags_urls[0]
-
-        hrefs = [
-            str(self.to_canonical_form(a.get("href")))
-            for a in soup.find_all(href=True)
-            if self.is_valid_url(a.get("href"))
-        ]
+        with metrics.timer("parse"):
+            hrefs, image_sources = self.extract_links(document, url)
         print("Found " + str(len(hrefs)) + " potential new urls")
 
+        hrefs = [info.url for info in url_engine.parse_many(hrefs) if info.in_scope]
         added = 0
-        for href in hrefs:
-            if not self.is_government_url(href) or self.is_already_visited(href):
-                continue
-            # print("Added " + href + " to `FRONTIER` page with id " + str(page_id))
-            page_id = self.add_to_frontier(href, site_id)
-            self.conn.insert_link(existing_page_id, page_id)
+        for href in self.unvisited(hrefs):
+            self.queue_frontier(href, site_id, source_id=existing_page_id)
             added += 1
+        for href in hrefs:
+            self.batch.add_link(existing_page_id, href)
 
         print("Added " + str(added) + " new urls from hrefs")
 
@@ -251,97 +442,157 @@ class Worker:
         # print("Added " + str(added) + " new urls from js click")
 
         # Image collection
-        images = [a.get("src") for a in soup.find_all('img')]
-        image_sources = []
-        added = 0
-        for img in images:
-            if self.is_valid_url(img):
-                image_sources.append(img)
-                added += 1
-                if self.is_already_visited(img):
-                    continue
-                self.add_to_frontier(img, site_id, True)
-            else:
-                if not base_url_for_image is None:
-                    img = self.to_canonical_form(os.path.join(base_url_for_image, img))
+        for img in self.unvisited(image_sources):
+            self.queue_frontier(img, site_id, True, source_id=existing_page_id)
 
-                if self.is_valid_url(img) and 'base64' not in img:
-                    image_sources.append(img)
-                    added += 1
-                    if self.is_already_visited(img):
-                        continue
-                    self.add_to_frontier(img, site_id, True)
+        print("Added " + str(len(image_sources)) + " new images to list")
+        self.flush_writes()
 
-        print("Added " + str(added) + " new images to list")
+    @staticmethod
+    def extract_links(document: str, url: str = None):
+        """ Canonical hrefs and image sources found in `document` at `url`.
+        """
+        return extract_links(document, url)
 
     def save_file(self, url: str, response):
-        page_id = self.conn.page_for_url(url)
+        page_id = self.page_id(url)
 
-        data_type_code = [
-            extension
-            for extension in supported_files
-            if extension in url
-        ]
+        data_type_code = url_engine.parse(url).file_type or \
+            file_type_for_content_type(response.headers["Content-Type"])
         if not data_type_code:
             # something went wrong! abort ..
             print("Error storing file from %s! Invalid Content-Type: %s" % (url, response.headers["Content-Type"]))
             self.conn.update_page(page_id, "BINARY", None, 500, datetime.datetime.now(), is_binary=True)
             return
 
-        self.conn.insert_page_data(page_id, data_type_code[0].upper(), response.content)
+        try:
+            data, blob_key = self.read_body(response)
+        except TooLarge as e:
+            print("File at %s is too large, not storing it: %s" % (url, e))
+            self.conn.update_page(page_id, "BINARY", None, response.status_code, datetime.datetime.now(), is_binary=True)
+            self.conn.commit()
+            return
+
         self.conn.update_page(page_id, "BINARY", None, 200, datetime.datetime.now())
+        metrics.count("pages", page_type_code="BINARY")
+        self.batch.add_page_data(page_id, data_type_code, data, blob_key)
+        self.flush_writes()
 
     def save_image(self, url: str, response):
-        page_id = self.conn.page_for_url(url)
-        file_name = url.split("/")[-1:]
-        self.conn.insert_image(page_id,
-                               file_name,
-                               response.headers["Content-Type"],
-                               response.content,
-                               datetime.datetime.now())
+        page_id = self.page_id(url)
+        file_name = url.split("/")[-1]
+        try:
+            data, blob_key = self.read_body(response)
+        except TooLarge as e:
+            print("Image at %s is too large, not storing it: %s" % (url, e))
+            data, blob_key = None, None
+
         self.conn.update_page(page_id, "BINARY", None, 200, datetime.datetime.now(), is_binary=True)
+        metrics.count("pages", page_type_code="BINARY")
+        self.batch.add_image(page_id,
+                             file_name,
+                             response.headers["Content-Type"],
+                             data,
+                             datetime.datetime.now(),
+                             blob_key)
+        self.flush_writes()
+
+    def read_body(self, response):
+        """ Body of a binary `response` as `(data, blob_key)`. With a blob store
+            the body is streamed to disk and only its key is kept.
+        """
+        if self.blobs is None:
+            return response.content, None
+
+        length = response.headers.get("Content-Length")
+        if length and length.isdigit() and self.blobs.max_size and int(length) > self.blobs.max_size:
+            raise TooLarge("Content-Length is %s bytes" % length)
+        blob_key, _ = self.blobs.save(response.iter_content(CHUNK_SIZE))
+        return None, blob_key
 
     def dequeue_url(self):
+        if self.scheduler is not None:
+            return self.dequeue_scheduled_url()
+
+        frontier = FrontierQueue(self.conn, shard=self.shard, owner=self.owner, lease=self.lease)
         retry_count = 50
-        while True:
-            try:
-                # Fetch URLs from Frontier.
-                if retry_count == 0:
-                    print("Finished crawling")
-                    return
+        try:
+            while True:
+                # not known yet if claiming fails
+                url = None
+                try:
+                    # Fetch URLs from Frontier.
+                    if retry_count == 0:
+                        print("Finished crawling")
+                        return
 
-                result = self.conn.select_from_frontier()
-                if not result:
-                    time.sleep(10)
-                    retry_count -= 1
-                    continue
-                retry_count = 50
-                id, url, is_binary = result
-                self.conn.update_page(id, "IN PROGRESS", None, None, None)
+                    result = frontier.get()
+                    if not result:
+                        time.sleep(10)
+                        retry_count -= 1
+                        continue
+                    retry_count = 50
+                    id, url, is_binary, priority = result
 
-                # print(os.getpid(), "got", url, 'is empty:', frontier.empty())
+                    self.row = result
+                    self.parse_url(url, is_binary)
+                    print('Dequed: ', url)
+                except Exception as e:
+                    print("Error while crawling {}".format(url), e)
+                    metrics.error("crawl", e)
+                    continue
+                finally:
+                    self.row = None
+        finally:
+            frontier.release()
+
+    def dequeue_scheduled_url(self):
+        retry_count = 5
+        while retry_count:
+            # blocks until some domain is allowed to be fetched
+            result = self.scheduler.get()
+            if not result:
+                retry_count -= 1
+                continue
+            retry_count = 5
+            id, url, is_binary, priority = result
+            self.row = result
+            try:
                 self.parse_url(url, is_binary)
                 print('Dequed: ', url)
-            except:
-                continue
+            except Exception as e:
+                print("Error while crawling {}".format(url), e)
+                metrics.error("crawl", e)
+            finally:
+                self.row = None
+                self.scheduler.release(result)
+        print("Finished crawling")
 
     @staticmethod
-    def get_response(url: str):
+    def get_response(url: str, headers=None):
         """ This is where we fetch url content using request. We need to do that if we want to download files
             and we need this for storing status codes.
         """
-        response = requests.get(url, timeout=10, allow_redirects=False, verify=False)
+        response = http_client.get(url, headers=headers, timeout=10, allow_redirects=False, verify=False, stream=True)
         response.raise_for_status()
         return response
 
     @staticmethod
     def is_government_url(url: str):
-        return ".gov.si" in url
+        return url_engine.parse(url).in_scope
 
     def is_already_visited(self, url: str):
+        if self.seen is not None:
+            return self.seen.contains(url, self.conn)
         page_id = self.conn.page_for_url(url)
         return page_id
 
+    def unvisited(self, urls):
+        """ Unique `urls` that are not stored yet, in order. """
+        if self.seen is not None:
+            return self.seen.filter_unseen(urls, self.conn)
+        return [url for url in dict.fromkeys(urls) if not self.is_already_visited(url)]
+
     @staticmethod
     def is_allowed_by_robots(url: str, robot: robotparser.RobotFileParser):
         if not robot or not isinstance(robot, robotparser.RobotFileParser):
@@ -350,30 +601,25 @@ class Worker:
 
     @staticmethod
     def should_download_and_save_file(url):
-        for f in supported_files:
-            if f in url:
-                return True
-        return False
+        return url_engine.parse(url).file_type is not None
 
     @staticmethod
     def get_domain_from_url(url: str):
-        return "{uri.netloc}/".format(uri=parse.urlparse(url)).replace('www.', '')[:-1]  # remove trailing slash
+        return url_engine.parse(url).domain
 
     @staticmethod
     def to_canonical_form(url: str):
-        return str(urlcanon.semantic(urlcanon.parse_url(url)))
-
-    @staticmethod
-    def to_canonical(url: str):
-        return urlcanon.semantic(urlcanon.parse_url(url))
+        return url_engine.parse(url).url
 
     @staticmethod
     def is_valid_url(url: str):
-        return validators.url(url)
+        return url_engine.parse(url).valid
 
     def __call__(self):
-        self.get_chrome_driver()
-        return self.dequeue_url()
+        try:
+            return self.dequeue_url()
+        finally:
+            self.flush_writes(force=True)
 
 
 def _future_callback(future: Future):
@@ -382,31 +628,172 @@ def _future_callback(future: Future):
 
 DEFAULT_CONCURRENT_WORKERS = 4
 
-if __name__ == "__main__":
-    sites = [
-        "http://evem.gov.si/",
-        "https://e-uprava.gov.si/",
-        "https://podatki.gov.si/",
-        "http://www.e-prostor.gov.si/",
-        # additional
-        'http://www.gov.si/',
-        'http://prostor3.gov.si/preg/',
-        'https://egp.gu.gov.si/egp/',
-        'http://www.gu.gov.si/',
-        'https://gis.gov.si/ezkn/'
-    ]
-
-    workers = int(sys.argv[1]) if len(sys.argv) >= 2 else DEFAULT_CONCURRENT_WORKERS
-    connections = {id: DBApi(DBConn()) for id in range(workers)}
-
-    api = DBApi(DBConn())
-    api.in_progress_to_frontier()
+SITES = [
+    "http://evem.gov.si/",
+    "https://e-uprava.gov.si/",
+    "https://podatki.gov.si/",
+    "http://www.e-prostor.gov.si/",
+    # additional
+    'http://www.gov.si/',
+    'http://prostor3.gov.si/preg/',
+    'https://egp.gu.gov.si/egp/',
+    'http://www.gu.gov.si/',
+    'https://gis.gov.si/ezkn/'
+]
+
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Crawl *.gov.si sites.")
+    parser.add_argument("workers", nargs="?", type=int, default=DEFAULT_CONCURRENT_WORKERS,
+                        help="number of threaded workers")
+    parser.add_argument("--mode", choices=["threads", "async"], default="threads",
+                        help="one blocking Worker per thread, or a single asyncio event loop")
+    parser.add_argument("--concurrency", type=int, default=1000,
+                        help="in-flight fetches in async mode")
+    parser.add_argument("--write-window", type=float, default=0.0,
+                        help="seconds to collect discovered rows before writing them (0 writes after every page)")
+    parser.add_argument("--blob-dir", default="blobs",
+                        help="directory for downloaded files and images, empty to keep them in the DB")
+    parser.add_argument("--max-file-size", type=int, default=50,
+                        help="largest file or image to download, in MB")
+    parser.add_argument("--chrome", type=int, default=2,
+                        help="size of the headless Chrome pool, independent of the number of workers")
+    parser.add_argument("--chrome-max-pages", type=int, default=500,
+                        help="restart a Chrome instance after this many pages")
+    parser.add_argument("--chrome-max-memory", type=int, default=1024,
+                        help="restart a Chrome instance once it uses more MB than this")
+    parser.add_argument("--render", choices=["auto", "always", "never"], default="auto",
+                        help="render HTML with Chrome only when it looks JavaScript dependent, always, or never")
+    parser.add_argument("--scope", nargs="+", default=list(SCOPE),
+                        help="domain suffixes of the hosts to crawl")
+    parser.add_argument("--sleep", action="store_true",
+                        help="sleep the crawl delay on each worker instead of using the per-host scheduler")
+    parser.add_argument("--min-delay", type=float, default=DEFAULT_MIN_DELAY,
+                        help="shortest delay between requests to a healthy host without a robots.txt Crawl-delay")
+    parser.add_argument("--max-host-concurrency", type=int, default=DEFAULT_MAX_CONCURRENCY,
+                        help="most requests in flight to one healthy host")
+    parser.add_argument("--retries", type=int, default=DEFAULT_RETRIES,
+                        help="times a url is fetched again after a timeout, connection error, 429 or 5xx response")
+    parser.add_argument("--pool-size", type=int, default=8,
+                        help="keep-alive connections per host")
+    parser.add_argument("--dns-ttl", type=int, default=300,
+                        help="seconds to cache DNS lookups")
+    parser.add_argument("--http2", action="store_true",
+                        help="fetch with HTTP/2 where supported (needs httpx[http2])")
+    parser.add_argument("--recrawl", action="store_true",
+                        help="requeue stored pages that are due for a revisit and fetch them with conditional requests")
+    parser.add_argument("--metrics-port", type=int, default=9100,
+                        help="serve Prometheus metrics on this local port (plus the shard index), 0 to disable")
+    parser.add_argument("--metrics-file",
+                        help="also append a JSON metrics snapshot to this file")
+    parser.add_argument("--metrics-interval", type=int, default=60,
+                        help="seconds between JSON metrics snapshots")
+    parser.add_argument("--backend", choices=BACKENDS, default="postgres",
+                        help="crawldb on Postgres, or an embedded SQLite file without a database server")
+    parser.add_argument("--sqlite-path", default=DEFAULT_SQLITE_PATH,
+                        help="database file of the sqlite backend")
+    parser.add_argument("--html-storage", choices=HTML_STORAGE, default="inline",
+                        help="HTML in page.html_content, or compressed once per unique body in the content table "
+                             "(zstd with per-site dictionaries if zstandard is installed, needs migration 10 on Postgres)")
+    parser.add_argument("--checkpoint", default="crawl.checkpoint",
+                        help="file to save the in-memory crawl state to and resume from (plus the shard index), "
+                             "empty to disable")
+    parser.add_argument("--checkpoint-interval", type=int, default=DEFAULT_INTERVAL,
+                        help="seconds between checkpoints")
+    parser.add_argument("--lease", type=int, default=DEFAULT_LEASE,
+                        help="seconds a claimed url stays reserved for this crawl without renewal")
+    return parser
+
+
+def prepare_frontier(api: Storage, worker: "Worker" = None, recrawl=False):
+    """ With `recrawl` requeue pages due for a revisit, seed an empty frontier.
+
+        Interrupted pages need no reset, their leases expire (or are released
+        by the restarted crawl, see `Checkpoint.resume`).
+    """
+    worker = worker or Worker(0, conn=api)
+    if recrawl:
+        # new sitemap entries and lastmod dates feed the revisit schedule
+        for site_id, locations, since in api.select_sitemaps():
+            worker.ingest_sitemaps(site_id, locations.splitlines(), since)
+        print("Requeued %d pages due for a revisit" % api.requeue_due(datetime.datetime.now()))
     if not api.select_from_frontier():
-        worker = Worker(0)
-        for url in sites:
-            worker.get_chrome_driver()
+        for url in SITES:
             worker.parse_url(url, False)
 
+
+def crawl(args, shard=None, setup=True):
+    """ Crawl with the command line `args`.
+
+        With `shard=(index, count)` only urls whose domain hashes to `index`
+        are claimed, see `crawler.shard`. `setup` requeues and seeds the
+        frontier first; a sharded crawl does that once for all shards.
+    """
+    workers = args.workers
+    configure(args.backend, args.sqlite_path, args.html_storage)
+    url_engine.configure(Scope(args.scope))
+
+    api = connect()
+    http_client.configure(pool_maxsize=args.pool_size, dns_ttl=args.dns_ttl, http2=args.http2)
+
+    if args.metrics_port:
+        # local shards listen on consecutive ports
+        metrics.serve(args.metrics_port + (shard[0] if shard else 0))
+    if args.metrics_file:
+        metrics.write_snapshots(args.metrics_file, args.metrics_interval)
+    # own connection, the gauge is read from the metrics server thread
+    metrics_api = connect()
+    metrics.gauge("frontier_size", metrics_api.frontier_size)
+
+    checkpoint_path = args.checkpoint
+    if checkpoint_path and shard is not None:
+        checkpoint_path += ".%d" % shard[0]
+    checkpoint = Checkpoint(checkpoint_path, shard, args.lease, args.checkpoint_interval)
+    # the run of the resumed checkpoint, or a new one
+    owner = checkpoint.owner
+
+    seen = SeenUrls()
+    dedup = DuplicateIndex()
+    blobs = BlobStore(args.blob_dir, args.max_file_size * 2 ** 20) if args.blob_dir else None
+
+    recrawl = RecrawlPolicy() if args.recrawl else None
+
+    renderer = None
+    if args.render != "never":
+        policy = RenderPolicy(default=ALWAYS if args.render == "always" else None)
+        pool = DriverPool(args.chrome, max_pages=args.chrome_max_pages, max_memory=args.chrome_max_memory * 2 ** 20)
+        renderer = Renderer(pool, policy)
+
+    scheduler = None
+    if args.mode == "threads" and not args.sleep:
+        controller = AdaptiveController(min_delay=args.min_delay, max_concurrency=args.max_host_concurrency,
+                                        retry=RetryPolicy(args.retries))
+        scheduler = PolitenessScheduler(Worker.get_domain_from_url,
+                                        refill=functools.partial(api.claim_from_frontier, shard=shard,
+                                                                 owner=owner, lease=args.lease),
+                                        controller=controller)
+        metrics.gauge("scheduler_buffered", lambda: scheduler.buffered)
+        metrics.gauge("scheduler_hosts", lambda: len(scheduler.queues))
+        metrics.gauge("scheduler_parked", lambda: len(controller.parked))
+        metrics.gauge("scheduler_retries", lambda: len(scheduler.retries))
+
+    checkpoint.resume(api, seen, dedup, scheduler)
+    checkpoint.start(seen, dedup, scheduler)
+
+    if setup:
+        prepare_frontier(api, Worker(0, conn=api, renderer=renderer, seen=seen, dedup=dedup, blobs=blobs,
+                                     owner=owner, lease=args.lease),
+                         recrawl=args.recrawl)
+
+    if args.mode == "async":
+        from crawler.async_fetch import AsyncCrawler
+        crawler = AsyncCrawler(concurrency=args.concurrency, seen=seen, dedup=dedup, blobs=blobs, shard=shard,
+                               recrawl=recrawl, owner=owner, lease=args.lease)
+        print("Fetched %d pages" % crawler())
+        http_client.report()
+        checkpoint.save(api, seen, dedup)
+        return
+
     with ThreadPoolExecutor(max_workers=workers) as executor:
 
         def submit_worker(_f):
@@ -414,10 +801,24 @@ if __name__ == "__main__":
             _future.add_done_callback(_future_callback)
             return _future
 
-        futures = [submit_worker(Worker(id)) for id in range(workers)]
+        futures = [submit_worker(Worker(id, renderer=renderer, scheduler=scheduler, seen=seen,
+                                        write_window=args.write_window, dedup=dedup, blobs=blobs, shard=shard,
+                                        recrawl=recrawl, owner=owner, lease=args.lease))
+                   for id in range(workers)]
 
         # This will stop our crawler when none of the running
         # processes cant fetch URL from Frontier
         wait(futures, return_when=ALL_COMPLETED)
+        checkpoint.save(api, seen, dedup, scheduler)
 
+        http_client.report()
+        if scheduler is not None:
+            scheduler.report()
+        if renderer is not None:
+            renderer.report()
+            renderer.close()
+
+
+if __name__ == "__main__":
+    crawl(argument_parser().parse_args())
     sys.exit(0)
@@ -0,0 +1,200 @@
+""" Adaptive host control and retries against a stand-in server answering 429 and 503 """
+
+import random
+import threading
+import time
+
+import pytest
+
+from crawler.adaptive import AdaptiveController, RetryPolicy
+from crawler.bench import StandInHandler, StandInServer
+from crawler.client import http_client
+from crawler.politeness import PolitenessScheduler
+from crawler.sqlite_storage import SqliteApi
+from crawler.web_crawler import Worker
+
+
+class ScriptedHandler(StandInHandler):
+    """ Answers page requests with the `(status, Retry-After)` pairs queued in
+        `server.script`, then like `StandInHandler`.
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            if self.path.startswith("/page/"):
+                server.requests += 1
+            answer = server.script.pop(0) if server.script and self.path.startswith("/page/") else None
+        if answer is None:
+            return super().do_GET()
+        status, retry_after = answer
+        self.send_response(status)
+        if retry_after is not None:
+            self.send_header("Retry-After", retry_after)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    # no proxies from the environment between the tests and the stand-in server
+    monkeypatch.setattr(http_client.session, "trust_env", False)
+    with StandInServer(handler=ScriptedHandler) as server:
+        server.httpd.lock = threading.Lock()
+        server.httpd.script = []
+        server.httpd.requests = 0
+        yield server
+
+
+@pytest.fixture
+def api(tmp_path):
+    api = SqliteApi(str(tmp_path / "crawl.sqlite"))
+    yield api
+    api.close()
+
+
+def failure(server, status, retry_after=None):
+    """ The exception `Worker.get_response` raises for a `status` answer. """
+    server.httpd.script.append((status, retry_after))
+    with pytest.raises(Exception) as info:
+        Worker.get_response(server.base_url + "/page/1")
+    return info.value
+
+
+def test_throttle_parks_host_and_cuts_only_concurrency(server):
+    controller = AdaptiveController(default_delay=1.0, min_delay=0.1, max_concurrency=4)
+    host = controller.host("host")
+    for _ in range(100):
+        controller.record("host", 0.0, 0.01)
+    assert host.limit == 4 and host.interval == 0.1
+
+    controller.record("host", 100.0, 0.01, failure(server, 429, "30"))
+    assert controller.parked_until("host") == 130.0
+    assert host.limit == 2
+    assert host.interval == 0.1
+
+
+def test_failures_back_off_and_recover(server):
+    controller = AdaptiveController(default_delay=1.0, min_delay=0.1, max_delay=8.0, park_after=10)
+    host = controller.host("host")
+
+    # 503 without Retry-After: multiplicative decrease of rate and concurrency
+    now = 0.0
+    for expected in (2.0, 4.0, 8.0, 8.0):
+        now += 1.0
+        controller.record("host", now, 0.01, failure(server, 503))
+        assert host.interval == expected and host.limit == 1
+    assert not controller.parked_until("host")
+
+    # normal responses add to the rate and the concurrency again
+    for _ in range(200):
+        now += 0.01
+        controller.record("host", now, 0.01)
+    assert host.interval == 0.1
+    assert host.limit == controller.max_concurrency
+
+
+def test_failure_streak_parks_then_takes_host_down(server):
+    controller = AdaptiveController(default_delay=1.0, min_delay=0.1, park_after=2, park_time=10.0, max_parks=2,
+                                    max_park=60.0)
+    host = controller.host("host")
+    error = failure(server, 503)
+
+    controller.record("host", 1.0, 0.01, error)
+    controller.record("host", 2.0, 0.01, error)
+    # parked, and back at the interval from before the streak
+    assert controller.parked_until("host") == 12.0
+    assert host.interval == 1.0
+    assert not controller.is_down("host", 12.0)
+
+    controller.record("host", 13.0, 0.01, error)
+    controller.record("host", 14.0, 0.01, error)
+    assert controller.is_down("host", 15.0)
+    assert not controller.is_down("host", 75.0)
+
+
+def test_retry_policy(server):
+    policy = RetryPolicy(retries=2, base=1.0, cap=10.0, rnd=random.Random(1))
+    unavailable = failure(server, 503)
+    assert 0 <= policy.delay(1, unavailable) <= 1.0
+    assert 0 <= policy.delay(2, unavailable) <= 2.0
+    assert policy.delay(3, unavailable) is None
+    # a longer Retry-After wins over the backoff, up to the cap
+    assert policy.delay(1, failure(server, 429, "5")) == 5.0
+    assert policy.delay(1, failure(server, 429, "3600")) == 10.0
+    assert policy.delay(1, failure(server, 404)) is None
+
+
+def test_scheduler_requeues_until_retries_are_used_up(server):
+    scheduler = PolitenessScheduler(Worker.get_domain_from_url, max_delay=0, timeout=2,
+                                    controller=AdaptiveController(retry=RetryPolicy(retries=2, base=0.01)))
+    row = (1, server.base_url + "/page/1", False, 1.0)
+    scheduler.put(row)
+
+    for _ in range(2):
+        assert scheduler.get() == row
+        assert scheduler.record(row, 0.01, failure(server, 503, "0"))
+        scheduler.release(row)
+    assert scheduler.get() == row
+    assert not scheduler.record(row, 0.01, failure(server, 503, "0"))
+    assert scheduler.get(timeout=0.1) is None
+
+
+def crawl(api, server, script, retries):
+    """ Queue one page, answered with `script` first, and crawl until the frontier is empty. """
+    site_id = api.insert_site(Worker.get_domain_from_url(server.base_url + "/"), "", "")
+    url = server.base_url + "/page/1"
+    page_id = api.insert_page(site_id, "FRONTIER", url, None, None, None)
+    server.httpd.script.extend(script)
+
+    scheduler = PolitenessScheduler(Worker.get_domain_from_url, refill=api.claim_from_frontier, max_delay=0,
+                                    timeout=0.2, refill_backoff=0.05,
+                                    controller=AdaptiveController(retry=RetryPolicy(retries, base=0.01)))
+    Worker(0, conn=api, scheduler=scheduler).dequeue_scheduled_url()
+    return api.cursor.execute("SELECT page_type_code, http_status_code, leased_by, lease_expires FROM page "
+                              "WHERE id = ?", (page_id, )).fetchone()
+
+
+def test_worker_retries_throttled_page(api, server):
+    page = crawl(api, server, [(503, "0"), (429, "0")], retries=3)
+    assert page == ("HTML", 200, None, None)
+    assert server.httpd.requests == 3
+
+
+def test_worker_stores_status_once_retries_are_used_up(api, server):
+    page = crawl(api, server, [(503, "0")] * 3, retries=2)
+    assert page == ("HTML", 503, None, None)
+    assert server.httpd.requests == 3
+
+
+def test_worker_hands_rows_of_down_host_back_to_frontier(api, server):
+    controller = AdaptiveController(max_delay=0, park_after=1, max_parks=1, max_park=60.0,
+                                    retry=RetryPolicy(retries=2, base=0.01))
+    scheduler = PolitenessScheduler(Worker.get_domain_from_url, max_delay=0, controller=controller)
+    site_id = api.insert_site(Worker.get_domain_from_url(server.base_url + "/"), "", "")
+    url = server.base_url + "/page/1"
+    api.insert_page(site_id, "FRONTIER", url, None, None, None)
+    row, = api.claim_from_frontier(1, owner="a")
+
+    worker = Worker(0, conn=api, scheduler=scheduler)
+    worker.row = row
+    # a failure takes the host down (one park allowed), the row is retried later
+    server.httpd.script.append((500, None))
+    worker.fetch_url(url, site_id, False)
+    assert scheduler.is_down(url)
+
+    # no request while it is down: the lease is handed back until the host is tried again
+    requests = server.httpd.requests
+    worker.fetch_url(url, site_id, False)
+    assert server.httpd.requests == requests
+    page_type, status, leased_by, lease_expires = api.cursor.execute(
+        "SELECT page_type_code, http_status_code, leased_by, lease_expires FROM page WHERE id = ?", (row[0], )).fetchone()
+    assert (page_type, status, leased_by) == ("IN PROGRESS", None, None)
+    assert lease_expires > time.time() + 30
+    assert api.claim_from_frontier(1, owner="b") == []
+
+    # with its retries used up it fails with `HostDown`, without a request
+    worker.fetch_url(url, site_id, False)
+    assert server.httpd.requests == requests
+    assert api.cursor.execute("SELECT page_type_code, leased_by FROM page WHERE id = ?",
+                              (row[0], )).fetchone() == ("HTML", None)
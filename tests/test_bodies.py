@@ -0,0 +1,101 @@
+""" `BodyCodec` round trips and deduplicated page bodies """
+
+import pytest
+
+from crawler.bench import synthetic_page
+from crawler.bodies import BodyCodec, Dictionaries, zstandard
+from crawler.sqlite_storage import SqliteApi
+
+CODECS = ["zlib", pytest.param("zstd", marks=pytest.mark.skipif(zstandard is None, reason="needs zstandard"))]
+SAMPLES = 32
+
+
+def document(n):
+    """ A page of many lines, most of them shared with the other pages. """
+    return synthetic_page(n).decode("utf-8").replace("><", ">\n<").replace("Vsebina", "Vsebina št. %d" % n)
+
+
+@pytest.fixture
+def api(tmp_path):
+    api = SqliteApi(str(tmp_path / "crawl.sqlite"), html_storage="dedup")
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def site_id(api):
+    return api.insert_site("www.gov.si", "", "")
+
+
+def codec_for(api, codec, samples=SAMPLES):
+    # dictionaries of other tests' databases are not shared with this one
+    api._bodies = BodyCodec(api, codec, Dictionaries(samples))
+    return api._bodies
+
+
+def content_rows(api):
+    return api.cursor.execute("SELECT count(*) FROM content").fetchone()[0]
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip_without_dictionary(api, site_id, codec):
+    bodies = codec_for(api, codec)
+    for text in (document(1), "", "<p>čćžšđ €</p>" * 100):
+        hash, used, dictionary_id, size, data = bodies.encode(site_id, text)
+        assert (used, dictionary_id, size) == (codec, None, len(text.encode("utf-8")))
+        assert bodies.decode(used, dictionary_id, data) == text
+    assert bodies.encode(None, document(1))[2] is None
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_round_trip_with_trained_dictionary(api, site_id, codec):
+    bodies = codec_for(api, codec)
+    rows = [bodies.encode(site_id, document(n)) for n in range(SAMPLES)]
+    # the body completing the samples trains the site's dictionary
+    assert [row[2] for row in rows[:-1]] == [None] * (SAMPLES - 1)
+    dictionary_id = rows[-1][2]
+    assert dictionary_id is not None
+
+    text = document(1000)
+    hash, used, used_dictionary, size, data = bodies.encode(site_id, text)
+    assert used_dictionary == dictionary_id
+    assert len(data) < len(bodies.compress(text.encode("utf-8")))
+    assert bodies.decode(used, used_dictionary, data) == text
+
+    # another connection reads the dictionary from the database
+    reader = BodyCodec(api, codec, Dictionaries(SAMPLES))
+    assert [reader.decode(*row[1:3], row[4]) for row in rows] == [document(n) for n in range(SAMPLES)]
+    assert reader.decode(used, used_dictionary, data) == text
+    assert reader.dictionary_for(site_id, b"") == dictionary_id
+    with pytest.raises(KeyError):
+        reader.decode(used, dictionary_id + 1, data)
+
+
+def test_repeated_body_is_stored_once(api, site_id):
+    codec_for(api, "zlib", samples=2)
+    text = document(1)
+    first = api.insert_page(site_id, "HTML", "http://www.gov.si/a", text, 200, None)
+    second = api.insert_page(site_id, "HTML", "http://www.gov.si/b", text, 200, None)
+    assert content_rows(api) == 1
+
+    third = api.insert_page(site_id, "FRONTIER", "http://www.gov.si/c", None, None, None)
+    api.update_page(third, "HTML", document(2), 200, None)
+    assert content_rows(api) == 2
+    # the body of the second page trained a dictionary, the third one is compressed with it
+    assert api.cursor.execute("SELECT dictionary_id FROM content ORDER BY id").fetchall() == [(None, ), (1, )]
+
+    assert api.cursor.execute("SELECT count(*) FROM page WHERE html_content IS NOT NULL").fetchone() == (0, )
+    assert [api.page_html(id) for id in (first, second, third)] == [text, text, document(2)]
+    assert api.page_html(third + 1) is None
+
+
+def test_inline_page_html(tmp_path):
+    api = SqliteApi(str(tmp_path / "inline.sqlite"))
+    site_id = api.insert_site("www.gov.si", "", "")
+    text = document(1)
+    page_id = api.insert_page(site_id, "HTML", "http://www.gov.si/a", text, 200, None)
+    frontier_id = api.insert_page(site_id, "FRONTIER", "http://www.gov.si/b", None, None, None)
+    assert api.cursor.execute("SELECT count(*) FROM content").fetchone() == (0, )
+    assert api.page_html(page_id) == text
+    assert api.page_html(frontier_id) is None
+    api.close()
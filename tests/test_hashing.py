@@ -0,0 +1,93 @@
+""" SimHash fingerprints and the near-duplicate index """
+
+import random
+
+import pytest
+
+from crawler.hashing import DuplicateIndex, from_bigint, hamming, hash_document, main_text, simhash, to_bigint
+
+DISTANCE = 3
+
+WORDS = ("vlada republika slovenija ministrstvo zakon uredba javni razpis obvestilo seja odbor proračun "
+         "občina davek pokojnina zdravje šolstvo promet okolje kmetijstvo kultura sodišče policija").split()
+
+
+def text(seed, words=400):
+    rnd = random.Random(seed)
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+def page(body, nav="Domov O nas Kontakt Novice Zaposlitve Iskanje"):
+    return ("<html><head><title>gov.si</title><style>p { color: red }</style></head><body>"
+            "<header><nav>%s</nav></header><main><p>%s</p></main><footer>%s</footer></body></html>" % (nav, body, nav))
+
+
+def test_identical_bodies_have_the_same_fingerprints():
+    assert hash_document(page(text(1))) == hash_document(page(text(1)))
+    assert simhash(page(text(1))) == simhash(page(text(1)))
+
+
+def test_near_identical_bodies_are_within_the_threshold():
+    body = text(1).split()
+    edited = list(body)
+    edited[200] = "spremenjeno"
+    assert hamming(simhash(page(" ".join(body))), simhash(page(" ".join(edited)))) <= DISTANCE
+    # the same text under other navigation is the same main text
+    assert simhash(page(text(1))) == simhash(page(text(1), nav="Home About Contact"))
+
+
+@pytest.mark.parametrize("seed", range(2, 7))
+def test_unrelated_bodies_are_not(seed):
+    assert hamming(simhash(page(text(1))), simhash(page(text(seed)))) > DISTANCE
+
+
+def test_boilerplate_is_not_main_text():
+    document = "<body><nav>Domov</nav><!-- <main>skrito</main> --><p>vsebina</p><footer>Kontakt</footer></body>"
+    assert main_text(document).split() == ["vsebina"]
+    assert main_text("<body><nav>Domov</nav><article>članek</article><p>drugo</p></body>").split() == ["članek"]
+
+
+def test_bigint_round_trip():
+    for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+        assert -(1 << 63) <= to_bigint(value) < 1 << 63
+        assert from_bigint(to_bigint(value)) == value
+
+
+def test_index_finds_exact_and_near_duplicates():
+    index = DuplicateIndex(DISTANCE)
+    document = page(text(1))
+    index.add(7, hash_document(document), to_bigint(simhash(document)))
+
+    assert index.find(hash_document(document), to_bigint(simhash(document))) == (7, True)
+    edited = page(text(1).replace(" ", " zakon ", 1))
+    assert index.find(hash_document(edited), to_bigint(simhash(edited))) == (7, False)
+    other = page(text(2))
+    assert index.find(hash_document(other), to_bigint(simhash(other))) == (None, False)
+
+
+def test_band_lookup_finds_a_planted_near_duplicate():
+    rnd = random.Random(42)
+    index = DuplicateIndex(DISTANCE)
+    for page_id in range(5000):
+        index.add(page_id, page_id, to_bigint(rnd.getrandbits(64)))
+
+    query = rnd.getrandbits(64)
+    band_bits = index.band_bits
+    # differs in one bit of each of the first three bands: only the last band matches
+    planted = query ^ (1 << 3) ^ (1 << (band_bits + 5)) ^ (1 << (2 * band_bits + 7))
+    index.add(9999, -1, to_bigint(planted))
+    assert index.find(-2, to_bigint(query)) == (9999, False)
+
+    # one more bit in the last band: no band agrees any more
+    farther = DuplicateIndex(DISTANCE)
+    farther.add(9999, -1, to_bigint(planted ^ (1 << (3 * band_bits + 1))))
+    assert farther.find(-2, to_bigint(query)) == (None, False)
+
+
+def test_snapshot_restore():
+    index = DuplicateIndex(DISTANCE)
+    index.add(1, 11, to_bigint(simhash(page(text(1)))))
+    restored = DuplicateIndex(DISTANCE)
+    assert restored.restore(index.snapshot())
+    assert restored.find(11, 0) == (1, True)
+    assert not DuplicateIndex(DISTANCE + 1).restore(index.snapshot())
@@ -0,0 +1,67 @@
+""" Link extraction with `html.parser` """
+
+import pytest
+
+from crawler.links import extract_links
+
+PAGE = "http://www.gov.si/teme/zdravje/index.html"
+
+
+@pytest.mark.parametrize("html, url, hrefs", [
+    # absolute links, canonicalised
+    ('<a href="HTTP://WWW.GOV.SI/a/../b">b</a>', None, ["http://www.gov.si/b"]),
+    # relative links need the page url or a base
+    ('<a href="novice/">novice</a>', None, []),
+    ('<a href="novice/">novice</a>', PAGE, ["http://www.gov.si/teme/zdravje/novice/"]),
+    ('<a href="/kontakt">kontakt</a>', PAGE, ["http://www.gov.si/kontakt"]),
+    ('<a href="../promet/">promet</a>', PAGE, ["http://www.gov.si/teme/promet/"]),
+    ('<a href="//e-uprava.gov.si/">e-uprava</a>', "https://www.gov.si/", ["https://e-uprava.gov.si/"]),
+    ('<a href="  /a  ">a</a>', PAGE, ["http://www.gov.si/a"]),
+    # `<base href>` wins over the page url, a relative base is resolved against the page url
+    ('<base href="http://evem.gov.si/evem/"><a href="novice.evem">n</a>', PAGE,
+     ["http://evem.gov.si/evem/", "http://evem.gov.si/evem/novice.evem"]),
+    ('<base href="/arhiv/"><a href="2019/">2019</a>', PAGE, ["http://www.gov.si/arhiv/", "http://www.gov.si/arhiv/2019/"]),
+    ('<base href="http://evem.gov.si/evem/"><a href="novice.evem">n</a>', None,
+     ["http://evem.gov.si/evem/", "http://evem.gov.si/evem/novice.evem"]),
+    # not fetchable
+    ('<a href="mailto:gp@gov.si">pošta</a><a href="javascript:void(0)">x</a><a href="tel:+386">t</a>', PAGE, []),
+    # `onclick` locations
+    ('<button onclick="location.href=\'/prijava\'">Prijava</button>', PAGE, ["http://www.gov.si/prijava"]),
+    ('<div onclick="window.location = &quot;http://evem.gov.si/&quot;">x</div>', None, ["http://evem.gov.si/"]),
+    ('<tr onclick="document.location.assign(\'vloga.html\')">', PAGE, ["http://www.gov.si/teme/zdravje/vloga.html"]),
+    ('<a onclick="return confirm(\'Ste prepričani?\')" href="/izbris">x</a>', PAGE, ["http://www.gov.si/izbris"]),
+])
+def test_hrefs(html, url, hrefs):
+    assert extract_links(html, url)[0] == hrefs
+
+
+@pytest.mark.parametrize("html, url, images", [
+    ('<img src="http://www.gov.si/slika.png">', None, ["http://www.gov.si/slika.png"]),
+    ('<img src="slike/grb.png">', PAGE, ["http://www.gov.si/teme/zdravje/slike/grb.png"]),
+    ('<img src="slike/grb.png">', None, []),
+    ('<base href="http://www.gov.si/static/"><img src="grb.png"/>', None, ["http://www.gov.si/static/grb.png"]),
+    ('<img src="data:image/png;base64,iVBORw0KGgo=">', PAGE, []),
+    ('<img alt="brez vira"><img src>', PAGE, []),
+    # only images, not other `src` attributes
+    ('<script src="/app.js"></script><iframe src="/okno"></iframe>', PAGE, []),
+])
+def test_images(html, url, images):
+    assert extract_links(html, url)[1] == images
+
+
+@pytest.mark.parametrize("html", [
+    '<a href="/a">a<a href="/b">b',                        # unclosed tags
+    '<p><a href="/a">a</p></a><a href="/b"></div>b</a>',   # misnested tags
+    '<a href=/a>a</a><a href=\'/b\'>b</a>',                # unquoted and single-quoted attributes
+    '<A HREF="/a">a</A><a href="/b"',                      # upper case, document ends inside a tag
+    '<!-- <a href="/c"> --><a href="/a">a</a><![CDATA[x]]><a href="/b">',
+])
+def test_malformed_html(html):
+    hrefs = extract_links(html, PAGE)[0]
+    assert "http://www.gov.si/a" in hrefs
+    assert "http://www.gov.si/c" not in hrefs
+
+
+def test_character_references_are_decoded():
+    assert extract_links('<a href="/iskanje?q=1&amp;stran=2">x</a>', PAGE)[0] == \
+        ["http://www.gov.si/iskanje?q=1&stran=2"]
@@ -0,0 +1,112 @@
+""" Static scores, OPIC cash and the frontier order they give """
+
+import random
+
+import pytest
+
+from crawler.priority import CASH_PER_PAGE, PriorityScorer
+from crawler.sqlite_storage import SqliteApi
+from crawler.utils import WriteBatch
+
+
+@pytest.fixture
+def api(tmp_path):
+    api = SqliteApi(str(tmp_path / "crawl.sqlite"))
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def site_id(api):
+    return api.insert_site("www.gov.si", "", "")
+
+
+def priorities(api):
+    return dict(api.cursor.execute("SELECT url, priority FROM page WHERE page_type_code = 'FRONTIER'").fetchall())
+
+
+@pytest.mark.parametrize("url, depth, in_sitemap, score", [
+    ("http://www.gov.si/", 0, False, 1.0 + 2.0),
+    ("http://www.gov.si", 0, True, 1.0 + 1.0 + 2.0),
+    ("http://www.gov.si/teme/", 1, False, 0.5),
+    ("http://www.gov.si/teme/", 3, True, 0.25 + 1.0),
+    ("http://www.gov.si/novice/2019/", 1, False, 0.5 + 1.0),
+    ("http://www.gov.si/en/news/", 1, False, 0.5 - 0.5),
+    ("http://www.gov.si/novice/?stran=2", 1, False, 0.5 + 1.0 - 1.0 - 0.5),
+    ("http://www.gov.si/iskanje?q=zakon", 2, False, 1 / 3 - 1.0 - 0.5),
+    ("http://www.gov.si/PRIJAVA", 1, False, 0.5 - 2.0),
+    ("http://www.gov.si/teme/", None, False, 1.0),
+])
+def test_score(url, depth, in_sitemap, score):
+    assert PriorityScorer().score(url, depth, in_sitemap) == pytest.approx(score)
+
+
+@pytest.mark.parametrize("cash_weight", [1.0, 0.5])
+def test_cash_is_conserved_across_outlinks(cash_weight):
+    rnd = random.Random(1)
+    links = {(from_id, rnd.randrange(1000, 1100)) for from_id in range(1, 50) for _ in range(rnd.randrange(1, 30))}
+    cash = PriorityScorer(cash_weight=cash_weight).cash(sorted(links))
+
+    # every linking page hands out exactly its unit of cash, split evenly
+    sources = {from_id for from_id, _ in links}
+    assert sum(cash.values()) == pytest.approx(len(sources) * cash_weight * CASH_PER_PAGE)
+    for to_id, received in cash.items():
+        assert received == pytest.approx(sum(cash_weight * CASH_PER_PAGE / sum(1 for f, _ in links if f == from_id)
+                                             for from_id, target in links if target == to_id))
+    assert PriorityScorer().cash([]) == {}
+
+
+def test_stored_links_hand_out_cash(api, site_id):
+    batch = WriteBatch()
+    batch.add_frontier("http://www.gov.si/a", site_id)
+    batch.add_frontier("http://www.gov.si/b", site_id)
+    ids = batch.flush(api)
+    source, other = ids["http://www.gov.si/a"], ids["http://www.gov.si/b"]
+    before = priorities(api)
+
+    targets = ["http://www.gov.si/teme/%d" % n for n in range(4)]
+    batch = WriteBatch()
+    for url in targets:
+        batch.add_frontier(url, site_id, source_id=source)
+        batch.add_link(source, url)
+    batch.add_link(other, targets[0])
+    batch.flush(api)
+
+    static = PriorityScorer().score(targets[0], 1)
+    after = priorities(api)
+    assert [after[url] - static for url in targets] == pytest.approx([0.25 + 1.0, 0.25, 0.25, 0.25])
+    assert sum(after[url] for url in targets) - 4 * static == pytest.approx(2 * CASH_PER_PAGE)
+    assert {url: after[url] for url in before} == before
+
+    # a link stored again hands out nothing
+    batch = WriteBatch()
+    batch.add_link(other, targets[0])
+    batch.flush(api)
+    assert priorities(api) == after
+
+
+def test_frontier_is_claimed_by_priority(api, site_id):
+    urls = ["http://www.gov.si/iskanje/%d" % n for n in range(3)] + \
+           ["http://www.gov.si/teme/%d" % n for n in range(3)] + \
+           ["http://www.gov.si/", "http://www.gov.si/novice/"]
+    batch = WriteBatch()
+    for url in urls:
+        batch.add_frontier(url, site_id, in_sitemap=url.endswith("/novice/"))
+    batch.flush(api)
+
+    # pages linking to the second `teme` url lift it above the others with its static score
+    sources = ["http://www.gov.si/vir/%d" % n for n in range(3)]
+    batch = WriteBatch()
+    for url in sources:
+        batch.add_frontier(url, site_id)
+    batch.flush(api)
+    batch = WriteBatch()
+    for url in sources:
+        batch.add_link(api.page_for_url(url), "http://www.gov.si/teme/1")
+    batch.flush(api)
+
+    claimed = [url for _, url, _, _ in api.claim_from_frontier(len(urls) + len(sources), owner="a")]
+    assert claimed[:3] == ["http://www.gov.si/teme/1", "http://www.gov.si/", "http://www.gov.si/novice/"]
+    # equal priorities in insertion order, penalised urls last
+    assert claimed[3:] == ["http://www.gov.si/teme/0", "http://www.gov.si/teme/2"] + sources + urls[:3]
+    assert api.claim_from_frontier(1, owner="a") == []
@@ -0,0 +1,144 @@
+""" Change-rate estimates, revisit intervals and conditional recrawls """
+
+import datetime
+import math
+
+import pytest
+
+from crawler.bench import StandInServer
+from crawler.client import http_client
+from crawler.metrics import metrics
+from crawler.recrawl import DEFAULT_RATE, RecrawlPolicy, Revisit
+from crawler.sqlite_storage import SqliteApi
+from crawler.web_crawler import Worker
+
+START = datetime.datetime(2019, 3, 1, 12)
+
+
+@pytest.fixture
+def api(tmp_path):
+    api = SqliteApi(str(tmp_path / "crawl.sqlite"))
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(http_client.session, "trust_env", False)
+    with StandInServer() as server:
+        yield server
+
+
+def revisits(result):
+    return metrics.counters.get(("revisits", (("result", result), )), 0)
+
+
+def replay(policy, history):
+    """ `page_revisit` row after visits on the `(day, changed)` pairs of `history`. """
+    row, revisit = None, None
+    for day, changed in history:
+        accessed_time = START + datetime.timedelta(days=day)
+        row = policy.visit(1, revisit, changed, accessed_time, etag='"%d"' % day if changed else None)
+        page_id, etag, last_modified, visits, changes, observed_days, rate, next_visit = row
+        revisit = Revisit(page_id, etag, last_modified, None, visits, changes, observed_days, accessed_time)
+    return row
+
+
+@pytest.mark.parametrize("intervals, changes, observed_days, rate", [
+    (0, 0, 0.0, DEFAULT_RATE),
+    (4, 0, 8.0, 0.0),
+    (4, 2, 8.0, -math.log(2.5 / 4.5) / 2),
+    (10, 10, 10.0, -math.log(0.5 / 10.5)),
+    # the same history observed over twice the time is half the rate
+    (10, 5, 10.0, -math.log(5.5 / 10.5)),
+    (10, 5, 20.0, -math.log(5.5 / 10.5) / 2),
+])
+def test_change_rate(intervals, changes, observed_days, rate):
+    assert RecrawlPolicy().change_rate(intervals, changes, observed_days) == pytest.approx(rate)
+
+
+@pytest.mark.parametrize("rate, days", [
+    (0.0, 30.0),
+    (math.log(2) / 5, 5.0),
+    (DEFAULT_RATE, 7 * math.log(2)),
+    (10.0, 1.0),
+    (0.001, 30.0),
+])
+def test_interval_is_clamped(rate, days):
+    assert RecrawlPolicy(target=0.5, min_days=1.0, max_days=30.0).interval(rate) == pytest.approx(days)
+
+
+@pytest.mark.parametrize("history, visits, changes, observed_days, days", [
+    # first visit: the default rate
+    ([(0, True)], 1, 0, 0.0, 7 * math.log(2)),
+    # never changed on weekly revisits: as late as allowed
+    ([(0, True), (7, False), (14, False), (21, False)], 4, 0, 21.0, 30.0),
+    # changed on every other of four revisits two days apart
+    ([(0, True), (2, True), (4, False), (6, True), (8, False)], 5, 2, 8.0, math.log(2) / (-math.log(2.5 / 4.5) / 2)),
+    # changed on every daily revisit: as early as allowed
+    ([(day, True) for day in range(6)], 6, 5, 5.0, 1.0),
+])
+def test_visit_history_sets_next_visit(history, visits, changes, observed_days, days):
+    page_id, etag, last_modified, *counts, rate, next_visit = replay(RecrawlPolicy(), history)
+    assert counts == [visits, changes, pytest.approx(observed_days)]
+    last_day = history[-1][0]
+    assert (next_visit - START).total_seconds() / 86400 == pytest.approx(last_day + days)
+
+
+def test_validators_are_kept_when_a_304_omits_them():
+    policy = RecrawlPolicy()
+    first = policy.visit(1, None, True, START, '"a"', "Fri, 01 Mar 2019 12:00:00 GMT")
+    revisit = Revisit(1, first[1], first[2], None, *first[3:6], START)
+    assert revisit.headers() == {"If-None-Match": '"a"', "If-Modified-Since": "Fri, 01 Mar 2019 12:00:00 GMT"}
+
+    assert policy.visit(1, revisit, False, START + datetime.timedelta(days=1))[1:3] == \
+        ('"a"', "Fri, 01 Mar 2019 12:00:00 GMT")
+    assert policy.visit(1, revisit, True, START + datetime.timedelta(days=1), '"b"')[1:3] == \
+        ('"b"', "Fri, 01 Mar 2019 12:00:00 GMT")
+    assert Revisit(1, None, None, None, 1, 0, 0.0, START).headers() == {}
+
+
+def test_conditional_recrawl(api, server):
+    url = server.base_url + "/page/3"
+    site_id = api.insert_site(Worker.get_domain_from_url(url), "", "")
+    worker = Worker(0, conn=api, recrawl=RecrawlPolicy())
+
+    def revisit_row():
+        return api.cursor.execute("SELECT etag, visits, changes, next_visit FROM page_revisit WHERE page_id = ?",
+                                  (api.page_for_url(url), )).fetchone()
+
+    def accessed_time():
+        return api.cursor.execute("SELECT accessed_time FROM page WHERE url = ?", (url, )).fetchone()[0]
+
+    def days_until(next_visit):
+        return (datetime.datetime.fromisoformat(str(next_visit)) - datetime.datetime.now()).total_seconds() / 86400
+
+    worker.fetch_url(url, site_id, False)
+    etag, visits, changes, next_visit = revisit_row()
+    assert (etag, visits, changes) == ('"3-0"', 1, 0)
+    assert days_until(next_visit) == pytest.approx(7 * math.log(2), abs=0.01)
+    assert api.requeue_due(datetime.datetime.now()) == 0
+
+    # requeued once due, answered with a 304: only the visit is recorded
+    assert api.requeue_due(datetime.datetime.now() + datetime.timedelta(days=7)) == 1
+    stored = api.cursor.execute("SELECT html_content, hash FROM page WHERE url = ?", (url, )).fetchone()
+    first_access = accessed_time()
+    not_modified = revisits("not_modified")
+    worker.fetch_url(url, site_id, False)
+    assert revisits("not_modified") == not_modified + 1
+    etag, visits, changes, next_visit = revisit_row()
+    assert (etag, visits, changes) == ('"3-0"', 2, 0)
+    assert days_until(next_visit) == pytest.approx(30.0, abs=0.01)
+    assert api.cursor.execute("SELECT page_type_code, http_status_code, html_content, hash FROM page WHERE url = ?",
+                              (url, )).fetchone() == ("HTML", 200) + stored
+    assert accessed_time() > first_access
+
+    # changed since: fetched in full, with new validators and a shorter interval
+    server.httpd.versions[3] = 1
+    changed = revisits("changed")
+    worker.fetch_url(url, site_id, False)
+    assert revisits("changed") == changed + 1
+    etag, visits, changes, next_visit = revisit_row()
+    assert (etag, visits, changes) == ('"3-1"', 3, 1)
+    assert days_until(next_visit) == pytest.approx(1.0, abs=0.01)
+    assert api.cursor.execute("SELECT hash FROM page WHERE url = ?", (url, )).fetchone() != stored[1:]
@@ -0,0 +1,79 @@
+""" Bloom filter of seen urls """
+
+import pytest
+
+from crawler.seen import BloomFilter, SeenUrls
+from crawler.sqlite_storage import SqliteApi
+from crawler.utils import WriteBatch
+
+
+@pytest.fixture
+def api(tmp_path):
+    api = SqliteApi(str(tmp_path / "crawl.sqlite"))
+    yield api
+    api.close()
+
+
+def store(api, urls):
+    site_id = api.insert_site("www.gov.si", "", "")
+    batch = WriteBatch()
+    for url in urls:
+        batch.add_frontier(url, site_id)
+    batch.flush(api)
+
+
+def test_no_false_negatives():
+    bloom = BloomFilter(capacity=10000, error_rate=0.01)
+    urls = ["http://www.gov.si/page/%d" % n for n in range(10000)]
+    for url in urls:
+        bloom.add(url)
+    assert all(url in bloom for url in urls)
+    assert bloom.add(urls[0]) is False
+
+
+@pytest.mark.parametrize("error_rate", [0.01, 0.001])
+def test_false_positive_rate_near_target(error_rate):
+    capacity = 20000
+    bloom = BloomFilter(capacity=capacity, error_rate=error_rate)
+    for n in range(capacity):
+        bloom.add("http://www.gov.si/page/%d" % n)
+
+    probes = 100000
+    false_positives = sum("http://www.gov.si/other/%d" % n in bloom for n in range(probes))
+    # a filter filled to capacity is at its configured rate, give or take sampling noise
+    assert false_positives / probes < 1.5 * error_rate
+    assert bloom.error_rate() == pytest.approx(error_rate, rel=0.2)
+    assert bloom.count > 0.99 * capacity
+
+
+def test_warm_seeds_from_iter_urls(api):
+    stored = ["http://www.gov.si/page/%d" % n for n in range(50)]
+    store(api, stored)
+
+    seen = SeenUrls(capacity=1000)
+    seen.warm(api)
+    assert all(url in seen.bloom for url in stored)
+    assert seen.filter_unseen(stored + ["http://www.gov.si/new"], api) == ["http://www.gov.si/new"]
+
+
+def test_warm_since_id(api):
+    store(api, ["http://www.gov.si/old"])
+    since = api.max_page_id()
+    store(api, ["http://www.gov.si/new"])
+
+    seen = SeenUrls(capacity=1000)
+    seen.warm(api, since_id=since)
+    assert "http://www.gov.si/new" in seen.bloom
+    assert "http://www.gov.si/old" not in seen.bloom
+
+
+def test_false_positives_are_confirmed_against_the_db(api):
+    store(api, ["http://www.gov.si/stored"])
+    seen = SeenUrls(capacity=1000)
+    # a url reported as present by the filter but never stored
+    seen.add("http://www.gov.si/queued")
+
+    assert seen.filter_unseen(["http://www.gov.si/queued", "http://www.gov.si/queued"], api) == \
+        ["http://www.gov.si/queued"]
+    assert seen.false_positives == 1 and seen.db_confirmations == 1
+    assert not seen.contains("http://www.gov.si/other", api)
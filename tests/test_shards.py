@@ -0,0 +1,86 @@
+""" Domain shards: `url_shard` and sharded frontier claims """
+
+import zlib
+
+import pytest
+
+from crawler.frontier import FrontierQueue
+from crawler.sqlite_storage import SqliteApi, url_shard
+from crawler.utils import WriteBatch
+
+DOMAINS = ["www.gov.si", "e-uprava.gov.si", "evem.gov.si", "www.stat.si", "podatki.gov.si", "www.fu.gov.si",
+           "www.zrsz.gov.si", "www.arso.gov.si", "mju.gov.si", "www.policija.si", "www.uradni-list.si", "nio.gov.si"]
+
+
+@pytest.fixture
+def api(tmp_path):
+    api = SqliteApi(str(tmp_path / "crawl.sqlite"))
+    batch = WriteBatch()
+    for domain in DOMAINS:
+        site_id = api.insert_site(domain, "", "")
+        for n in range(5):
+            batch.add_frontier("http://%s/page/%d" % (domain, n), site_id)
+    batch.flush(api)
+    yield api
+    api.close()
+
+
+def domain(url):
+    return url.split("/")[2]
+
+
+def test_url_shard_is_stable():
+    # crc32 of the domain without `www.`: the same in every process and on every node
+    for count in (1, 2, 3, 8, 64):
+        assert url_shard("http://www.gov.si/", count) == zlib.crc32(b"gov.si") % count
+
+
+@pytest.mark.parametrize("url", [
+    "http://gov.si/",
+    "https://www.gov.si/podrocja/",
+    "http://WWW.GOV.SI/",
+    "http://www.gov.si:8080/a",
+    "http://www.gov.si?q=1",
+    "http://www.gov.si#top",
+])
+def test_url_shard_owns_whole_domains(url):
+    assert url_shard(url, 16) == url_shard("http://www.gov.si/", 16)
+
+
+def test_url_shard_spreads_domains():
+    shards = {url_shard("http://site-%d.gov.si/" % n, 8) for n in range(200)}
+    assert shards == set(range(8))
+
+
+@pytest.mark.parametrize("count", [1, 2, 3, 5])
+def test_shards_claim_disjoint_rows(api, count):
+    claimed = {index: api.claim_from_frontier(1000, shard=(index, count), owner="shard-%d" % index)
+               for index in range(count)}
+
+    ids = [row[0] for rows in claimed.values() for row in rows]
+    assert len(ids) == len(set(ids)) == len(DOMAINS) * 5
+    for index, rows in claimed.items():
+        assert all(url_shard(url, count) == index for _, url, _, _ in rows)
+    domains = [{domain(row[1]) for row in rows} for rows in claimed.values()]
+    assert sum(map(len, domains)) == len(DOMAINS)
+
+
+def test_shard_reclaims_only_its_expired_leases(api):
+    for index in range(2):
+        api.claim_from_frontier(1000, shard=(index, 2), owner="shard-%d" % index, lease=-1)
+
+    rows = api.claim_from_frontier(1000, shard=(0, 2), owner="shard-0b")
+    assert rows and all(url_shard(url, 2) == 0 for _, url, _, _ in rows)
+    assert api.claim_from_frontier(1000, shard=(0, 2), owner="shard-0c") == []
+
+
+def test_frontier_queue_stays_in_its_shard(api):
+    queue = FrontierQueue(api, batch_size=7, shard=(1, 3), owner="shard-1")
+    urls = []
+    while True:
+        row = queue.get()
+        if row is None:
+            break
+        urls.append(row[1])
+    assert urls and all(url_shard(url, 3) == 1 for url in urls)
+    assert api.claim_from_frontier(1000, shard=(1, 3), owner="shard-1b") == []
@@ -0,0 +1,68 @@
+""" `SitemapReader` against a stand-in server """
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import pytest
+
+from crawler import sitemap
+from crawler.bench import StandInServer
+from crawler.client import http_client
+from crawler.sitemap import SitemapReader
+
+URLSET = '<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</urlset>'
+INDEX = '<?xml version="1.0" encoding="UTF-8"?><sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">%s</sitemapindex>'
+
+
+def urlset(*urls):
+    return (URLSET % "".join("<url><loc>%s</loc></url>" % url for url in urls)).encode(), "application/xml"
+
+
+class SerialExecutor(ThreadPoolExecutor):
+    """ Lets every location submitted by the caller be read before the next one is submitted. """
+
+    def submit(self, fn, *args, **kwargs):
+        future = super().submit(fn, *args, **kwargs)
+        if threading.current_thread() is threading.main_thread():
+            wait([future])
+        return future
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(http_client.session, "trust_env", False)
+    with StandInServer() as server:
+        yield server
+
+
+def read(reader, locations):
+    return sorted(url for chunk in reader.urls(locations) for url, _ in chunk)
+
+
+def test_sitemaps_after_a_failing_one_are_read(server, monkeypatch):
+    monkeypatch.setattr(sitemap, "ThreadPoolExecutor", SerialExecutor)
+    server.httpd.files["/b.xml"] = urlset("http://www.gov.si/b/1", "http://www.gov.si/b/2")
+    server.httpd.files["/c.xml"] = urlset("http://www.gov.si/c/1")
+
+    # /a.xml is a 404: its reader is done before /b.xml is submitted
+    locations = [server.base_url + path for path in ("/a.xml", "/b.xml", "/c.xml")]
+    assert read(SitemapReader(), locations) == ["http://www.gov.si/b/1", "http://www.gov.si/b/2",
+                                                "http://www.gov.si/c/1"]
+
+
+def test_indexes_are_followed_in_chunks(server):
+    urls = ["http://www.gov.si/%d" % n for n in range(25)]
+    server.httpd.files["/a.xml"] = urlset(*urls[:10])
+    server.httpd.files["/b.xml"] = urlset(*urls[10:])
+    server.httpd.files["/index.xml"] = ((INDEX % "".join("<sitemap><loc>%s/%s</loc></sitemap>" % (server.base_url, name)
+                                                         for name in ("a.xml", "b.xml", "missing.xml"))).encode(),
+                                        "application/xml")
+
+    chunks = list(SitemapReader(threads=2, chunk_size=4).urls([server.base_url + "/index.xml"]))
+    assert max(map(len, chunks)) == 4
+    assert sorted(url for chunk in chunks for url, _ in chunk) == sorted(urls)
+
+
+def test_no_locations(server):
+    assert read(SitemapReader(), []) == []
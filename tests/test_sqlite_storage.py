@@ -0,0 +1,182 @@
+""" `SqliteApi` through the frontier lifecycle: claim, store, batch writes and leases """
+
+import datetime
+
+import pytest
+
+from crawler.bench import StandInServer
+from crawler.client import http_client
+from crawler.sqlite_storage import SqliteApi
+from crawler.storage import Storage
+from crawler.utils import BatchError, WriteBatch
+from crawler.web_crawler import Worker
+
+
+def page(api, page_id):
+    return api.cursor.execute("SELECT page_type_code, http_status_code, leased_by, lease_expires FROM page "
+                              "WHERE id = ?", (page_id, )).fetchone()
+
+
+@pytest.fixture
+def api(tmp_path):
+    api = SqliteApi(str(tmp_path / "crawl.sqlite"))
+    yield api
+    api.close()
+
+
+@pytest.fixture
+def site_id(api):
+    return api.insert_site("www.gov.si", "", "")
+
+
+def queue(api, site_id, *urls):
+    batch = WriteBatch()
+    for url in urls:
+        batch.add_frontier(url, site_id)
+    return batch.flush(api)
+
+
+def test_storage_is_abstract():
+    class Partial(Storage):
+        def commit(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_batch_flush_inserts_frontier_and_links(api, site_id):
+    inserted = queue(api, site_id, "http://www.gov.si/", "http://www.gov.si/a")
+    assert set(inserted) == {"http://www.gov.si/", "http://www.gov.si/a"}
+
+    batch = WriteBatch()
+    source = inserted["http://www.gov.si/"]
+    batch.add_frontier("http://www.gov.si/a", site_id, source_id=source)
+    batch.add_frontier("http://www.gov.si/b", site_id, source_id=source)
+    batch.add_link(source, "http://www.gov.si/a")
+    batch.add_link(source, "http://www.gov.si/b")
+    assert list(batch.flush(api)) == ["http://www.gov.si/b"]
+    assert len(batch) == 0
+
+    links = api.cursor.execute("SELECT to_page FROM link WHERE from_page = ?", (source, )).fetchall()
+    assert {id for id, in links} == {inserted["http://www.gov.si/a"], api.page_for_url("http://www.gov.si/b")}
+    depth, = api.cursor.execute("SELECT depth FROM page WHERE url = ?", ("http://www.gov.si/b", )).fetchone()
+    assert depth == 1
+
+
+def test_bad_row_loses_only_the_rows_of_its_page(api, site_id):
+    inserted = queue(api, site_id, "http://www.gov.si/a", "http://www.gov.si/b")
+    bad, good = inserted["http://www.gov.si/a"], inserted["http://www.gov.si/b"]
+
+    batch = WriteBatch(max_age=60)
+    batch.add_frontier("http://www.gov.si/a/1", site_id, source_id=bad)
+    batch.add_link(bad, "http://www.gov.si/a/1")
+    batch.add_image(bad, ["slika.png"], "image/png", b"", datetime.datetime.now())
+    batch.add_frontier("http://www.gov.si/b/1", site_id, source_id=good)
+    batch.add_link(good, "http://www.gov.si/b/1")
+    batch.add_link(good, "http://www.gov.si/a/1")
+    batch.add_page_data(good, "PDF", b"%PDF")
+    with pytest.raises(BatchError) as info:
+        batch.flush(api)
+
+    assert list(info.value.errors) == [bad]
+    assert len(batch) == 0
+    # the link of the good page to a url found on the bad page is written with that url
+    assert set(info.value.inserted) == {"http://www.gov.si/b/1", "http://www.gov.si/a/1"}
+    assert api.cursor.execute("SELECT count(*) FROM link WHERE from_page = ?", (good, )).fetchone() == (2, )
+    assert api.cursor.execute("SELECT count(*) FROM page_data WHERE page_id = ?", (good, )).fetchone() == (1, )
+    assert api.cursor.execute("SELECT count(*) FROM link WHERE from_page = ?", (bad, )).fetchone() == (0, )
+    assert api.cursor.execute("SELECT count(*) FROM image").fetchone() == (0, )
+
+
+def test_claim_leases_rows_once(api, site_id):
+    queue(api, site_id, *["http://www.gov.si/%d" % n for n in range(5)])
+
+    first = api.claim_from_frontier(3, owner="a")
+    second = api.claim_from_frontier(3, owner="b")
+    assert len(first) == 3 and len(second) == 2
+    assert not {row[0] for row in first} & {row[0] for row in second}
+    assert api.claim_from_frontier(3, owner="c") == []
+
+    type_code, status, leased_by, lease_expires = page(api, first[0][0])
+    assert (type_code, status, leased_by) == ("IN PROGRESS", None, "a")
+    assert lease_expires is not None
+
+
+def test_update_page_ends_lease(api, site_id):
+    queue(api, site_id, "http://www.gov.si/")
+    page_id, url, _, _ = api.claim_from_frontier(1, owner="a")[0]
+
+    api.update_page(page_id, "HTML", "<html></html>", 200, datetime.datetime.now())
+    assert page(api, page_id) == ("HTML", 200, None, None)
+    assert api.renew_leases("a") == 0
+
+
+def test_failure_is_stored_on_the_claimed_row(api, site_id):
+    queue(api, site_id, "http://www.gov.si/slika.png")
+    row = api.claim_from_frontier(1, owner="a")[0]
+
+    worker = Worker(0, conn=api)
+    worker.row = row
+    # the worker fetches the canonical form, which need not be the queued url
+    worker.store_failure("http://gov.si/slika.png", site_id, 503)
+    assert page(api, row[0]) == ("HTML", 503, None, None)
+    assert api.claim_from_frontier(1, owner="b") == []
+
+
+def test_expired_leases_are_claimed_again(api, site_id):
+    queue(api, site_id, "http://www.gov.si/a")
+    expired, = api.claim_from_frontier(1, owner="a", lease=-1)
+    queue(api, site_id, "http://www.gov.si/b")
+
+    # expired leases come before the frontier
+    claimed = api.claim_from_frontier(2, owner="b")
+    assert [row[1] for row in claimed] == ["http://www.gov.si/a", "http://www.gov.si/b"]
+    assert claimed[0] == expired
+    # the previous owner can no longer renew or reclaim it
+    assert api.reclaim_leases([expired[0]], "a") == []
+    assert api.renew_leases("a") == 0
+    assert api.renew_leases("b") == 2
+
+
+def test_postponed_rows_wait_for_their_delay(api, site_id):
+    queue(api, site_id, "http://www.gov.si/")
+    page_id = api.claim_from_frontier(1, owner="a")[0][0]
+
+    assert api.postpone_leases([page_id], 60) == 1
+    assert page(api, page_id)[:3] == ("IN PROGRESS", None, None)
+    assert api.claim_from_frontier(1, owner="b") == []
+
+    api.postpone_leases([page_id], -1)
+    assert [row[0] for row in api.claim_from_frontier(1, owner="b")] == [page_id]
+
+
+def test_release_returns_rows_to_the_frontier(api, site_id):
+    queue(api, site_id, "http://www.gov.si/a", "http://www.gov.si/b")
+    kept, released = [row[0] for row in api.claim_from_frontier(2, owner="a")]
+
+    assert api.release_leases("a", keep=[kept]) == 1
+    assert page(api, released) == ("FRONTIER", None, None, None)
+    assert page(api, kept)[:3] == ("IN PROGRESS", None, "a")
+
+
+def test_crawled_image_is_stored(api, monkeypatch):
+    monkeypatch.setattr(http_client.session, "trust_env", False)
+    with StandInServer() as server:
+        html = '<html><body><img src="%s/img/logo.png"></body></html>' % server.base_url
+        server.httpd.files["/index.html"] = (html.encode(), "text/html; charset=utf-8")
+        server.httpd.files["/img/logo.png"] = (b"\x89PNG\r\n\x1a\n", "image/png")
+        url = server.base_url + "/index.html"
+        site_id = api.insert_site(Worker.get_domain_from_url(url), "", "")
+        queue(api, site_id, url)
+
+        worker = Worker(0, conn=api)
+        for _ in range(2):
+            worker.row, = api.claim_from_frontier(1, owner="a")
+            worker.fetch_url(worker.row[1], site_id, worker.row[2])
+            worker.row = None
+
+    image_page = api.page_for_url(server.base_url + "/img/logo.png")
+    assert page(api, image_page) == ("BINARY", 200, None, None)
+    assert api.cursor.execute("SELECT filename, content_type, data FROM image WHERE page_id = ?",
+                              (image_page, )).fetchall() == [("logo.png", "image/png", b"\x89PNG\r\n\x1a\n")]
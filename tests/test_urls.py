@@ -0,0 +1,150 @@
+""" `UrlEngine` canonical forms and `Scope` filtering """
+
+import pytest
+
+from crawler.urls import Scope, UrlEngine, file_type_for_content_type
+
+
+@pytest.fixture
+def engine():
+    return UrlEngine()
+
+
+@pytest.mark.parametrize("url, canonical", [
+    ("https://www.GOV.si/a/../Porocilo.PDF", "https://www.gov.si/Porocilo.PDF"),
+    ("http://WWW.Gov.Si", "http://www.gov.si/"),
+    ("HTTP://www.gov.si:80/", "http://www.gov.si/"),
+    ("https://www.gov.si:443/a", "https://www.gov.si/a"),
+    ("http://www.gov.si:8080/a", "http://www.gov.si:8080/a"),
+    ("http://www.gov.si/a/./b/../c/", "http://www.gov.si/a/c/"),
+    ("http://www.gov.si/a#vsebina", "http://www.gov.si/a"),
+    ("http://www.gov.si/a?b=1&a=2", "http://www.gov.si/a?a=2&b=1"),
+    ("http://www.gov.si/%7Euser/", "http://www.gov.si/~user/"),
+    ("https://www.gov.si/čšž", "https://www.gov.si/%C4%8D%C5%A1%C5%BE"),
+    ("http://www.gov.si/a b", "http://www.gov.si/a%20b"),
+    # the case of the path is kept
+    ("http://www.gov.si/datoteka.PPTX", "http://www.gov.si/datoteka.PPTX"),
+])
+def test_canonical_form(engine, url, canonical):
+    assert engine.parse(url).url == canonical
+
+
+@pytest.mark.parametrize("url, valid, in_scope", [
+    ("http://www.gov.si/", True, True),
+    ("https://evem.gov.si/evem/", True, True),
+    ("http://gov.si/", True, True),
+    ("http://e-uprava.gov.si:8080/", True, True),
+    ("http://xn--80ak6aa92e.gov.si/", True, True),
+    # valid, but not fetched
+    ("ftp://ftp.gov.si/x.doc", True, False),
+    # other hosts, also ones mentioning the scope
+    ("http://www.example.com/", True, False),
+    ("http://gov.si.example.com/", True, False),
+    ("http://mygov.si/", True, False),
+    ("http://example.com/?q=.gov.si", True, False),
+    ("http://192.168.1.1/a.pdf", True, False),
+    ("http://[::1]/x", True, False),
+    # not urls the crawler can fetch
+    ("/relative", False, False),
+    ("novice/", False, False),
+    ("mailto:gp@gov.si", False, False),
+    ("javascript:void(0)", False, False),
+    ("http:/www.gov.si/", False, False),
+    (" http://www.gov.si/", False, False),
+    ("http://www.gov.si/a b", False, False),
+    ("http://www.gov.si:99999/", False, False),
+    ("http://www.gov.si:x/", False, False),
+    ("http://-bad-.gov.si/", False, False),
+    ("http://www..gov.si/", False, False),
+])
+def test_validity_and_scope(engine, url, valid, in_scope):
+    info = engine.parse(url)
+    assert (info.valid, info.in_scope) == (valid, in_scope)
+
+
+@pytest.mark.parametrize("url, host, port, domain, registered_domain", [
+    ("http://www.gov.si/", "www.gov.si", None, "gov.si", "www.gov.si"),
+    ("http://gov.si/", "gov.si", None, "gov.si", "gov.si"),
+    ("http://www.gu.gov.si/", "www.gu.gov.si", None, "gu.gov.si", "gu.gov.si"),
+    ("http://sub.www.gu.gov.si/", "sub.www.gu.gov.si", None, "sub.www.gu.gov.si", "gu.gov.si"),
+    ("http://e-uprava.gov.si:8080/", "e-uprava.gov.si", "8080", "e-uprava.gov.si:8080", "e-uprava.gov.si"),
+    ("http://www.example.co.uk/", "www.example.co.uk", None, "example.co.uk", "co.uk"),
+    ("http://192.168.1.1/", "192.168.1.1", None, "192.168.1.1", "192.168.1.1"),
+])
+def test_hosts_and_domains(engine, url, host, port, domain, registered_domain):
+    info = engine.parse(url)
+    assert (info.host, info.port, info.domain, info.registered_domain) == (host, port, domain, registered_domain)
+
+
+@pytest.mark.parametrize("url, extension, file_type", [
+    ("https://www.gov.si/Porocilo.PDF", "pdf", "PDF"),
+    ("http://www.gov.si/a.doc", "doc", "DOC"),
+    ("http://www.gov.si/a.docx", "docx", "DOCX"),
+    ("http://www.gov.si/datoteka.PPTX", "pptx", "PPTX"),
+    ("http://www.gov.si/a.tar.gz", "gz", None),
+    ("http://www.gov.si/index.html", "html", None),
+    # only the extension of the last path segment counts
+    ("http://www.gov.si/dir.pdf/file", None, None),
+    ("http://www.gov.si/x.php?f=a.pdf", "php", None),
+    ("http://www.gov.si/pdf", None, None),
+    ("http://www.gov.si/", None, None),
+    ("http://www.gov.si/a.pdf-stara", None, None),
+])
+def test_file_type(engine, url, extension, file_type):
+    info = engine.parse(url)
+    assert (info.extension, info.file_type) == (extension, file_type)
+
+
+@pytest.mark.parametrize("content_type, file_type", [
+    ("application/pdf", "PDF"),
+    ("Application/PDF; charset=binary", "PDF"),
+    ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", "DOCX"),
+    ("application/vnd.ms-powerpoint", "PPT"),
+    ("text/html; charset=utf-8", None),
+    ("", None),
+    (None, None),
+])
+def test_file_type_for_content_type(content_type, file_type):
+    assert file_type_for_content_type(content_type) == file_type
+
+
+@pytest.mark.parametrize("suffixes, schemes, url, in_scope", [
+    (["gov.si"], ("http", "https"), "http://www.gov.si/", True),
+    ([".GOV.SI."], ("http", "https"), "http://www.gov.si/", True),
+    (["gov.si", "uradni-list.si"], ("http", "https"), "http://www.uradni-list.si/", True),
+    (["gov.si", "uradni-list.si"], ("http", "https"), "http://www.uradni-list.com/", False),
+    (["evem.gov.si"], ("http", "https"), "http://evem.gov.si/evem/", True),
+    (["evem.gov.si"], ("http", "https"), "http://www.gov.si/", False),
+    (["gov.si"], ("https", ), "http://www.gov.si/", False),
+    (["gov.si"], ("http", "https", "ftp"), "ftp://ftp.gov.si/", True),
+    (["si"], ("http", "https"), "http://www.example.si/", True),
+])
+def test_configured_scope(suffixes, schemes, url, in_scope):
+    assert UrlEngine(Scope(suffixes, schemes)).parse(url).in_scope == in_scope
+
+
+def test_scope_suffixes_count_as_public_suffixes():
+    scope = Scope(["gov.si", "uradni-list.si"])
+    assert scope.registered_domain("www.uradni-list.si") == "www.uradni-list.si"
+    assert scope.registered_domain("www.mju.gov.si") == "mju.gov.si"
+    assert Scope(["si"]).registered_domain("www.mju.gov.si") == "gov.si"
+
+
+def test_filter(engine):
+    urls = ["http://www.gov.si/b", "HTTP://WWW.GOV.SI/b#top", "http://www.example.com/", "novice/",
+            "http://www.gov.si/a", "http://www.gov.si/x/../b", "ftp://ftp.gov.si/"]
+    assert engine.filter(urls) == ["http://www.gov.si/b", "http://www.gov.si/a"]
+    assert engine.filter(urls, scoped=False) == ["http://www.gov.si/b", "http://www.example.com/",
+                                                 "http://www.gov.si/a", "ftp://ftp.gov.si/"]
+    assert engine.filter([]) == []
+    assert [info.url for info in engine.parse_many(urls[:2])] == ["http://www.gov.si/b"] * 2
+
+
+def test_configure_drops_cached_scope(engine):
+    url = "http://www.example.com/"
+    assert not engine.parse(url).in_scope
+    assert engine.cache_info().currsize == 1
+    engine.configure(Scope(["example.com"]))
+    assert engine.cache_info().currsize == 0
+    assert engine.parse(url).in_scope
+    assert engine.parse(url) is engine.parse(url)